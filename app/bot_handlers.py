@@ -1,7 +1,7 @@
 # app/bot_handlers.py
 import uuid
 from app.models.central_models import Tenant, Base as CentralBase
-from app.tenants import create_tenant_db, get_session_for_tenant
+from app.tenants import create_tenant_db, get_engine_for_tenant, get_session_for_tenant
 from app.database import CentralSessionLocal  # your central DB session
 from app.bot import bot  # your existing telebot instance
 
@@ -7,11 +7,16 @@ from config import DATABASE_URL
 Base = declarative_base()  # shared by all central DB models
 
 # -------------------- Engine & Session --------------------
+# Every webhook update holds a central session while it runs in the
+# threadpool, so size the pool for concurrent updates, not the default 5.
 engine = create_engine(
     DATABASE_URL,
     echo=False,
     future=True,
-    pool_pre_ping=True
+    pool_pre_ping=True,
+    pool_size=20,
+    max_overflow=10,
+    pool_recycle=1800
 )
 SessionLocal = sessionmaker(
     autocommit=False,
@@ -37,19 +42,3 @@ def get_db():
         yield db
     finally:
         db.close()
-
-# -------------------- Tenant DB Helper --------------------
-def get_engine_for_tenant(tenant_db_url: str):
-    """Return an engine for a tenant DB"""
-    return create_engine(
-        tenant_db_url,
-        echo=False,
-        future=True,
-        pool_pre_ping=True
-    )
-
-def get_tenant_session(tenant_db_url: str):
-    """Return a session for a tenant DB"""
-    engine = get_engine_for_tenant(tenant_db_url)
-    Session = sessionmaker(bind=engine, autocommit=False, autoflush=False, future=True)
-    return Session()
@@ -1,6 +1,6 @@
 # app/dependencies.py
 from fastapi import Depends, HTTPException
-from app.tenant_db import get_session_for_tenant  # updated import
+from app.tenants import get_session_for_tenant
 from app.models.central_models import Tenant
 from app.core import SessionLocal as CentralSessionLocal  # central DB session
 
@@ -1,3 +1,4 @@
+import asyncio
 from fastapi import FastAPI
 from app.routes import products, views, sales, reports, users, whatsapp, telegram
 import uvicorn
@@ -5,6 +6,7 @@ import os
 
 # ✅ FIX: Import from the NEW tenant_db.py instead of tenants.py
 from app.tenant_db import create_central_db  # ← CHANGED THIS LINE
+from app.state_store import ttl_sweeper
 
 app = FastAPI(title="POS Backend API")
 
@@ -14,6 +16,24 @@ def startup_event():
     create_central_db()  # This will now use the NEW function
     print("✅ Central database initialized successfully.")
 
+
+# -------------------- Register Telegram Webhook --------------------
+@app.on_event("startup")
+def register_telegram_webhook():
+    telegram.register_webhook()
+
+
+# -------------------- Evict Idle Conversation State --------------------
+@app.on_event("startup")
+async def start_state_sweeper():
+    asyncio.create_task(ttl_sweeper(telegram.user_states))
+    asyncio.create_task(ttl_sweeper(telegram.seen_updates))
+
+
+@app.on_event("shutdown")
+def close_http_clients():
+    telegram.shutdown_bot_api_executor()
+
 # -------------------- Include Routers --------------------
 app.include_router(products.router)
 app.include_router(views.router)
@@ -33,7 +33,7 @@ def add_stock(
     - `quantity` must be greater than 0
     - Returns the updated product
     """
-    product = db.query(ProductORM).filter(ProductORM.product_id == product_id).first()  # ORM
+    product = db.get(ProductORM, product_id)  # ORM
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
 
@@ -55,7 +55,7 @@ def reduce_stock(
     - Prevents stock from going negative
     - Returns the updated product
     """
-    product = db.query(ProductORM).filter(ProductORM.product_id == product_id).first()
+    product = db.get(ProductORM, product_id)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
 
@@ -85,7 +85,7 @@ def batch_update_stock(
     updated_products = []
 
     for upd in updates:
-        product = db.query(ProductORM).filter(ProductORM.product_id == upd.product_id).first()
+        product = db.get(ProductORM, upd.product_id)
         if not product:
             continue  # skip invalid product_ids
 
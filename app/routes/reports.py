@@ -13,6 +13,13 @@ router = APIRouter(
     tags=["reports"]
 )
 
+
+def _month_range(year: int, month: int):
+    """[start, end) datetimes for a calendar month, so filters can use the sale_date index."""
+    start = datetime(year, month, 1)
+    end = datetime(year + (month == 12), month % 12 + 1, 1)
+    return start, end
+
 @router.get("/total_sales_per_product")
 def total_sales_per_product(db: Session = Depends(get_db)):
     """
@@ -130,6 +137,7 @@ def monthly_sales_per_product(
     now = datetime.now()
     year = year or now.year
     month = month or now.month
+    start, end = _month_range(year, month)
 
     results = (
         db.query(
@@ -138,8 +146,7 @@ def monthly_sales_per_product(
             func.sum(SaleORM.total_amount).label("total_revenue")
         )
         .join(ProductORM, SaleORM.product_id == ProductORM.product_id)
-        .filter(extract("year", SaleORM.sale_date) == year)
-        .filter(extract("month", SaleORM.sale_date) == month)
+        .filter(SaleORM.sale_date >= start, SaleORM.sale_date < end)
         .group_by(ProductORM.name)
         .all()
     )
@@ -161,6 +168,7 @@ def monthly_sales_per_user(
     """
     Get monthly sales aggregated by user.
     """
+    start, end = _month_range(year, month)
     results = (
         db.query(
             User.name.label("user"),
@@ -168,8 +176,7 @@ def monthly_sales_per_user(
             func.sum(SaleORM.total_amount).label("total_spent")
         )
         .join(User, SaleORM.user_id == User.user_id)
-        .filter(extract("year", SaleORM.sale_date) == year)
-        .filter(extract("month", SaleORM.sale_date) == month)
+        .filter(SaleORM.sale_date >= start, SaleORM.sale_date < end)
         .group_by(User.name)
         .all()
     )
@@ -184,18 +191,38 @@ def stock_turnover_per_product(db: Session = Depends(get_db)):
     """
     Returns turnover rate per product: units sold / (stock + units sold)
     """
-    products = db.query(ProductORM).all()
-    results = []
+    # Stock (summed over shops) and units sold per product, grouped in SQL
+    # and joined in one query instead of a SUM query per product
+    stock = (
+        db.query(ProductShopStockORM.product_id, func.sum(ProductShopStockORM.stock).label("stock"))
+        .group_by(ProductShopStockORM.product_id)
+        .subquery()
+    )
+    sold = (
+        db.query(SaleORM.product_id, func.sum(SaleORM.quantity).label("units_sold"))
+        .group_by(SaleORM.product_id)
+        .subquery()
+    )
+    rows = (
+        db.query(
+            ProductORM.name,
+            func.coalesce(stock.c.stock, 0).label("stock"),
+            func.coalesce(sold.c.units_sold, 0).label("units_sold")
+        )
+        .outerjoin(stock, stock.c.product_id == ProductORM.product_id)
+        .outerjoin(sold, sold.c.product_id == ProductORM.product_id)
+        .all()
+    )
 
-    for product in products:
-        total_sold = db.query(func.sum(SaleORM.quantity))\
-                       .filter(SaleORM.product_id == product.product_id)\
-                       .scalar() or 0
-        turnover_rate = total_sold / (product.stock + total_sold) if (product.stock + total_sold) > 0 else 0
+    results = []
+    for r in rows:
+        total_sold = int(r.units_sold)
+        product_stock = int(r.stock)
+        turnover_rate = total_sold / (product_stock + total_sold) if (product_stock + total_sold) > 0 else 0
         results.append({
-            "product": product.name,
-            "units_sold": int(total_sold),
-            "stock": product.stock,
+            "product": r.name,
+            "units_sold": total_sold,
+            "stock": product_stock,
             "turnover_rate": round(turnover_rate, 2)
         })
 
@@ -206,8 +233,10 @@ def average_order_value(db: Session = Depends(get_db)):
     """
     Returns the average order value
     """
-    total_sales = db.query(func.count(SaleORM.sale_id)).scalar() or 0
-    total_revenue = db.query(func.sum(SaleORM.total_amount)).scalar() or 0
+    total_sales, total_revenue = db.query(
+        func.count(SaleORM.sale_id),
+        func.coalesce(func.sum(SaleORM.total_amount), 0)
+    ).one()
 
     aov = round(total_revenue / total_sales, 2) if total_sales > 0 else 0
 
@@ -219,23 +248,28 @@ def top_repeat_customers(limit: int = 5, db: Session = Depends(get_db)):
     """
     Returns top repeat customers by purchase frequency
     """
-    customers = db.query(
+    # Aggregate and rank sales alone, then join names onto just the top rows
+    # (outer join keeps sales whose user is gone)
+    top = db.query(
         SaleORM.user_id,
         func.count(SaleORM.sale_id).label("num_purchases"),
         func.sum(SaleORM.total_amount).label("total_spent")
     ).group_by(SaleORM.user_id)\
      .order_by(func.count(SaleORM.sale_id).desc())\
-     .limit(limit).all()
+     .limit(limit).subquery()
 
-    results = []
-    for c in customers:
-        user = db.query(User).filter(User.user_id == c.user_id).first()
-        results.append({
-            "user": user.name if user else f"User {c.user_id}",
+    customers = db.query(top.c.user_id, User.name, top.c.num_purchases, top.c.total_spent)\
+        .outerjoin(User, User.user_id == top.c.user_id)\
+        .order_by(top.c.num_purchases.desc())\
+        .all()
+
+    return [
+        {
+            "user": c.name or f"User {c.user_id}",
             "num_purchases": c.num_purchases,
             "total_spent": float(c.total_spent)
-        })
-    return results
+        } for c in customers
+    ]
 
 @router.get("/weekly_revenue")
 def weekly_revenue(year: int = datetime.now().year, db: Session = Depends(get_db)):
@@ -246,7 +280,7 @@ def weekly_revenue(year: int = datetime.now().year, db: Session = Depends(get_db
         extract('week', SaleORM.sale_date).label("week"),
         func.sum(SaleORM.quantity).label("total_quantity"),
         func.sum(SaleORM.total_amount).label("total_revenue")
-    ).filter(extract('year', SaleORM.sale_date) == year)\
+    ).filter(SaleORM.sale_date >= datetime(year, 1, 1), SaleORM.sale_date < datetime(year + 1, 1, 1))\
      .group_by("week")\
      .order_by("week").all()
 
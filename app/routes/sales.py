@@ -23,11 +23,11 @@ def create_sale(sale: SaleCreate, db: Session = Depends(get_db)):
     - Calculates total_amount automatically
     - Reduces product stock
     """
-    user = db.query(User).filter(User.user_id == sale.user_id).first()
+    user = db.get(User, sale.user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    product = db.query(ProductORM).filter(ProductORM.product_id == sale.product_id).first()
+    product = db.get(ProductORM, sale.product_id)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
 
@@ -61,7 +61,7 @@ def get_all_sales(db: Session = Depends(get_db)):
 @router.get("/{sale_id}", response_model=Sale)
 def get_sale(sale_id: int, db: Session = Depends(get_db)):
     """Retrieve a specific sale by ID"""
-    sale = db.query(SaleORM).filter(SaleORM.sale_id == sale_id).first()
+    sale = db.get(SaleORM, sale_id)
     if not sale:
         raise HTTPException(status_code=404, detail="Sale not found")
     return sale
@@ -73,11 +73,11 @@ def delete_sale(sale_id: int, db: Session = Depends(get_db)):
     Delete a sale by ID.
     - Restores product stock when sale is deleted
     """
-    sale = db.query(SaleORM).filter(SaleORM.sale_id == sale_id).first()
+    sale = db.get(SaleORM, sale_id)
     if not sale:
         raise HTTPException(status_code=404, detail="Sale not found")
 
-    product = db.query(ProductORM).filter(ProductORM.product_id == sale.product_id).first()
+    product = db.get(ProductORM, sale.product_id)
     if product:
         product.stock += sale.quantity  # restore stock
 
@@ -94,11 +94,11 @@ def update_sale(sale_id: int, updated_sale: SaleCreate, db: Session = Depends(ge
     - Adjusts stock difference
     - Recalculates total_amount
     """
-    sale = db.query(SaleORM).filter(SaleORM.sale_id == sale_id).first()
+    sale = db.get(SaleORM, sale_id)
     if not sale:
         raise HTTPException(status_code=404, detail="Sale not found")
 
-    product = db.query(ProductORM).filter(ProductORM.product_id == updated_sale.product_id).first()
+    product = db.get(ProductORM, updated_sale.product_id)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
 
@@ -1,26 +1,36 @@
 # app/routes/telegram.py
 
 import json 
+import orjson
+import hashlib
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 import secrets    # For secure password generation
 import string     # For password character sets
-from fastapi import APIRouter, Request, Depends
+from fastapi import APIRouter, Request, BackgroundTasks
 import requests, os
-from sqlalchemy.orm import Session
+from requests.adapters import HTTPAdapter
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
 from decimal import Decimal
 from datetime import datetime, timedelta
-from sqlalchemy import func, text, extract
+from sqlalchemy import func, text, extract, update
 from app.models.central_models import Tenant, User  # ✅ ADD User here
 from app.models.models import TenantBase  # ✅ FIXED: Remove "Base as User"
 from app.models.models import ProductORM, CustomerORM, SaleORM, PendingApprovalORM, ShopORM, ProductShopStockORM, PaymentRecordORM  # Tenant DB
-from app.database import get_db  # central DB session - KEEP THIS ONE
 from app.telegram_notifications import notify_low_stock, notify_top_product, notify_high_value_sale, send_message, notify_owner_of_pending_approval
+from app.telegram_notifications import keyboard_json
 from app.telegram_notifications import notify_shopkeeper_of_approval_result
 from config import DATABASE_URL
 from telebot import types
 from app.telegram_notifications import notify_owner_of_new_shopkeeper
-from config import TELEGRAM_BOT_TOKEN, TELEGRAM_API_URL
-from app.tenant_db import get_tenant_session, create_tenant_db, ensure_tenant_tables, ensure_tenant_session, create_initial_shop, create_additional_shop, create_shop_users
+from config import TELEGRAM_BOT_TOKEN, TELEGRAM_API_URL, REDIS_URL
+from config import TELEGRAM_WEBHOOK_URL, TELEGRAM_WEBHOOK_MAX_CONNECTIONS
+from app.tenant_db import get_tenant_session, tenant_session, create_tenant_db, ensure_tenant_tables, ensure_tenant_session, create_initial_shop, create_additional_shop, create_shop_users
 import random
 import bcrypt
 import time
@@ -32,6 +42,7 @@ from telegram.helpers import escape_markdown
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 import re
 import html
+from app.state_store import TTLDict, RedisStateStore, LockRenewer, redis_client
 from app.shop_utils import (
     create_shop_user,
     get_shop_users,
@@ -64,31 +75,218 @@ logging.basicConfig(level=logging.INFO)
 
 router = APIRouter()
 
+# Accepted values for typed answers in the state-driven flows
+PAYMENT_METHODS = frozenset({"cash", "ecocash", "swipe"})
+YES = "yes"
+
+# Report callbacks handled by the shared report branch
+REPORT_CALLBACKS = frozenset({
+    "report_daily", "report_weekly", "report_monthly", "report_low_stock",
+    "report_top_products", "report_aov", "report_stock_turnover",
+    "report_credits", "report_change", "report_payment_summary",
+})
+
+# Cheap shape checks for typed numbers, so malformed input is rejected
+# without going through int()/float() and a ValueError
+_INT_RE = re.compile(r"\d+")
+_DEC_RE = re.compile(r"\d+(?:\.\d*)?|\.\d+")
+
+# Product searches return at most this many buttons; one extra row is
+# fetched to know whether to ask for a more specific name
+PRODUCT_SEARCH_LIMIT = 10
+SEARCH_MORE_HINT = f"\n\n(Showing first {PRODUCT_SEARCH_LIMIT} matches - type more of the name to narrow it down.)"
+
+# Static replies, built once at import (send_message never mutates keyboards)
+BACK_TO_MENU_KB = {"inline_keyboard": [[{"text": "⬅️ Back to Menu", "callback_data": "back_to_menu"}]]}
+BACK_TO_MENU_JSON = keyboard_json(BACK_TO_MENU_KB)
+
+HELP_TEXT = (
+    "❓ *Help & FAQs*\n\n"
+    "📌 *Getting Started*\n"
+    "• Owners: setup shop and add products.\n"
+    "• Shopkeepers: record sales, check stock.\n\n"
+    "🛒 *Managing Products*\n"
+    "• Owners can add/update all product fields.\n"
+    "• Shopkeepers can suggest new products or update quantity/unit only.\n\n"
+    "📦 *Stock Management*\n"
+    "• Check View Stock before recording sales.\n"
+    "• Low stock alerts will appear automatically to owners.\n\n"
+    "📊 *Reports*\n"
+    "• Owners: full reports\n"
+    "• Shopkeepers: limited access\n\n"
+    "⚠️ *Common Issues*\n"
+    "• Bot unresponsive → /start\n"
+    "• Always follow input formats.\n\n"
+    "👨‍💻 Contact support for more help."
+)
+
+# Redis keys are namespaced per bot token so several bots sharing one Redis
+# never see each other's chats (chat_id alone is only unique per user).
+BOT_KEY_PREFIX = f"tg:{hashlib.sha256((TELEGRAM_BOT_TOKEN or '').encode()).hexdigest()[:12]}:"
+
 # Tracks multi-step actions per user
-user_states = {}  # chat_id -> {"action": "awaiting_shop_name" / "awaiting_product" / "awaiting_update" / "awaiting_sale"}
+user_states = RedisStateStore(REDIS_URL, prefix=f"{BOT_KEY_PREFIX}st:") if REDIS_URL else TTLDict()  # chat_id -> {"action": "awaiting_shop_name" / "awaiting_product" / "awaiting_update" / "awaiting_sale"}
 
 # Ensure the token is set
 if not TELEGRAM_BOT_TOKEN:
     raise RuntimeError("TELEGRAM_BOT_TOKEN is not set in environment or .env file")
 
+# Bot API calls whose response we don't need run on a small thread pool.
+# The webhook body is synchronous (DB + telebot), so an asyncio task would
+# not get to run until the handler had finished anyway.
+_bot_api_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="bot-api")
+
+# One keep-alive connection pool to api.telegram.org, shared by those calls
+_http = requests.Session()
+_http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def _post_answer_callback_query(callback_id):
+    try:
+        _http.post(
+            f"{TELEGRAM_API_URL}/answerCallbackQuery",
+            data=orjson.dumps({"callback_query_id": callback_id}),
+            headers=JSON_HEADERS,
+            timeout=10
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ answerCallbackQuery failed: {e}")
+
+
+def answer_callback_query(callback_id):
+    """Acknowledge a button press without blocking the webhook."""
+    _bot_api_executor.submit(_post_answer_callback_query, callback_id)
 
-# -------------------- Helpers --------------------
 
-def escape_markdown_v2(text: str) -> str:
+def register_webhook():
     """
-    Safely escape text for Telegram MarkdownV2.
+    Point Telegram at our webhook (when TELEGRAM_WEBHOOK_URL is set), letting it
+    deliver up to TELEGRAM_WEBHOOK_MAX_CONNECTIONS updates in parallel and only
+    the update types we handle.
     """
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text or '')
+    if not TELEGRAM_WEBHOOK_URL:
+        return
+    try:
+        resp = _http.post(
+            f"{TELEGRAM_API_URL}/setWebhook",
+            json={
+                "url": TELEGRAM_WEBHOOK_URL,
+                "max_connections": TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+                "allowed_updates": ["message", "callback_query"],
+            },
+            timeout=10
+        )
+        logger.info(f"🔗 setWebhook → {resp.status_code}: {resp.text[:200]}")
+    except Exception as e:
+        logger.error(f"❌ setWebhook failed: {e}")
+
+
+# -------------------- Tenant Provisioning --------------------
+# create_tenant_db (schema + tables DDL) takes seconds. New owners get their
+# credentials and the first setup prompt right away; the schema is built
+# meanwhile. users.tenant_schema is only set once the tables exist, so the
+# central DB, not this process, says whether provisioning is done: a failed
+# run, a restart or another worker just leaves it NULL and it is re-submitted.
+PROVISION_PREFIX = f"{BOT_KEY_PREFIX}provision:"
+PROVISION_TTL = 120  # seconds a claim holds off duplicate runs on other workers
+_provision_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="provision")
+_provisioning = {}  # chat_id -> Future, runs in flight in this process
+_provisioning_lock = threading.Lock()
+
+
+def _claim_provisioning(chat_id):
+    """True unless another worker is already provisioning this chat."""
+    if _redis is None:
+        return True
+    try:
+        return bool(_redis.set(f"{PROVISION_PREFIX}{chat_id}", 1, nx=True, ex=PROVISION_TTL))
+    except Exception as e:
+        logger.warning(f"⚠️ Provisioning claim via Redis failed for {chat_id}: {e}")
+        return True
+
+
+def _provision_task(chat_id):
+    try:
+        schema_name, _ = create_tenant_db(chat_id)
+        if schema_name:
+            send_message(chat_id, "✅ Your shop database is ready!")
+        else:
+            logger.error(f"❌ Tenant provisioning failed for {chat_id}; will retry on next setup step")
+            send_message(chat_id, "⚠️ Setting up your shop database failed. I'll try again when you next continue your shop setup.")
+        return schema_name
+    finally:
+        invalidate_user_cache(chat_id)
+        if _redis is not None:
+            try:
+                _redis.delete(f"{PROVISION_PREFIX}{chat_id}")
+            except Exception as e:
+                logger.warning(f"⚠️ Could not clear provisioning claim for {chat_id}: {e}")
+        with _provisioning_lock:
+            _provisioning.pop(chat_id, None)
+
+
+def provision_tenant(chat_id):
+    """Start creating the tenant schema for an owner, unless it is already under way."""
+    with _provisioning_lock:
+        if chat_id in _provisioning or not _claim_provisioning(chat_id):
+            return
+        _provisioning[chat_id] = _provision_executor.submit(_provision_task, chat_id)
+
+
+# -------------------- Sale Notifications --------------------
+# Alerts triggered by a sale (owner/admin messages plus their DB lookups)
+# run after the receipt has gone out, each with its own short-lived tenant
+# session; the sale's session is closed by then. A product that keeps
+# selling below its threshold alerts at most once per cooldown.
+LOW_STOCK_ALERT_COOLDOWN = 60
+_notify_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="notify")
+_low_stock_alerted = TTLDict(ttl=LOW_STOCK_ALERT_COOLDOWN, maxsize=5000)  # (schema, shop_id, product_id) -> sent_at
+
+
+def _notify_low_stock_task(schema_name, product_id, shop_id):
+    try:
+        with tenant_session(schema_name) as tenant_db:
+            if tenant_db is None:
+                return
+            product = tenant_db.get(ProductORM, product_id)
+            if product:
+                notify_low_stock(tenant_db, product, shop_id)
+    except Exception:
+        logger.exception(f"❌ Low stock alert failed for product {product_id} in {schema_name}")
+
+
+def queue_low_stock_alert(schema_name, product_id, shop_id):
+    """Send the low-stock alert off the request path, once per cooldown per product."""
+    key = (schema_name, shop_id, product_id)
+    sent_at = _low_stock_alerted.get(key)
+    now = time.monotonic()
+    if sent_at is not None and now - sent_at < LOW_STOCK_ALERT_COOLDOWN:
+        return
+    _low_stock_alerted[key] = now
+    _notify_executor.submit(_notify_low_stock_task, schema_name, product_id, shop_id)
+
+
+def shutdown_bot_api_executor():
+    _bot_api_executor.shutdown(wait=False)
+    _provision_executor.shutdown(wait=False)
+    _notify_executor.shutdown(wait=False)
+    _http.close()
+
+
+# -------------------- Helpers --------------------
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
 
 def create_username(full_name: str) -> str:
     """Generate a simple username from full name."""
-    base = "".join(full_name.lower().split())  # remove spaces
+    base = _WHITESPACE_RE.sub("", full_name.lower())  # remove spaces
     suffix = str(random.randint(100, 999))
     return f"{base}{suffix}"
 
 def get_user(chat_id: int, db: Session):
-    return db.query(User).filter(User.user_id == chat_id).first()
+    return db.get(User, chat_id)
 
 def send_owner_credentials(chat_id, username, password):
     send_message(
@@ -98,14 +296,109 @@ def send_owner_credentials(chat_id, username, password):
         f"🔑 Password: {password}"
     )
 
-def get_user_by_chat(chat_id: int):
+# Short-lived chat_id -> User snapshot cache. Role / shop / tenant schema
+# almost never change mid-conversation; sites that change them call
+# invalidate_user_cache().
+USER_CACHE_TTL = 60
+USER_CACHE_MAX = 5000
+USER_CACHE_PREFIX = f"{BOT_KEY_PREFIX}u:"
+_user_cache = TTLDict(ttl=USER_CACHE_TTL, maxsize=USER_CACHE_MAX)  # chat_id -> (column dict, expires_at)
+# With Redis the cache is shared, so an invalidation on one worker is seen
+# by all of them; the in-process dict is only used without Redis.
+_redis = redis_client(REDIS_URL) if REDIS_URL else None
+
+
+def invalidate_user_cache(chat_id):
+    _user_cache.pop(chat_id, None)
+    if _redis is not None:
+        try:
+            _redis.delete(f"{USER_CACHE_PREFIX}{chat_id}")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not invalidate cached user {chat_id}: {e}")
+
+
+def invalidate_user_cache_for_username(db, username):
+    """Drop the cached row of the account `username` (role/password/deletion changes)."""
+    target_chat_id = db.query(User.chat_id).filter(User.username == username).scalar()
+    if target_chat_id:
+        invalidate_user_cache(target_chat_id)
+
+
+# Columns kept in the cache. Plain values only, so a cached entry never
+# depends on the mapped class layout of whichever deploy wrote it; other
+# columns load from the DB once the row is merged into a session.
+USER_CACHE_FIELDS = ("user_id", "chat_id", "username", "name", "role", "shop_id", "shop_name", "tenant_schema", "is_active")
+
+
+def _user_from_fields(fields):
+    """Detached User rebuilt from cached column values."""
+    user = User(**fields)
+    make_transient_to_detached(user)
+    return user
+
+
+def _cached_user(chat_id):
+    """Cached column dict for this chat, or None on a miss (unreadable entries count as misses)."""
+    if _redis is None:
+        entry = _user_cache.get(chat_id)
+        return entry[0] if entry and entry[1] >= time.monotonic() else None
+    try:
+        raw = _redis.get(f"{USER_CACHE_PREFIX}{chat_id}")
+        fields = orjson.loads(raw) if raw else None
+    except Exception as e:
+        logger.warning(f"⚠️ User cache read failed for {chat_id}: {e}")
+        return None
+    if not isinstance(fields, dict) or set(fields) != set(USER_CACHE_FIELDS):
+        return None
+    return fields
+
+
+def _store_user(chat_id, fields):
+    if _redis is None:
+        _user_cache[chat_id] = (fields, time.monotonic() + USER_CACHE_TTL)
+        return
+    try:
+        _redis.set(f"{USER_CACHE_PREFIX}{chat_id}", orjson.dumps(fields), ex=USER_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"⚠️ User cache write failed for {chat_id}: {e}")
+
+
+def get_user_by_chat(chat_id: int, db: Session = None):
     """
     Return the central User row matching the Telegram chat_id.
+    Served from a short TTL cache of its main columns; when `db` is given
+    the rebuilt row is attached to it with merge(load=False), so no SELECT
+    is issued, other columns load on access and changes to the returned
+    user are flushed by that session.
     """
     if not chat_id:
         return None
-    db = next(get_db())  # get a central DB session
-    return db.query(User).filter(User.chat_id == chat_id).first()
+
+    fields = _cached_user(chat_id)
+    if fields is None:
+        central_db = SessionLocal()
+        try:
+            row = central_db.query(*(getattr(User, f) for f in USER_CACHE_FIELDS)).filter(
+                User.chat_id == chat_id
+            ).first()
+        finally:
+            central_db.close()
+        if row is None:
+            return None
+        fields = dict(zip(USER_CACHE_FIELDS, row))
+        _store_user(chat_id, fields)
+
+    user = _user_from_fields(fields)
+    if db is None:
+        return user
+    return db.merge(user, load=False)
+
+def get_owner_chat_id(central_db: Session, tenant_schema: str):
+    """Chat id of the owner of a tenant schema (selects just that column)."""
+    return central_db.query(User.chat_id).filter(
+        User.tenant_schema == tenant_schema,
+        User.role == "owner"
+    ).limit(1).scalar()
 
 def create_shopkeeper(tenant_session, username, password):
     from utils.security import hash_password
@@ -119,14 +412,16 @@ def create_shopkeeper(tenant_session, username, password):
     tenant_session.commit()
     return new_user
 
+# Role selection buttons, serialized once at import
+ROLE_SELECT_JSON = keyboard_json({"inline_keyboard": [[
+    {"text": "👑 Owner", "callback_data": "role_owner"},
+    {"text": "🛍 Shopkeeper", "callback_data": "role_keeper"},
+]]})
+
+
 def role_menu(chat_id):
     """Role selection menu (Owner vs Shopkeeper)."""
-    keyboard = types.InlineKeyboardMarkup()
-    keyboard.add(
-        types.InlineKeyboardButton("👑 Owner", callback_data="role_owner"),
-        types.InlineKeyboardButton("🛍 Shopkeeper", callback_data="role_keeper")
-    )
-    send_message(chat_id, "👋 Welcome! Please choose your role:", keyboard)
+    send_message(chat_id, "👋 Welcome! Please choose your role:", ROLE_SELECT_JSON)
 
 def main_menu(role: str):
     """Generate main menu based on user role (Owner/Admin/Shopkeeper)."""
@@ -188,8 +483,20 @@ def main_menu(role: str):
     keyboard.append([{"text": "❓ Help", "callback_data": "help"}])
     
     return {"inline_keyboard": keyboard}
-        
-            
+
+
+# Static per-role menus, serialized once at import
+MAIN_MENU_JSON_BY_ROLE = {r: keyboard_json(main_menu(r)) for r in ("owner", "admin", "shopkeeper")}
+
+# Role menus shown at the end of most flows, also serialized once
+ROLE_MENU_JSON_BY_ROLE = {r: keyboard_json(get_role_based_menu(r)) for r in ("owner", "admin", "shopkeeper")}
+
+
+def role_menu_keyboard(role):
+    """Pre-serialized role-based main menu (built on the fly for unknown roles)."""
+    return ROLE_MENU_JSON_BY_ROLE.get(role) or get_role_based_menu(role)
+
+
 def build_keyboard(kb_dict):
     """Convert our menu dict into a Telebot InlineKeyboardMarkup."""
     keyboard = types.InlineKeyboardMarkup()
@@ -212,45 +519,43 @@ def products_page_view(tenant_db, page: int = 1, per_page: int = 5):
       - Always include "⬅️ Back to Menu" button
     """
     if not tenant_db:
-        return "❌ No tenant DB connected.", {"inline_keyboard": [[{"text": "⬅️ Back to Menu", "callback_data": "back_to_menu"}]]}
-
-    # total count
-    total = tenant_db.query(func.count(ProductORM.product_id)).scalar() or 0
-    total_pages = max(1, -(-total // per_page))  # ceil division
+        return "❌ No tenant DB connected.", BACK_TO_MENU_KB
 
     page = max(1, int(page))
-    if page > total_pages:
-        page = total_pages
-
     offset = (page - 1) * per_page
+    # Fetch one extra row to know whether there is a next page, instead of
+    # counting the whole table on every page view
     products = (
-        tenant_db.query(ProductORM)
+        tenant_db.query(ProductORM.product_id, ProductORM.name, ProductORM.price)
         .order_by(ProductORM.product_id)
         .offset(offset)
-        .limit(per_page)
+        .limit(per_page + 1)
         .all()
     )
+    has_next = len(products) > per_page
+    products = products[:per_page]
 
     if not products:
-        text = "📦 No products found."
-        kb = {"inline_keyboard": [[{"text": "⬅️ Back to Menu", "callback_data": "back_to_menu"}]]}
-        return text, kb
+        if page > 1:
+            # Products were removed since the page link was sent
+            return products_page_view(tenant_db, 1, per_page)
+        return "📦 No products found.", BACK_TO_MENU_KB
+
+    # Total stock across all shops for the whole page in one grouped query
+    stock_totals = dict(
+        tenant_db.query(ProductShopStockORM.product_id, func.sum(ProductShopStockORM.stock))
+        .filter(ProductShopStockORM.product_id.in_([p.product_id for p in products]))
+        .group_by(ProductShopStockORM.product_id)
+        .all()
+    )
 
     # Prepare textual listing with clear IDs
-    lines = [f"📦 *Products — Page {page}/{total_pages}*"]
+    lines = [f"📦 *Products — Page {page}*"]
     
     for p in products:
         # Ensure price cast to float for printing
         price = float(p.price) if p.price is not None else 0.0
-        
-        # Get total stock across all shops
-        total_stock = 0
-        shop_stocks = tenant_db.query(ProductShopStockORM).filter(
-            ProductShopStockORM.product_id == p.product_id
-        ).all()
-        
-        if shop_stocks:
-            total_stock = sum(stock.stock for stock in shop_stocks)
+        total_stock = stock_totals.get(p.product_id) or 0
         
         # FIXED: Use total_stock instead of p.stock
         lines.append(f"ID {p.product_id}: {p.name} — ${price:.2f} — Total Stock: {total_stock}")
@@ -266,7 +571,7 @@ def products_page_view(tenant_db, page: int = 1, per_page: int = 5):
     nav_row = []
     if page > 1:
         nav_row.append({"text": "⬅️ Back", "callback_data": f"products_page:{page-1}"})
-    if page < total_pages:
+    if has_next:
         nav_row.append({"text": "Next ➡️", "callback_data": f"products_page:{page+1}"})
     if nav_row:
         kb_rows.append(nav_row)
@@ -290,13 +595,16 @@ def help_text():
 
 
 # -------------------- Helpers --------------------
+# Either separator, with the whitespace around it
+_INPUT_SEP_RE = re.compile(r"\s*[;,]\s*")
+
+
 def parse_input(text: str, expected_parts: int):
     """
     Normalize input and split into expected parts.
     Accepts both ';' and ',' as separators.
     """
-    normalized = text.replace(",", ";")
-    parts = [p.strip() for p in normalized.split(";") if p.strip()]
+    parts = [p for p in _INPUT_SEP_RE.split(text.strip()) if p]
     
     if len(parts) != expected_parts:
         raise ValueError(f"Expected {expected_parts} parts, got {len(parts)}")
@@ -321,7 +629,7 @@ def create_user(chat_id: int, username: str, password: str, full_name: str, emai
         return user
     except SQLAlchemyError as e:
         db.rollback()
-        print("❌ Failed to create user:", e)
+        logger.error(f"❌ Failed to create user: {e}")
         return None
     finally:
         db.close()
@@ -373,7 +681,6 @@ def register_new_user(central_db: Session, chat_id: int, text: str, role="keeper
         try:
             central_db.add(new_user)
             central_db.commit()
-            central_db.refresh(new_user)
             
             # Create tenant schema and tables
             schema_name, _ = create_tenant_db(chat_id)
@@ -412,7 +719,6 @@ def register_new_user(central_db: Session, chat_id: int, text: str, role="keeper
         try:
             central_db.add(new_user)
             central_db.commit()
-            central_db.refresh(new_user)
             
             send_message(chat_id, f"✅ Shopkeeper '{name}' registered successfully.")
             send_message(new_chat_id, f"👋 Hello {name}! You've been added as a shopkeeper. Use /start to begin.")
@@ -434,63 +740,71 @@ def get_stock_list(tenant_db, shop_id=None):
         
         if shop_id:
             # Get shop-specific stock
-            shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+            shop = tenant_db.get(ShopORM, shop_id)
             if not shop:
                 return "❌ Shop not found."
             
             lines.append(f"🏪 *{shop.name} - Stock Report*\n")
             
-            # Get products with stock for this shop
-            stock_items = tenant_db.query(ProductShopStockORM).filter(
+            # Products with stock for this shop: only the displayed columns,
+            # in one joined query instead of a product lookup per row
+            stock_items = tenant_db.query(
+                ProductORM.name, ProductORM.unit_type, ProductORM.price,
+                ProductShopStockORM.stock, ProductShopStockORM.low_stock_threshold
+            ).join(
+                ProductORM, ProductORM.product_id == ProductShopStockORM.product_id
+            ).filter(
                 ProductShopStockORM.shop_id == shop_id
             ).all()
             
             if not stock_items:
                 lines.append("📦 No stock assigned to this shop yet.")
             else:
-                for item in stock_items:
-                    product = tenant_db.query(ProductORM).filter(
-                        ProductORM.product_id == item.product_id
-                    ).first()
-                    
-                    if product:
-                        status = "🟢" if item.stock > item.low_stock_threshold else "🔴" if item.stock == 0 else "🟡"
-                        lines.append(f"{status} *{product.name}*")
-                        lines.append(f"  📊 Stock: {item.stock} {product.unit_type}")
-                        lines.append(f"  💰 Price: ${product.price:.2f}")
-                        lines.append(f"  ⚠️ Low Stock Alert: {item.low_stock_threshold}")
-                        if item.stock <= item.low_stock_threshold:
-                            lines.append(f"  ⚠️ *LOW STOCK!*")
-                        lines.append("")
+                for name, unit_type, price, stock, threshold in stock_items:
+                    status = "🟢" if stock > threshold else "🔴" if stock == 0 else "🟡"
+                    lines.append(f"{status} *{name}*")
+                    lines.append(f"  📊 Stock: {stock} {unit_type}")
+                    lines.append(f"  💰 Price: ${price:.2f}")
+                    lines.append(f"  ⚠️ Low Stock Alert: {threshold}")
+                    if stock <= threshold:
+                        lines.append(f"  ⚠️ *LOW STOCK!*")
+                    lines.append("")
         else:
             # Get all products (for backward compatibility)
             lines.append("📦 *All Products*\n")
             
-            products = tenant_db.query(ProductORM).all()
+            products = tenant_db.query(
+                ProductORM.product_id, ProductORM.name, ProductORM.unit_type, ProductORM.price
+            ).all()
             if not products:
                 lines.append("No products found.")
             else:
-                for product in products:
-                    # Try to get stock from ProductShopStockORM
-                    stock_items = tenant_db.query(ProductShopStockORM).filter(
-                        ProductShopStockORM.product_id == product.product_id
-                    ).all()
+                # Shop stock rows and shop names loaded once, grouped per product
+                shop_names = dict(tenant_db.query(ShopORM.shop_id, ShopORM.name).all())
+                stock_by_product = defaultdict(list)
+                for product_id, item_shop_id, stock, threshold in tenant_db.query(
+                    ProductShopStockORM.product_id, ProductShopStockORM.shop_id,
+                    ProductShopStockORM.stock, ProductShopStockORM.low_stock_threshold
+                ):
+                    stock_by_product[product_id].append((item_shop_id, stock, threshold))
+                
+                for product_id, name, unit_type, price in products:
+                    stock_items = stock_by_product.get(product_id)
                     
                     if stock_items:
                         # Product has shop-specific stock
-                        for item in stock_items:
-                            shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == item.shop_id).first()
-                            shop_name = shop.name if shop else f"Shop {item.shop_id}"
-                            status = "🟢" if item.stock > item.low_stock_threshold else "🔴" if item.stock == 0 else "🟡"
-                            lines.append(f"{status} *{product.name}* ({shop_name})")
-                            lines.append(f"  📊 Stock: {item.stock} {product.unit_type}")
-                            lines.append(f"  💰 Price: ${product.price:.2f}")
+                        for item_shop_id, stock, threshold in stock_items:
+                            shop_name = shop_names.get(item_shop_id) or f"Shop {item_shop_id}"
+                            status = "🟢" if stock > threshold else "🔴" if stock == 0 else "🟡"
+                            lines.append(f"{status} *{name}* ({shop_name})")
+                            lines.append(f"  📊 Stock: {stock} {unit_type}")
+                            lines.append(f"  💰 Price: ${price:.2f}")
                             lines.append("")
                     else:
                         # Product has no shop-specific stock yet
-                        lines.append(f"⚪ *{product.name}*")
-                        lines.append(f"  📊 Stock: 0 {product.unit_type}")
-                        lines.append(f"  💰 Price: ${product.price:.2f}")
+                        lines.append(f"⚪ *{name}*")
+                        lines.append(f"  📊 Stock: 0 {unit_type}")
+                        lines.append(f"  💰 Price: ${price:.2f}")
                         lines.append(f"  ℹ️ No shop stock assigned")
                         lines.append("")
         
@@ -549,8 +863,7 @@ def add_product(db: Session, chat_id: int, data: dict):
 
     try:
         db.add(new_product)
-        db.commit()
-        db.refresh(new_product)
+        db.flush()  # assigns product_id; product + stock row commit together below
         
         # ✅ Create shop-specific stock record with ALL stock-related fields
         if shop_id:
@@ -563,11 +876,11 @@ def add_product(db: Session, chat_id: int, data: dict):
                 reorder_quantity=0
             )
             db.add(shop_stock)
-            db.commit()
         else:
             # If no shop_id (global product), handle differently
             # For now, just create a basic product without stock info
             pass
+        db.commit()
         
     except Exception as e:
         db.rollback()
@@ -591,6 +904,7 @@ def add_product(db: Session, chat_id: int, data: dict):
 
 def add_product_pending_approval(tenant_db, chat_id, data):
     """Save product addition request for owner approval"""
+    central_db = None
     try:
         # Get shopkeeper info
         central_db = SessionLocal()
@@ -598,7 +912,6 @@ def add_product_pending_approval(tenant_db, chat_id, data):
         
         if not shopkeeper:
             logger.error(f"❌ Shopkeeper not found for chat_id: {chat_id}")
-            central_db.close()
             return False
 
         # Create pending approval record
@@ -611,24 +924,21 @@ def add_product_pending_approval(tenant_db, chat_id, data):
         )
         
         tenant_db.add(pending_approval)
+        tenant_db.flush()  # Get the approval_id from the INSERT itself
+        approval_id = pending_approval.approval_id
         tenant_db.commit()
-        tenant_db.refresh(pending_approval)  # Get the approval_id
         
         # Find owner for this tenant
-        owner = central_db.query(User).filter(
-            User.tenant_schema == shopkeeper.tenant_schema,
-            User.role == 'owner'
-        ).first()
-        central_db.close()
+        owner_chat_id = get_owner_chat_id(central_db, shopkeeper.tenant_schema)
         
-        if owner:
+        if owner_chat_id:
             # Use centralized notification system
             notify_owner_of_pending_approval(
-                owner.chat_id, 
+                owner_chat_id, 
                 'add_product', 
                 data.get('name', 'Unknown Product'), 
                 shopkeeper.name, 
-                pending_approval.approval_id
+                approval_id
             )
         
         logger.info(f"✅ Product addition pending approval: {data.get('name', 'Unknown')}")
@@ -638,21 +948,25 @@ def add_product_pending_approval(tenant_db, chat_id, data):
         logger.error(f"❌ Failed to save pending approval: {e}")
         tenant_db.rollback()
         return False
+    finally:
+        if central_db is not None:
+            central_db.close()
+
 
 def handle_approval_action(owner_chat_id, approval_id, action):
     """Handle approval or rejection of pending actions"""
+    central_db = None
+    tenant_db = None
     try:
         central_db = SessionLocal()
         owner = central_db.query(User).filter(User.chat_id == owner_chat_id).first()
         
         if not owner or owner.role != 'owner':
             logger.error(f"❌ Only owners can approve actions: {owner_chat_id}")
-            central_db.close()
             return False
         
         tenant_db = get_tenant_session(owner.tenant_schema, owner_chat_id)
         if not tenant_db:
-            central_db.close()
             return False
         
         # Get pending approval
@@ -663,8 +977,6 @@ def handle_approval_action(owner_chat_id, approval_id, action):
         
         if not pending:
             logger.error(f"❌ Pending approval not found: {approval_id}")
-            tenant_db.close()
-            central_db.close()
             return False
         
         product_data = json.loads(pending.product_data)
@@ -681,7 +993,7 @@ def handle_approval_action(owner_chat_id, approval_id, action):
             pending.resolved_at = func.now()
             
             # Notify shopkeeper using centralized system
-            shopkeeper = central_db.query(User).filter(User.user_id == pending.shopkeeper_id).first()
+            shopkeeper = central_db.get(User, pending.shopkeeper_id)
             if shopkeeper and shopkeeper.chat_id:
                 notify_shopkeeper_of_approval_result(
                     shopkeeper.chat_id, 
@@ -695,7 +1007,7 @@ def handle_approval_action(owner_chat_id, approval_id, action):
             pending.resolved_at = func.now()
             
             # Notify shopkeeper using centralized system
-            shopkeeper = central_db.query(User).filter(User.user_id == pending.shopkeeper_id).first()
+            shopkeeper = central_db.get(User, pending.shopkeeper_id)
             if shopkeeper and shopkeeper.chat_id:
                 notify_shopkeeper_of_approval_result(
                     shopkeeper.chat_id, 
@@ -705,8 +1017,6 @@ def handle_approval_action(owner_chat_id, approval_id, action):
                 )
         
         tenant_db.commit()
-        tenant_db.close()
-        central_db.close()
         
         logger.info(f"✅ Approval {action}: {approval_id}")
         return True
@@ -714,21 +1024,27 @@ def handle_approval_action(owner_chat_id, approval_id, action):
     except Exception as e:
         logger.error(f"❌ Failed to handle approval action: {e}")
         return False
+    finally:
+        if central_db is not None:
+            central_db.close()
+        if tenant_db is not None:
+            tenant_db.close()
+
         
 def handle_stock_approval_action(owner_chat_id, approval_id, action):
     """Handle approval or rejection of stock update requests"""
+    central_db = None
+    tenant_db = None
     try:
         central_db = SessionLocal()
         owner = central_db.query(User).filter(User.chat_id == owner_chat_id).first()
         
         if not owner or owner.role != 'owner':
             logger.error(f"❌ Only owners can approve stock updates: {owner_chat_id}")
-            central_db.close()
             return False
         
         tenant_db = get_tenant_session(owner.tenant_schema, owner_chat_id)
         if not tenant_db:
-            central_db.close()
             return False
         
         # Get pending stock approval
@@ -740,8 +1056,6 @@ def handle_stock_approval_action(owner_chat_id, approval_id, action):
         
         if not pending:
             logger.error(f"❌ Pending stock approval not found: {approval_id}")
-            tenant_db.close()
-            central_db.close()
             return False
         
         stock_data = json.loads(pending.product_data)
@@ -753,9 +1067,7 @@ def handle_stock_approval_action(owner_chat_id, approval_id, action):
         
         if action == "approved":
             # Update the product stock
-            product = tenant_db.query(ProductORM).filter(
-                ProductORM.product_id == product_id
-            ).first()
+            product = tenant_db.get(ProductORM, product_id)
             
             if product:
                 product.stock = new_stock
@@ -766,9 +1078,7 @@ def handle_stock_approval_action(owner_chat_id, approval_id, action):
             pending.resolved_at = func.now()
             
             # Notify shopkeeper
-            shopkeeper = central_db.query(User).filter(
-                User.user_id == pending.shopkeeper_id
-            ).first()
+            shopkeeper = central_db.get(User, pending.shopkeeper_id)
             
             if shopkeeper and shopkeeper.chat_id:
                 # Use the existing notification function
@@ -784,9 +1094,7 @@ def handle_stock_approval_action(owner_chat_id, approval_id, action):
             pending.resolved_at = func.now()
             
             # Notify shopkeeper
-            shopkeeper = central_db.query(User).filter(
-                User.user_id == pending.shopkeeper_id
-            ).first()
+            shopkeeper = central_db.get(User, pending.shopkeeper_id)
             
             if shopkeeper and shopkeeper.chat_id:
                 notify_shopkeeper_of_approval_result(
@@ -797,8 +1105,6 @@ def handle_stock_approval_action(owner_chat_id, approval_id, action):
                 )
         
         tenant_db.commit()
-        tenant_db.close()
-        central_db.close()
         
         logger.info(f"✅ Stock update {action}: {approval_id}")
         return True
@@ -806,33 +1112,35 @@ def handle_stock_approval_action(owner_chat_id, approval_id, action):
     except Exception as e:
         logger.error(f"❌ Failed to handle stock approval action: {e}")
         return False
+    finally:
+        if central_db is not None:
+            central_db.close()
+        if tenant_db is not None:
+            tenant_db.close()
+
         
 def show_approval_details(chat_id, approval_id):
     """Show details of a specific approval request"""
+    central_db = None
+    tenant_db = None
     try:
         central_db = SessionLocal()
         user = central_db.query(User).filter(User.chat_id == chat_id).first()
         
         if not user:
             send_message(chat_id, "❌ User not found.")
-            central_db.close()
             return False
         
         tenant_db = get_tenant_session(user.tenant_schema, chat_id)
         if not tenant_db:
             send_message(chat_id, "❌ Unable to access store database.")
-            central_db.close()
             return False
         
         # Get pending approval
-        pending = tenant_db.query(PendingApprovalORM).filter(
-            PendingApprovalORM.approval_id == approval_id
-        ).first()
+        pending = tenant_db.get(PendingApprovalORM, approval_id)
         
         if not pending:
             send_message(chat_id, "❌ Approval request not found.")
-            tenant_db.close()
-            central_db.close()
             return False
         
         # Parse product data
@@ -874,28 +1182,30 @@ def show_approval_details(chat_id, approval_id):
                 approve_cb = f"approve_action:{approval_id}"
                 reject_cb = f"reject_action:{approval_id}"
                 
-            kb_rows = [
+            kb = {"inline_keyboard": [
                 [
                     {"text": "✅ Approve", "callback_data": approve_cb},
                     {"text": "❌ Reject", "callback_data": reject_cb}
                 ],
                 [{"text": "⬅️ Back to Menu", "callback_data": "back_to_menu"}]
-            ]
+            ]}
         else:
-            kb_rows = [
-                [{"text": "⬅️ Back to Menu", "callback_data": "back_to_menu"}]
-            ]
+            kb = BACK_TO_MENU_JSON
         
-        send_message(chat_id, message, {"inline_keyboard": kb_rows})
+        send_message(chat_id, message, kb)
         
-        tenant_db.close()
-        central_db.close()
         return True
         
     except Exception as e:
         logger.error(f"❌ Failed to show approval details: {e}")
         send_message(chat_id, "❌ Error loading approval details.")
         return False
+    finally:
+        if central_db is not None:
+            central_db.close()
+        if tenant_db is not None:
+            tenant_db.close()
+
         
         
 def update_product(db: Session, chat_id: int, product: ProductORM, data: dict):
@@ -908,15 +1218,19 @@ def update_product(db: Session, chat_id: int, product: ProductORM, data: dict):
     ProductShopStockORM (shop-specific). This function only updates ProductORM fields.
     """
     try:
+        # Collect the changed columns and write them in one UPDATE ... RETURNING
+        # instead of mutating the ORM object and reloading it after commit.
+        changes = {}
+
         # -------------------- Name --------------------
         if "new_name" in data and data["new_name"] != "-":
-            product.name = data["new_name"].strip()
+            changes["name"] = data["new_name"].strip()
 
         # -------------------- Price --------------------
         if "new_price" in data and data["new_price"] != "-":
             try:
-                product.price = float(data["new_price"])
-                if product.price <= 0:
+                changes["price"] = float(data["new_price"])
+                if changes["price"] <= 0:
                     raise ValueError("Price must be greater than 0.")
             except ValueError:
                 send_message(chat_id, "❌ Invalid price. Please enter a number.")
@@ -924,7 +1238,7 @@ def update_product(db: Session, chat_id: int, product: ProductORM, data: dict):
 
         # -------------------- Unit Type --------------------
         if "new_unit" in data and data["new_unit"] != "-":
-            product.unit_type = data["new_unit"].strip()
+            changes["unit_type"] = data["new_unit"].strip()
 
         # -------------------- REMOVED: Quantity, Min Stock, Low Threshold --------------------
         # These are now handled in ProductShopStockORM (shop-specific stock)
@@ -932,8 +1246,17 @@ def update_product(db: Session, chat_id: int, product: ProductORM, data: dict):
         # as these attributes don't exist on ProductORM anymore
         
         # -------------------- Commit --------------------
-        db.commit()
-        db.refresh(product)
+        if changes:
+            name, price, unit_type = db.execute(
+                update(ProductORM)
+                .where(ProductORM.product_id == product.product_id)
+                .values(**changes)
+                .returning(ProductORM.name, ProductORM.price, ProductORM.unit_type)
+                .execution_options(synchronize_session=False)
+            ).one()
+            db.commit()
+        else:
+            name, price, unit_type = product.name, product.price, product.unit_type
         
         # Get total stock across all shops (for informational display)
         total_stock = 0
@@ -949,15 +1272,15 @@ def update_product(db: Session, chat_id: int, product: ProductORM, data: dict):
         for stock in shop_stocks:
             if stock.low_stock_threshold:
                 # Get shop name
-                shop = db.query(ShopORM).filter(ShopORM.shop_id == stock.shop_id).first()
+                shop = db.get(ShopORM, stock.shop_id)
                 shop_name = shop.name if shop else f"Shop {stock.shop_id}"
                 low_thresholds.append(f"{shop_name}: {stock.low_stock_threshold}")
 
         # Build success message
         success_msg = f"✅ Product updated successfully:\n"
-        success_msg += f"📦 {product.name}\n"
-        success_msg += f"💲 Price: ${product.price:.2f}\n"
-        success_msg += f"📦 Unit: {product.unit_type}\n"
+        success_msg += f"📦 {name}\n"
+        success_msg += f"💲 Price: ${price:.2f}\n"
+        success_msg += f"📦 Unit: {unit_type}\n"
         success_msg += f"📊 Total Stock (all shops): {total_stock}\n"
         
         if low_thresholds:
@@ -970,7 +1293,7 @@ def update_product(db: Session, chat_id: int, product: ProductORM, data: dict):
             success_msg += "\n🏪 Updated shop stocks:\n"
             for stock_info in data["shop_stocks"]:
                 if "new_stock" in stock_info:
-                    shop = db.query(ShopORM).filter(ShopORM.shop_id == stock_info["shop_id"]).first()
+                    shop = db.get(ShopORM, stock_info["shop_id"])
                     shop_name = shop.name if shop else f"Shop {stock_info['shop_id']}"
                     success_msg += f"  • {shop_name}: {stock_info.get('current_stock', '?')} → {stock_info['new_stock']}\n"
 
@@ -985,14 +1308,14 @@ def get_cart_summary(cart):
     if not cart:
         return "🛒 Cart is empty"
     
-    summary = "🛒 *Current Cart:*\n"
-    total = 0
-    for i, item in enumerate(cart, 1):
-        summary += f"{i}. {item['name']} - {item['quantity']} {item['unit_type']} × ${item['price']:.2f} = ${item['subtotal']:.2f}\n"
-        total += item['subtotal']
-    
-    summary += f"\n💰 *Total: ${total:.2f}*\n"
-    return summary
+    total = sum(item["subtotal"] for item in cart)
+    parts = ["🛒 *Current Cart:*"]
+    parts.extend(
+        f"{i}. {item['name']} - {item['quantity']} {item['unit_type']} × ${item['price']:.2f} = ${item['subtotal']:.2f}"
+        for i, item in enumerate(cart, 1)
+    )
+    parts.append(f"\n💰 *Total: ${total:.2f}*\n")
+    return "\n".join(parts)
 
 def ensure_payment_method_column(tenant_db, schema_name):
     """Safely add payment_method column if it doesn't exist"""
@@ -1026,8 +1349,22 @@ def ensure_payment_method_column(tenant_db, schema_name):
         tenant_db.rollback()
         return False
         
-def record_cart_sale(tenant_db, chat_id, data):
-    """Record a sale from cart data with payment_method tracking and stock updates - UPDATED FOR MULTI-SHOP"""
+# One row per cart item, including the shop that made the sale
+INSERT_SALE_SQL = text("""
+    INSERT INTO sales 
+    (user_id, product_id, shop_id, customer_id, unit_type, quantity, total_amount, 
+     surcharge_amount, sale_date, payment_type, payment_method, amount_paid, 
+     pending_amount, change_left)
+    VALUES 
+    (:user_id, :product_id, :shop_id, :customer_id, :unit_type, :quantity, :total_amount,
+     :surcharge_amount, :sale_date, :payment_type, :payment_method, :amount_paid, 
+     :pending_amount, :change_left)
+""")
+
+
+def record_cart_sale(tenant_db, chat_id, data, keyboard=None):
+    """Record a sale from cart data with payment_method tracking and stock updates - UPDATED FOR MULTI-SHOP
+    `keyboard` is attached to the receipt message."""
     from datetime import datetime, timedelta  # <-- ADD THIS HERE
     
     try:
@@ -1036,15 +1373,16 @@ def record_cart_sale(tenant_db, chat_id, data):
         customer_id = data.get("customer_id")
         cart_total = sum(item["subtotal"] for item in data.get("cart", []))
         
+        # Cached central user (no session left open); used for both the
+        # duplicate check and the shop assignment below
+        current_user = get_user_by_chat(chat_id)
+        
         # Only check for duplicates if we have a customer_id
         if customer_id:
-            from datetime import datetime, timedelta
             five_minutes_ago = datetime.utcnow() - timedelta(minutes=5)
             
             # We need to get the shop_id first to check duplicates
-            from app.core import SessionLocal
-            central_db_temp = SessionLocal()
-            current_user_temp = central_db_temp.query(User).filter(User.chat_id == chat_id).first()
+            current_user_temp = current_user
             
             if current_user_temp:
                 # Determine tentative shop_id for duplicate check
@@ -1067,10 +1405,8 @@ def record_cart_sale(tenant_db, chat_id, data):
                         for sale in recent_sales:
                             if abs(sale.total_amount - cart_total) < 0.01:  # Within 1 cent
                                 logger.warning(f"⚠️ Duplicate sale detected and prevented: Sale ID {sale.sale_id}, Amount: ${sale.total_amount}")
-                                central_db_temp.close()
                                 send_message(chat_id, "⚠️ A similar sale was recently recorded. Please wait a few minutes or verify this is a new sale.")
                                 return False
-            central_db_temp.close()
         
         # ✅ Calculate surcharge for Ecocash
         payment_method = data.get("payment_method", "cash")
@@ -1084,12 +1420,7 @@ def record_cart_sale(tenant_db, chat_id, data):
             data["final_total"] = cart_total + surcharge
             data["original_total"] = cart_total  # Store original total for receipt
         
-        # ✅ UPDATED: Get current user to check shop assignment
-        from app.core import SessionLocal
-        central_db = SessionLocal()
-        current_user = central_db.query(User).filter(User.chat_id == chat_id).first()
-        central_db.close()
-        
+        # ✅ UPDATED: Current user (loaded above) decides the shop assignment
         if not current_user:
             logger.error(f"❌ User not found for chat_id: {chat_id}")
             send_message(chat_id, "❌ User not found. Please login again.")
@@ -1125,7 +1456,7 @@ def record_cart_sale(tenant_db, chat_id, data):
                     return False
             else:
                 # Get shop name for selected shop
-                shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                shop = tenant_db.get(ShopORM, shop_id)
                 shop_name = shop.name if shop else "Selected Shop"
         
         else:
@@ -1159,57 +1490,54 @@ def record_cart_sale(tenant_db, chat_id, data):
                 tenant_db.flush()  # Get the customer_id
                 customer_id = new_customer.customer_id
         
-        # ✅ Check stock availability for each item in the selected shop
-        for item in data["cart"]:
+        # ✅ Check stock availability for each item in the selected shop.
+        # Rows are locked (FOR UPDATE) until the commit below so concurrent
+        # sales of the same product can't both pass the check and then
+        # overwrite each other's decrement; locking in product_id order
+        # keeps two carts from deadlocking.
+        stock_rows = {}  # product_id -> stock row, reused for the decrement below
+        for item in sorted(data["cart"], key=lambda i: i["product_id"]):
             # Check shop-specific stock
             shop_stock = tenant_db.query(ProductShopStockORM).filter(
                 ProductShopStockORM.product_id == item["product_id"],
                 ProductShopStockORM.shop_id == shop_id
-            ).first()
+            ).with_for_update().first()
+
+            # Name was cached on the cart item at selection time
+            product_name = item.get("name") or f"ID:{item['product_id']}"
 
             if not shop_stock:
-                # Get product name for error message
-                product = tenant_db.query(ProductORM).filter(
-                    ProductORM.product_id == item["product_id"]
-                ).first()
-                product_name = product.name if product else f"ID:{item['product_id']}"
-                
                 logger.error(f"❌ Product {product_name} not available in selected shop")
                 send_message(chat_id, f"❌ {product_name} not available in shop '{shop_name}'.")
+                tenant_db.rollback()
                 return False
 
             if shop_stock.stock < item["quantity"]:
-                # Get product name for error message
-                product = tenant_db.query(ProductORM).filter(
-                    ProductORM.product_id == item["product_id"]
-                ).first()
-                product_name = product.name if product else f"ID:{item['product_id']}"
-                
                 logger.error(f"❌ Insufficient stock for {product_name} in selected shop")
                 send_message(chat_id, f"❌ Insufficient stock for {product_name} in shop '{shop_name}'. Available: {shop_stock.stock}")
+                tenant_db.rollback()
                 return False
+
+            stock_rows[item["product_id"]] = shop_stock
         
         # ✅ THEN: Record each item as separate sale WITH SHOP ID
-        cart_total = sum(item["subtotal"] for item in data["cart"])
-        
-        for item in data["cart"]:
+        cart = data["cart"]
+        cart_total = sum(item["subtotal"] for item in cart)
+
+        # Sale-level fields are the same for every row; read them once
+        sale_date = datetime.utcnow()
+        payment_type = data.get("payment_type", "full")
+        amount_paid = data.get("amount_paid", 0)
+        pending_amount = data.get("pending_amount", 0)
+        change_left = data.get("change_left", 0)
+        
+        sale_rows = []
+        for item in cart:
             # Calculate item's share of surcharge (proportional)
             item_share = (item["subtotal"] / cart_total * surcharge) if cart_total > 0 else 0
             item_total = item["subtotal"] + item_share
             
-            # ✅ UPDATED: Include shop_id in sale record
-            stmt = text("""
-                INSERT INTO sales 
-                (user_id, product_id, shop_id, customer_id, unit_type, quantity, total_amount, 
-                 surcharge_amount, sale_date, payment_type, payment_method, amount_paid, 
-                 pending_amount, change_left)
-                VALUES 
-                (:user_id, :product_id, :shop_id, :customer_id, :unit_type, :quantity, :total_amount,
-                 :surcharge_amount, :sale_date, :payment_type, :payment_method, :amount_paid, 
-                 :pending_amount, :change_left)
-            """)
-            
-            params = {
+            sale_rows.append({
                 "user_id": chat_id,
                 "product_id": item["product_id"],
                 "shop_id": shop_id,  # ✅ ADDED: Store which shop made the sale
@@ -1218,21 +1546,16 @@ def record_cart_sale(tenant_db, chat_id, data):
                 "quantity": item["quantity"],
                 "total_amount": item_total,  # Includes surcharge share
                 "surcharge_amount": item_share,  # Item's share of surcharge
-                "sale_date": datetime.utcnow(),
-                "payment_type": data.get("payment_type", "full"),
+                "sale_date": sale_date,
+                "payment_type": payment_type,
                 "payment_method": payment_method,
-                "amount_paid": data.get("amount_paid", 0),
-                "pending_amount": data.get("pending_amount", 0),
-                "change_left": data.get("change_left", 0)
-            }
-            
-            tenant_db.execute(stmt, params)
+                "amount_paid": amount_paid,
+                "pending_amount": pending_amount,
+                "change_left": change_left
+            })
             
-            # ✅ Update shop-specific stock
-            shop_stock = tenant_db.query(ProductShopStockORM).filter(
-                ProductShopStockORM.product_id == item["product_id"],
-                ProductShopStockORM.shop_id == shop_id
-            ).first()
+            # ✅ Update shop-specific stock (row loaded by the check above)
+            shop_stock = stock_rows.get(item["product_id"])
             
             if shop_stock:
                 shop_stock.stock -= item["quantity"]
@@ -1240,67 +1563,84 @@ def record_cart_sale(tenant_db, chat_id, data):
             
             logger.info(f"✅ Sale recorded: {item['name']} x {item['quantity']}, Shop: {shop_id}, Surcharge: ${item_share:.2f}")        
         
+        # One executemany for the whole cart instead of an INSERT per item
+        if sale_rows:
+            tenant_db.execute(INSERT_SALE_SQL, sale_rows)
+        
         tenant_db.commit()
+        invalidate_report_cache(current_user.tenant_schema)
         logger.info(f"✅ All sales recorded and stock updated for chat_id: {chat_id}, shop_id: {shop_id}")
         
         # ✅ Show final receipt with shop information
-        receipt = f"✅ *Sale Completed Successfully!*\n\n"
-        receipt += f"🏪 Shop: {shop_name}\n"
-        receipt += f"📅 Date: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}\n"
-        receipt += f"---\n"
-        
-        # Add cart items to receipt
-        receipt += get_cart_summary(data["cart"])
-        
-        if data.get("payment_method") == "ecocash" and data.get("surcharge", 0) > 0:
-            receipt += f"\n💳 *Payment Method: Ecocash*\n"
-            receipt += f"💰 Subtotal: ${data.get('original_total', 0):.2f}\n"
-            receipt += f"⚡ Surcharge (10%): ${data.get('surcharge', 0):.2f}\n"
-            receipt += f"💵 *Amount Paid: ${data.get('amount_paid', 0):.2f}*\n"
+        receipt_parts = [
+            "✅ *Sale Completed Successfully!*\n",
+            f"🏪 Shop: {shop_name}",
+            f"📅 Date: {sale_date.strftime('%Y-%m-%d %H:%M:%S')}",
+            "---",
+            # Add cart items to receipt
+            get_cart_summary(cart),
+        ]
+        
+        if payment_method == "ecocash" and surcharge > 0:
+            receipt_parts.append("💳 *Payment Method: Ecocash*")
+            receipt_parts.append(f"💰 Subtotal: ${data.get('original_total', 0):.2f}")
+            receipt_parts.append(f"⚡ Surcharge (10%): ${surcharge:.2f}")
+            receipt_parts.append(f"💵 *Amount Paid: ${amount_paid:.2f}*")
         else:
-            receipt += f"\n💳 Payment Method: {data.get('payment_method', 'cash').title()}\n"
-            receipt += f"💰 Sale Type: {data.get('sale_type', 'cash').title()}\n"
-            receipt += f"💵 Amount Paid: ${data.get('amount_paid', 0):.2f}\n"
-        
-        if data.get("change_left", 0) > 0:
-            receipt += f"🪙 Change: ${data['change_left']:.2f}\n"
-        if data.get("pending_amount", 0) > 0:
-            receipt += f"📋 Pending: ${data['pending_amount']:.2f}\n"
+            receipt_parts.append(f"💳 Payment Method: {payment_method.title()}")
+            receipt_parts.append(f"💰 Sale Type: {data.get('sale_type', 'cash').title()}")
+            receipt_parts.append(f"💵 Amount Paid: ${amount_paid:.2f}")
+        
+        if change_left > 0:
+            receipt_parts.append(f"🪙 Change: ${change_left:.2f}")
+        if pending_amount > 0:
+            receipt_parts.append(f"📋 Pending: ${pending_amount:.2f}")
         if data.get("customer_name"):
-            receipt += f"👤 Customer: {data['customer_name']}\n"
+            receipt_parts.append(f"👤 Customer: {data['customer_name']}")
             if data.get("customer_contact"):
-                receipt += f"📞 Contact: {data['customer_contact']}\n"
+                receipt_parts.append(f"📞 Contact: {data['customer_contact']}")
+        receipt = "\n".join(receipt_parts)
             
-        send_message(chat_id, receipt)
+        send_message(chat_id, receipt, keyboard)
         
-        # ✅ Check for low stock alerts for this specific shop
+        # ✅ Queue low stock alerts for this specific shop
         for item in data["cart"]:
-            product = tenant_db.query(ProductORM).filter(
-                ProductORM.product_id == item["product_id"]
-            ).first()
+            # Shop-specific stock row, already in the session
+            shop_stock = stock_rows.get(item["product_id"])
             
-            if product:
-                # Get shop-specific stock
-                shop_stock = tenant_db.query(ProductShopStockORM).filter(
-                    ProductShopStockORM.product_id == item["product_id"],
-                    ProductShopStockORM.shop_id == shop_id
-                ).first()
-                
-                if shop_stock and shop_stock.stock <= shop_stock.low_stock_threshold:
-                    # Send low stock alert for this specific shop
-                    from app.telegram_notifications import notify_low_stock
-                    notify_low_stock(tenant_db, product, shop_id)
+            if shop_stock and shop_stock.stock <= shop_stock.low_stock_threshold:
+                queue_low_stock_alert(current_user.tenant_schema, item["product_id"], shop_id)
         
         return True
         
     except Exception as e:
-        logger.error(f"❌ Cart sale recording failed: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ Cart sale recording failed: {e}")
         tenant_db.rollback()
-        send_message(chat_id, f"❌ Failed to record sale: {str(e)}")
+        # The caller tells the user it failed; the exception text (SQL,
+        # parameters, ORM reprs) stays in the log.
         return False
                 
+def _finalize_sale(tenant_db, chat_id, user, answer, data):
+    """Handle the final yes/no sale confirmation. Returns True if the sale was recorded."""
+
+    if answer != YES:
+        send_message(chat_id, "❌ Sale cancelled.")
+        user_states.pop(chat_id, None)
+        send_message(chat_id, "🏠 Main Menu:", keyboard=role_menu_keyboard(user.role))
+        return False
+
+    logger.info(f"🎯 STEP 7 → Recording sale - Chat: {chat_id}")
+    user_states.pop(chat_id, None)
+
+    # The main menu rides on the receipt instead of a separate message
+    if not record_cart_sale(tenant_db, chat_id, data, role_menu_keyboard(user.role)):
+        logger.error(f"❌ STEP 7 → Sale recording failed - Chat: {chat_id}")
+        send_message(chat_id, "❌ Failed to record sale. Please try again.")
+        return False
+
+    logger.info(f"✅ STEP 7 → Sale recorded successfully - Chat: {chat_id}")
+    return True
+
 def check_low_stock_alerts(tenant_db, product_id, shop_id):
     """Check and notify about low stock for specific shop"""
     
@@ -1311,8 +1651,8 @@ def check_low_stock_alerts(tenant_db, product_id, shop_id):
     
     if shop_stock and shop_stock.is_low_stock():
         # Get shop info
-        shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
-        product = tenant_db.query(ProductORM).filter(ProductORM.product_id == product_id).first()
+        shop = tenant_db.get(ShopORM, shop_id)
+        product = tenant_db.get(ProductORM, product_id)
         
         if shop and product:
             # Notify owner (find owner in central DB)
@@ -1325,12 +1665,9 @@ def check_low_stock_alerts(tenant_db, product_id, shop_id):
                 schema_name = result[0] if result else None
                 
                 if schema_name:
-                    owner = central_db.query(User).filter(
-                        User.tenant_schema == schema_name,
-                        User.role == "owner"
-                    ).first()
+                    owner_chat_id = get_owner_chat_id(central_db, schema_name)
                     
-                    if owner and owner.chat_id:
+                    if owner_chat_id:
                         alert_msg = f"⚠️ *LOW STOCK ALERT* ⚠️\n\n"
                         alert_msg += f"🏪 Shop: {shop.name}\n"
                         alert_msg += f"📦 Product: {product.name}\n"
@@ -1341,7 +1678,7 @@ def check_low_stock_alerts(tenant_db, product_id, shop_id):
                         else:
                             alert_msg += f"⚠️ *Running low!*\n"
                         
-                        send_message(owner.chat_id, alert_msg)
+                        send_message(owner_chat_id, alert_msg)
             
             except Exception as e:
                 logger.error(f"❌ Error sending low stock alert: {e}")
@@ -1364,7 +1701,8 @@ def generate_comparison_report(tenant_db, report_type, shop_ids=None, shop_names
             # Example: Daily sales comparison
             for shop_id, shop_name in zip(shop_ids, shop_names):
                 daily_sales = tenant_db.query(SaleORM).filter(
-                    func.date(SaleORM.sale_date) == func.current_date(),
+                    SaleORM.sale_date >= func.current_date(),
+                    SaleORM.sale_date < func.current_date() + 1,
                     SaleORM.shop_id == shop_id
                 ).all()
                 
@@ -1410,6 +1748,71 @@ def generate_comparison_report(tenant_db, report_type, shop_ids=None, shop_names
         logger.error(f"❌ Comparison report error: {e}")
         return f"❌ Error generating comparison report: {str(e)}"
         
+# -------------------- Report Cache --------------------
+# Rendered report text per tenant schema, keyed by (report_type, shop_id,
+# day, generation). Kept briefly so repeated taps on a report don't re-run
+# the aggregates. Only reports built purely from sales are cached: those
+# change only in record_cart_sale, which bumps the tenant's generation.
+# The generation lives in Redis when available, so a sale recorded on
+# one worker invalidates every worker's copy; the day in the key stops a
+# report cached before midnight being served after it.
+REPORT_CACHE_TTL = 30
+CACHED_REPORTS = frozenset({
+    "report_daily", "report_weekly", "report_monthly",
+    "report_top_products", "report_aov",
+})
+REPORT_GEN_PREFIX = f"{BOT_KEY_PREFIX}repgen:"
+_report_cache = TTLDict(ttl=REPORT_CACHE_TTL, maxsize=1000)  # schema -> {(type, shop_id, day, gen): (text, expires_at)}
+_report_generations = defaultdict(int)  # schema -> local generation, without Redis
+
+
+def _report_generation(schema):
+    if _redis is not None:
+        try:
+            return int(_redis.get(f"{REPORT_GEN_PREFIX}{schema}") or 0)
+        except Exception as e:
+            logger.warning(f"⚠️ Report cache generation unavailable for {schema}: {e}")
+            return None
+    return _report_generations[schema]
+
+
+def cached_report(schema, tenant_db, report_type, shop_id=None, shop_name=None):
+    """generate_report() through the short per-tenant cache; errors are not cached."""
+    generation = _report_generation(schema) if report_type in CACHED_REPORTS else None
+    if generation is None:
+        return generate_report(tenant_db, report_type, shop_id=shop_id, shop_name=shop_name)
+
+    reports = _report_cache.get(schema)
+    if reports is None:
+        reports = _report_cache[schema] = {}
+    key = (report_type, shop_id, datetime.now().date(), generation)
+    entry = reports.get(key)
+    if entry and entry[1] >= time.monotonic():
+        return entry[0]
+
+    report = generate_report(tenant_db, report_type, shop_id=shop_id, shop_name=shop_name)
+    if not report.startswith("❌"):
+        now = time.monotonic()
+        # Entries from past days and generations are never hit again
+        for old_key, (_, expires_at) in list(reports.items()):
+            if expires_at < now:
+                reports.pop(old_key, None)
+        reports[key] = (report, now + REPORT_CACHE_TTL)
+    return report
+
+
+def invalidate_report_cache(schema):
+    """Drop a tenant's cached reports here and, through Redis, on every worker."""
+    _report_cache.pop(schema, None)
+    if _redis is None:
+        _report_generations[schema] += 1
+        return
+    try:
+        _redis.incr(f"{REPORT_GEN_PREFIX}{schema}")
+    except Exception as e:
+        logger.warning(f"⚠️ Could not bump report cache generation for {schema}: {e}")
+
+
 # -------------------- Clean Tenant-Aware Reports --------------------      
 def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
     """
@@ -1435,8 +1838,10 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
         # ---------- DAILY SALES REPORT ----------
         if report_type == "report_daily":
             # Build query with shop filtering
+            # Range on sale_date (not date(sale_date)) so ix_sales_sale_date applies
             query = tenant_db.query(SaleORM).filter(
-                func.date(SaleORM.sale_date) == today
+                SaleORM.sale_date >= today,
+                SaleORM.sale_date < today + timedelta(days=1)
             )
             
             if shop_id:
@@ -1446,7 +1851,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             
             # Get shop info
             if shop_id:
-                shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                shop = tenant_db.get(ShopORM, shop_id)
                 shop_display = f" for {shop.name}" if shop else f" for Shop {shop_id}"
             else:
                 shop_display = ""
@@ -1471,9 +1876,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
                 # Group by product
                 product_sales = {}
                 for sale in daily_sales:
-                    product = tenant_db.query(ProductORM).filter(
-                        ProductORM.product_id == sale.product_id
-                    ).first()
+                    product = tenant_db.get(ProductORM, sale.product_id)
                     if product:
                         product_name = product.name
                         if product_name not in product_sales:
@@ -1503,7 +1906,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             weekly_sales = query.all()
             
             if shop_id:
-                shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                shop = tenant_db.get(ShopORM, shop_id)
                 shop_display = f" for {shop.name}" if shop else f" for Shop {shop_id}"
             else:
                 shop_display = ""
@@ -1548,7 +1951,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             monthly_sales = query.all()
             
             if shop_id:
-                shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                shop = tenant_db.get(ShopORM, shop_id)
                 shop_display = f" for {shop.name}" if shop else f" for Shop {shop_id}"
             else:
                 shop_display = ""
@@ -1596,7 +1999,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             low_stock_items = query.all()
             
             if shop_id:
-                shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                shop = tenant_db.get(ShopORM, shop_id)
                 shop_display = f" for {shop.name}" if shop else f" for Shop {shop_id}"
             else:
                 shop_display = ""
@@ -1611,7 +2014,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
                 
                 for stock_item in low_stock_items:
                     product = stock_item.product
-                    shop_info = tenant_db.query(ShopORM).filter(ShopORM.shop_id == stock_item.shop_id).first()
+                    shop_info = tenant_db.get(ShopORM, stock_item.shop_id)
                     shop_name = shop_info.name if shop_info else f"Shop {stock_item.shop_id}"
                     
                     status = "🔴" if stock_item.stock == 0 else "🟡"
@@ -1649,7 +2052,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             top_products = query.order_by(func.sum(SaleORM.total_amount).desc()).limit(10).all()
             
             if shop_id:
-                shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                shop = tenant_db.get(ShopORM, shop_id)
                 shop_display = f" for {shop.name}" if shop else f" for Shop {shop_id}"
             else:
                 shop_display = ""
@@ -1663,9 +2066,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
                 report += "📊 **Top 10 Products by Revenue:**\n\n"
                 
                 for i, (product_id, quantity, amount) in enumerate(top_products, 1):
-                    product = tenant_db.query(ProductORM).filter(
-                        ProductORM.product_id == product_id
-                    ).first()
+                    product = tenant_db.get(ProductORM, product_id)
                     
                     if product:
                         product_name = product.name
@@ -1679,10 +2080,18 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
         
         # ---------- AVERAGE ORDER VALUE REPORT ----------
         elif report_type == "report_aov":
-            # Build query with shop filtering
+            # Average, count and the value distribution in one query with shop filtering
             query = tenant_db.query(
                 func.avg(SaleORM.total_amount).label('avg_amount'),
-                func.count(SaleORM.sale_id).label('total_sales')
+                func.count(SaleORM.sale_id).label('total_sales'),
+                func.count(SaleORM.sale_id).filter(SaleORM.total_amount < 10).label('under_10'),
+                func.count(SaleORM.sale_id).filter(
+                    SaleORM.total_amount >= 10, SaleORM.total_amount <= 50
+                ).label('from_10_to_50'),
+                func.count(SaleORM.sale_id).filter(
+                    SaleORM.total_amount > 50, SaleORM.total_amount <= 100
+                ).label('from_50_to_100'),
+                func.count(SaleORM.sale_id).filter(SaleORM.total_amount > 100).label('over_100')
             )
             
             if shop_id:
@@ -1691,7 +2100,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             result = query.first()
             
             if shop_id:
-                shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                shop = tenant_db.get(ShopORM, shop_id)
                 shop_display = f" for {shop.name}" if shop else f" for Shop {shop_id}"
             else:
                 shop_display = ""
@@ -1711,16 +2120,10 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
                 
                 # Get distribution
                 order_ranges = [
-                    ("<$10", tenant_db.query(SaleORM).filter(SaleORM.total_amount < 10).count()),
-                    ("$10-$50", tenant_db.query(SaleORM).filter(
-                        SaleORM.total_amount >= 10, 
-                        SaleORM.total_amount <= 50
-                    ).count()),
-                    ("$50-$100", tenant_db.query(SaleORM).filter(
-                        SaleORM.total_amount > 50, 
-                        SaleORM.total_amount <= 100
-                    ).count()),
-                    (">$100", tenant_db.query(SaleORM).filter(SaleORM.total_amount > 100).count())
+                    ("<$10", result.under_10),
+                    ("$10-$50", result.from_10_to_50),
+                    ("$50-$100", result.from_50_to_100),
+                    (">$100", result.over_100)
                 ]
                 
                 report += f"\n📈 **Order Value Distribution:**\n"
@@ -1731,8 +2134,12 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
         # ---------- STOCK TURNOVER REPORT ----------
         elif report_type == "report_stock_turnover":
             # FIXED: Use ProductShopStockORM
-            # Get all stock items with sales data
-            query = tenant_db.query(ProductShopStockORM).join(
+            # Stock rows with product names, as plain column tuples
+            query = tenant_db.query(
+                ProductORM.product_id, ProductORM.name,
+                ProductShopStockORM.shop_id, ProductShopStockORM.stock,
+                ProductShopStockORM.low_stock_threshold
+            ).join(
                 ProductORM, ProductORM.product_id == ProductShopStockORM.product_id
             )
             
@@ -1742,7 +2149,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             stock_items = query.all()
             
             if shop_id:
-                shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                shop = tenant_db.get(ShopORM, shop_id)
                 shop_display = f" for {shop.name}" if shop else f" for Shop {shop_id}"
             else:
                 shop_display = ""
@@ -1754,35 +2161,33 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
                 report += "No stock data available.\n"
             else:
                 report += "📊 **Stock Status Summary:**\n\n"
+                shown = stock_items[:20]  # Limit to first 20 items
                 
-                for stock_item in stock_items[:20]:  # Limit to first 20 items
-                    product = stock_item.product
-                    shop_info = tenant_db.query(ShopORM).filter(ShopORM.shop_id == stock_item.shop_id).first()
-                    shop_name = shop_info.name if shop_info else f"Shop {stock_item.shop_id}"
-                    
-                    # Get sales for this product
-                    sales_query = tenant_db.query(SaleORM).filter(
-                        SaleORM.product_id == product.product_id
-                    )
-                    
-                    if shop_id:
-                        sales_query = sales_query.filter(SaleORM.shop_id == shop_id)
-                    
-                    monthly_sales = sales_query.filter(
-                        SaleORM.sale_date >= month_ago
-                    ).all()
-                    
-                    total_sold = sum(sale.quantity for sale in monthly_sales)
+                # Units sold in the last 30 days for the shown products, one grouped query
+                sales_query = tenant_db.query(
+                    SaleORM.product_id, func.sum(SaleORM.quantity)
+                ).filter(
+                    SaleORM.product_id.in_({row.product_id for row in shown}),
+                    SaleORM.sale_date >= month_ago
+                )
+                if shop_id:
+                    sales_query = sales_query.filter(SaleORM.shop_id == shop_id)
+                sold_by_product = dict(sales_query.group_by(SaleORM.product_id).all())
+                shop_names = dict(tenant_db.query(ShopORM.shop_id, ShopORM.name).all())
+                
+                for product_id, name, item_shop_id, stock, threshold in shown:
+                    shop_name = shop_names.get(item_shop_id) or f"Shop {item_shop_id}"
+                    total_sold = sold_by_product.get(product_id) or 0
                     
-                    status = "🟢" if stock_item.stock > stock_item.low_stock_threshold else "🔴" if stock_item.stock == 0 else "🟡"
-                    report += f"{status} *{product.name}*\n"
+                    status = "🟢" if stock > threshold else "🔴" if stock == 0 else "🟡"
+                    report += f"{status} *{name}*\n"
                     report += f"   🏪 Shop: {shop_name}\n"
-                    report += f"   📊 Current Stock: {stock_item.stock}\n"
+                    report += f"   📊 Current Stock: {stock}\n"
                     report += f"   📈 Sold (30 days): {total_sold}\n"
                     
                     # Calculate turnover rate
-                    if stock_item.stock > 0:
-                        turnover_rate = (total_sold / stock_item.stock) * 100
+                    if stock > 0:
+                        turnover_rate = (total_sold / stock) * 100
                         report += f"   🔄 Turnover Rate: {turnover_rate:.1f}%\n"
                     
                     report += "\n"
@@ -1801,7 +2206,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             all_sales = query.all()
     
             if shop_id:
-                shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                shop = tenant_db.get(ShopORM, shop_id)
                 shop_display = f" for {shop.name}" if shop else f" for Shop {shop_id}"
             else:
                 shop_display = ""
@@ -1901,9 +2306,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
                     if recent_credits:
                         report += f"\n📅 **Recent Credit Sales (Last 5):**\n"
                         for sale in recent_credits:
-                            product = tenant_db.query(ProductORM).filter(
-                                ProductORM.product_id == sale.product_id
-                            ).first()
+                            product = tenant_db.get(ProductORM, sale.product_id)
                             product_name = product.name if product else f"Product {sale.product_id}"
                             report += f"  • {sale.sale_date.strftime('%Y-%m-%d')}: {product_name}\n"
                             report += f"    ${sale.total_amount:.2f} (Paid: ${sale.amount_paid:.2f}, Pending: ${sale.pending_amount:.2f})\n"
@@ -1939,9 +2342,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
                     if recent_changes:
                         report += f"\n📅 **Recent Change Due (Last 5):**\n"
                         for sale in recent_changes:
-                            product = tenant_db.query(ProductORM).filter(
-                                ProductORM.product_id == sale.product_id
-                            ).first()
+                            product = tenant_db.get(ProductORM, sale.product_id)
                             product_name = product.name if product else f"Product {sale.product_id}"
                             report += f"  • {sale.sale_date.strftime('%Y-%m-%d')}: {product_name}\n"
                             report += f"    Change Due: ${sale.change_left:.2f}\n"
@@ -2059,7 +2460,11 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             # Check for credit sales properly
             from sqlalchemy import or_
     
-            query = tenant_db.query(SaleORM).filter(
+            # Customer and product come in with the sales (two IN queries)
+            # rather than one lookup per row below
+            query = tenant_db.query(SaleORM).options(
+                selectinload(SaleORM.customer), selectinload(SaleORM.product)
+            ).filter(
                 or_(
                     SaleORM.payment_type.in_(["credit", "partial"]),
                     SaleORM.pending_amount > 0.01
@@ -2072,7 +2477,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             credit_sales = query.all()
     
             if shop_id:
-                shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                shop = tenant_db.get(ShopORM, shop_id)
                 shop_display = f" for {shop.name}" if shop else f" for Shop {shop_id}"
             else:
                 shop_display = ""
@@ -2109,9 +2514,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
                 customer_credits = {}
                 for sale in credit_sales:
                     if sale.customer_id:
-                        customer = tenant_db.query(CustomerORM).filter(
-                            CustomerORM.customer_id == sale.customer_id
-                        ).first()
+                        customer = sale.customer
                         customer_name = customer.name if customer else f"Customer {sale.customer_id}"
                     else:
                         customer_name = "Unknown Customer"
@@ -2131,8 +2534,10 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
                     if sale.sale_date > customer_credits[customer_name]["last_date"]:
                         customer_credits[customer_name]["last_date"] = sale.sale_date
         
+                # Per-customer and recent-sale sections, joined once
+                lines = []
                 if customer_credits:
-                    report += f"\n👥 **Customers with Pending Credit:**\n"
+                    lines.append(f"\n👥 **Customers with Pending Credit:**\n")
                     sorted_customers = sorted(
                         customer_credits.items(), 
                         key=lambda x: x[1]["pending"], 
@@ -2141,11 +2546,11 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             
                     for customer_name, data in sorted_customers:
                         days_ago = (today - data["last_date"].date()).days
-                        report += f"\n• **{customer_name}**\n"
-                        report += f"  📊 Total Credit: ${data['total_amount']:.2f}\n"
-                        report += f"  💰 Pending: ${data['pending']:.2f}\n"
-                        report += f"  📈 Transactions: {data['count']}\n"
-                        report += f"  📅 Last Credit: {data['last_date'].strftime('%Y-%m-%d')} ({days_ago} days ago)\n"
+                        lines.append(f"\n• **{customer_name}**\n")
+                        lines.append(f"  📊 Total Credit: ${data['total_amount']:.2f}\n")
+                        lines.append(f"  💰 Pending: ${data['pending']:.2f}\n")
+                        lines.append(f"  📈 Transactions: {data['count']}\n")
+                        lines.append(f"  📅 Last Credit: {data['last_date'].strftime('%Y-%m-%d')} ({days_ago} days ago)\n")
                 
                         # 🆕 ADDED: Payment history for this customer
                         if data["customer_id"]:
@@ -2155,38 +2560,37 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
                             ).order_by(PaymentRecordORM.recorded_at.desc()).limit(3).all()
                     
                             if payment_records:
-                                report += f"  📋 **Recent Payments (Last 3):**\n"
+                                lines.append(f"  📋 **Recent Payments (Last 3):**\n")
                                 for pr in payment_records:
                                     method_display = f"via {pr.payment_method}" if pr.payment_method else ""
-                                    report += f"    • {pr.recorded_at.strftime('%Y-%m-%d')}: ${pr.amount:.2f} {method_display}\n"
+                                    lines.append(f"    • {pr.recorded_at.strftime('%Y-%m-%d')}: ${pr.amount:.2f} {method_display}\n")
                                     if pr.notes:
-                                        report += f"      Note: {pr.notes}\n"
+                                        lines.append(f"      Note: {pr.notes}\n")
         
                 # Show recent credit sales (last 10)
                 recent_credits = sorted(credit_sales, key=lambda x: x.sale_date, reverse=True)[:10]
                 if recent_credits:
-                    report += f"\n📅 **Recent Credit Sales (Last 10):**\n"
+                    lines.append(f"\n📅 **Recent Credit Sales (Last 10):**\n")
                     for sale in recent_credits:
-                        product = tenant_db.query(ProductORM).filter(
-                            ProductORM.product_id == sale.product_id
-                        ).first()
+                        product = sale.product
                         product_name = product.name if product else f"Product {sale.product_id}"
                 
-                        report += f"• {sale.sale_date.strftime('%Y-%m-%d')}: {product_name}\n"
-                        report += f"  Amount: ${sale.total_amount:.2f}, Paid: ${sale.amount_paid:.2f}, Pending: ${sale.pending_amount:.2f}\n"
+                        lines.append(f"• {sale.sale_date.strftime('%Y-%m-%d')}: {product_name}\n")
+                        lines.append(f"  Amount: ${sale.total_amount:.2f}, Paid: ${sale.amount_paid:.2f}, Pending: ${sale.pending_amount:.2f}\n")
                         if sale.customer_id:
-                            customer = tenant_db.query(CustomerORM).filter(
-                                CustomerORM.customer_id == sale.customer_id
-                            ).first()
+                            customer = sale.customer
                             if customer:
-                                report += f"  Customer: {customer.name}\n"
+                                lines.append(f"  Customer: {customer.name}\n")
+                report += "".join(lines)
     
             return report
     
         # ---------- CHANGE DUE REPORT ----------
         elif report_type == "report_change":
             # Check change_left properly
-            query = tenant_db.query(SaleORM).filter(
+            query = tenant_db.query(SaleORM).options(
+                selectinload(SaleORM.customer), selectinload(SaleORM.product)
+            ).filter(
                 SaleORM.change_left > 0.01
             )
     
@@ -2196,7 +2600,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             change_sales = query.all()
     
             if shop_id:
-                shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                shop = tenant_db.get(ShopORM, shop_id)
                 shop_display = f" for {shop.name}" if shop else f" for Shop {shop_id}"
             else:
                 shop_display = ""
@@ -2234,9 +2638,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
                 customer_changes = {}
                 for sale in change_sales:
                     if sale.customer_id:
-                        customer = tenant_db.query(CustomerORM).filter(
-                            CustomerORM.customer_id == sale.customer_id
-                        ).first()
+                        customer = sale.customer
                         customer_name = customer.name if customer else f"Customer {sale.customer_id}"
                     else:
                         customer_name = "Walk-in Customer"
@@ -2256,8 +2658,10 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
                     if sale.sale_date > customer_changes[customer_name]["last_date"]:
                         customer_changes[customer_name]["last_date"] = sale.sale_date
         
+                # Per-customer and recent-sale sections, joined once
+                lines = []
                 if customer_changes:
-                    report += f"\n👥 **Customers Owed Change:**\n"
+                    lines.append(f"\n👥 **Customers Owed Change:**\n")
                     sorted_customers = sorted(
                         customer_changes.items(), 
                         key=lambda x: x[1]["change"], 
@@ -2266,11 +2670,11 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             
                     for customer_name, data in sorted_customers:
                         days_ago = (today - data["last_date"].date()).days
-                        report += f"\n• **{customer_name}**\n"
-                        report += f"  🪙 Change Due: ${data['change']:.2f}\n"
-                        report += f"  📊 Transactions: {data['count']}\n"
-                        report += f"  💰 Total Sales: ${data['total_sales']:.2f}\n"
-                        report += f"  📅 Last Transaction: {data['last_date'].strftime('%Y-%m-%d')} ({days_ago} days ago)\n"
+                        lines.append(f"\n• **{customer_name}**\n")
+                        lines.append(f"  🪙 Change Due: ${data['change']:.2f}\n")
+                        lines.append(f"  📊 Transactions: {data['count']}\n")
+                        lines.append(f"  💰 Total Sales: ${data['total_sales']:.2f}\n")
+                        lines.append(f"  📅 Last Transaction: {data['last_date'].strftime('%Y-%m-%d')} ({days_ago} days ago)\n")
                 
                         # 🆕 ADDED: Collection history for this customer
                         if data["customer_id"]:
@@ -2280,30 +2684,27 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
                             ).order_by(PaymentRecordORM.recorded_at.desc()).limit(3).all()
                     
                             if collection_records:
-                                report += f"  📋 **Recent Collections (Last 3):**\n"
+                                lines.append(f"  📋 **Recent Collections (Last 3):**\n")
                                 for cr in collection_records:
-                                    report += f"    • {cr.recorded_at.strftime('%Y-%m-%d')}: ${cr.amount:.2f} collected\n"
+                                    lines.append(f"    • {cr.recorded_at.strftime('%Y-%m-%d')}: ${cr.amount:.2f} collected\n")
                                     if cr.notes:
-                                        report += f"      Note: {cr.notes}\n"
+                                        lines.append(f"      Note: {cr.notes}\n")
         
                 # Show recent change due sales (last 10)
                 recent_changes = sorted(change_sales, key=lambda x: x.sale_date, reverse=True)[:10]
                 if recent_changes:
-                    report += f"\n📅 **Recent Change Due (Last 10):**\n"
+                    lines.append(f"\n📅 **Recent Change Due (Last 10):**\n")
                     for sale in recent_changes:
-                        product = tenant_db.query(ProductORM).filter(
-                            ProductORM.product_id == sale.product_id
-                        ).first()
+                        product = sale.product
                         product_name = product.name if product else f"Product {sale.product_id}"
                 
-                        report += f"• {sale.sale_date.strftime('%Y-%m-%d %H:%M')}: {product_name}\n"
-                        report += f"  Change Due: ${sale.change_left:.2f}, Paid: ${sale.amount_paid:.2f}\n"
+                        lines.append(f"• {sale.sale_date.strftime('%Y-%m-%d %H:%M')}: {product_name}\n")
+                        lines.append(f"  Change Due: ${sale.change_left:.2f}, Paid: ${sale.amount_paid:.2f}\n")
                         if sale.customer_id:
-                            customer = tenant_db.query(CustomerORM).filter(
-                                CustomerORM.customer_id == sale.customer_id
-                            ).first()
+                            customer = sale.customer
                             if customer:
-                                report += f"  Customer: {customer.name}\n"
+                                lines.append(f"  Customer: {customer.name}\n")
+                report += "".join(lines)
         
                 # Add actionable advice
                 report += f"\n💡 **Action Required:**\n"
@@ -2317,9 +2718,7 @@ def generate_report(tenant_db, report_type, shop_id=None, shop_name=None):
             return report
                     
     except Exception as e:
-        logger.error(f"❌ Error generating report {report_type}: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ Error generating report {report_type}: {e}")
         return f"❌ Error generating report: {str(e)}"
         
 def debug_sales_data(tenant_db):
@@ -2393,46 +2792,1042 @@ def report_menu_keyboard(role, is_shop_specific=False, shop_name=None):
     return {"inline_keyboard": keyboard}
 
 
-# -------------------- Webhook --------------------
-@router.post("/telegram/webhook")
-async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
-    import traceback
-    try:
-        data = await request.json()
-        print("📩 Incoming Telegram update:", data)
+# Default (all-shops) report menu per role, serialized once at import
+REPORT_MENU_JSON_BY_ROLE = {r: keyboard_json(report_menu_keyboard(r)) for r in ("owner", "admin", "shopkeeper")}
 
-        chat_id = None
-        text = ""
-        update_type = None
-        
-        # Determine the update type
-        if "message" in data:
-            chat_id = data["message"]["chat"]["id"]
-            text = data["message"].get("text", "").strip()
-            update_type = "message"
-        elif "callback_query" in data:
-            chat_id = data["callback_query"]["message"]["chat"]["id"]
-            text = data["callback_query"]["data"]
-            update_type = "callback"
-            callback_id = data["callback_query"]["id"]
-    
-            # ✅ Answer callback immediately
-            requests.post(
-                f"{TELEGRAM_API_URL}/answerCallbackQuery",
-                json={"callback_query_id": callback_id}
-            )
+# Shop-specific report menu per role; the shop name only appears in the
+# message text, never on the buttons, so one copy serves every shop
+SHOP_REPORT_MENU_JSON_BY_ROLE = {
+    r: keyboard_json(report_menu_keyboard(r, is_shop_specific=True, shop_name="shop"))
+    for r in ("owner", "admin", "shopkeeper")
+}
 
-        if not chat_id:
+
+def report_menu_json(role, is_shop_specific=False, shop_name=None):
+    """Pre-serialized report menu for this role and context (built on the fly for unknown roles)."""
+    if is_shop_specific and shop_name:
+        cached = SHOP_REPORT_MENU_JSON_BY_ROLE.get(role)
+    elif not is_shop_specific:
+        cached = REPORT_MENU_JSON_BY_ROLE.get(role)
+    else:
+        cached = None
+    return cached or report_menu_keyboard(role, is_shop_specific, shop_name)
+
+
+# -------------------- Callback Handlers --------------------
+# Table-driven callbacks: each handler takes (chat_id, user, db, arg) where
+# arg is the part of the callback data after the first ":" (empty for exact
+# matches). Anything not in these tables falls through to the elif ladder
+# in telegram_webhook.
+
+def _handle_add_another_item(chat_id, user, db, arg):
+    """Return to product search, keeping the cart."""
+    logger.info(f"🎯 Processing callback: add_another_item from chat_id={chat_id}")
+
+    # ✅ FIX: Get current state from user_states, not callback data
+    current_state = user_states.get(chat_id, {})
+    current_data = current_state.get("data", {})
+
+    logger.info(f"🔍 CART DEBUG [add_another_item] - Chat: {chat_id}, Items: {len(current_data.get('cart', []))}")
+
+    # Preserve existing cart and data
+    user_states[chat_id] = {
+        "action": "awaiting_sale", 
+        "step": 1, 
+        "data": current_data  # This preserves the cart!
+    }
+    send_message(chat_id, "➕ Add another item. Enter product name:")
+
+
+def _handle_view_cart(chat_id, user, db, arg):
+    """Show the current cart with cart actions."""
+    # ✅ FIX: Get cart from current state, not callback data
+    current_state = user_states.get(chat_id, {})
+    current_data = current_state.get("data", {})
+    cart = current_data.get("cart", [])
+
+    logger.info(f"🔍 CART DEBUG [view_cart] - Chat: {chat_id}, Items: {len(cart)}")
+
+    cart_summary = get_cart_summary(cart)
+    kb_rows = [
+        [{"text": "➕ Add Item", "callback_data": "add_another_item"}],
+        [{"text": "🗑 Remove Item", "callback_data": "remove_item"}],
+        [{"text": "✅ Checkout", "callback_data": "checkout_cart"}],
+        [{"text": "❌ Cancel Sale", "callback_data": "cancel_sale"}]
+    ]
+    send_message(chat_id, cart_summary, {"inline_keyboard": kb_rows})
+
+
+def _handle_remove_item(chat_id, user, db, arg):
+    """List cart items that can be removed."""
+    # ✅ FIX: Get cart from current state
+    current_state = user_states.get(chat_id, {})
+    current_data = current_state.get("data", {})
+    cart = current_data.get("cart", [])
+
+    logger.info(f"🔍 CART DEBUG [remove_item] - Chat: {chat_id}, Items: {len(cart)}")
+
+    if not cart:
+        send_message(chat_id, "🛒 Cart is empty. Add items first.")
+        return
+
+    kb_rows = []
+    for i, item in enumerate(cart, 1):
+        kb_rows.append([{"text": f"Remove: {item['name']} ({item['quantity']})", "callback_data": f"remove_cart_item:{i-1}"}])
+    kb_rows.append([{"text": "⬅️ Back to Cart", "callback_data": "view_cart"}])
+
+    send_message(chat_id, "🗑 Select item to remove:", {"inline_keyboard": kb_rows})
+
+
+def _handle_checkout_cart(chat_id, user, db, arg):
+    """Move the sale to checkout and ask for a payment method."""
+    logger.info(f"🎯 Processing callback: checkout_cart from chat_id={chat_id}")
+
+    # ✅ FIX: Get cart from current state
+    current_state = user_states.get(chat_id, {})
+    current_data = current_state.get("data", {})
+    cart = current_data.get("cart", [])
+
+    logger.info(f"🔍 CART DEBUG [checkout_cart] - Chat: {chat_id}, Items: {len(cart)}")
+
+    if not cart:
+        send_message(chat_id, "❌ Cart is empty! Add items first.")
+        return
+
+    # Move to checkout step
+    user_states[chat_id] = {
+        "action": "awaiting_sale", 
+        "step": 3, 
+        "data": current_data  # Preserve cart for checkout
+    }
+
+    # Show payment options - UPDATED: Cash, Ecocash, Swipe
+    kb_rows = [
+        [{"text": "💵 Cash", "callback_data": "payment_method:cash"}],
+        [{"text": "📱 Ecocash", "callback_data": "payment_method:ecocash"}],
+        [{"text": "💳 Swipe", "callback_data": "payment_method:swipe"}],
+        [{"text": "⬅️ Back to Cart", "callback_data": "view_cart"}]
+    ]
+
+    cart_summary = get_cart_summary(cart)
+    total = sum(item["subtotal"] for item in cart)
+    message = f"🛒 Checkout\n\n{cart_summary}\n💰 Total: ${total:.2f}\n\n💳 Select payment method:"
+
+    send_message(chat_id, message, {"inline_keyboard": kb_rows})
+
+
+def _handle_cancel_sale(chat_id, user, db, arg):
+    """Abandon the current sale and return to the main menu."""
+    logger.info(f"🎯 Processing callback: cancel_sale from chat_id={chat_id}")
+
+    current_state = user_states.get(chat_id, {})
+    current_data = current_state.get("data", {})
+    cart = current_data.get("cart", [])
+    logger.info(f"🔍 CART DEBUG [cancel_sale] - Chat: {chat_id}, Items: {len(cart)}")
+
+    user_states.pop(chat_id, None)
+    send_message(chat_id, "❌ Sale cancelled.")
+    kb = role_menu_keyboard(user.role)
+    send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
+
+
+def _handle_remove_cart_item(chat_id, user, db, arg):
+    """Remove the cart item at the given index."""
+    # ✅ FIX: Get cart from current state
+    current_state = user_states.get(chat_id, {})
+    current_data = current_state.get("data", {})
+    cart = current_data.get("cart", [])
+
+    logger.info(f"🔍 CART DEBUG [before_remove] - Chat: {chat_id}, Items: {len(cart)}")
+
+    try:
+        index = int(arg)
+        if 0 <= index < len(cart):
+            removed_item = cart.pop(index)
+
+            # Update the state with modified cart
+            user_states[chat_id] = {
+                "action": "awaiting_sale",
+                "step": 1, 
+                "data": current_data
+            }
+
+            logger.info(f"🔍 CART DEBUG [after_remove] - Chat: {chat_id}, Items: {len(cart)}")
+
+            send_message(chat_id, f"✅ Removed: {removed_item['name']}")
+
+            # Show updated cart
+            cart_summary = get_cart_summary(cart)
+            kb_rows = [
+                [{"text": "➕ Add Item", "callback_data": "add_another_item"}],
+                [{"text": "🗑 Remove Item", "callback_data": "remove_item"}],
+                [{"text": "✅ Checkout", "callback_data": "checkout_cart"}],
+                [{"text": "❌ Cancel Sale", "callback_data": "cancel_sale"}]
+            ]
+            send_message(chat_id, cart_summary, {"inline_keyboard": kb_rows})
+        else:
+            send_message(chat_id, "❌ Invalid item selection.")
+    except (ValueError, IndexError):
+        send_message(chat_id, "❌ Error removing item.")
+
+
+def _handle_payment_method(chat_id, user, db, arg):
+    """Apply the chosen payment method (cash / ecocash / swipe)."""
+    payment_method = arg
+
+    # Get current state
+    current_state = user_states.get(chat_id, {})
+    current_data = current_state.get("data", {})
+
+    logger.info(f"🔍 CART DEBUG [payment_method] - Chat: {chat_id}, Items: {len(current_data.get('cart', []))}, Method: {payment_method}")
+
+    current_data["payment_method"] = payment_method
+
+    # Calculate cart total
+    cart_total = sum(item["subtotal"] for item in current_data["cart"])
+
+    if payment_method == "cash":
+        # For cash, ask for sale type (cash/credit)
+        user_states[chat_id] = {
+            "action": "awaiting_sale", 
+            "step": 3.1, 
+            "data": current_data
+        }
+
+        kb_rows = [
+            [{"text": "💵 Cash Sale", "callback_data": "sale_type:cash"}],
+            [{"text": "🔄 Credit Sale", "callback_data": "sale_type:credit"}],
+            [{"text": "⬅️ Back", "callback_data": "view_cart"}]
+        ]
+
+        send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n\n💳 Select sale type:", {"inline_keyboard": kb_rows})
+
+    elif payment_method == "ecocash":
+        # ✅ Apply 10% surcharge for Ecocash
+        surcharge = cart_total * 0.10
+        final_total = cart_total + surcharge
+        current_data["original_total"] = cart_total  # Store original for receipt
+        current_data["surcharge"] = surcharge
+        current_data["final_total"] = final_total
+
+        # For Ecocash, it's always full payment with surcharge
+        current_data["sale_type"] = "cash"
+        current_data["payment_type"] = "full"
+        current_data["amount_paid"] = final_total
+        current_data["pending_amount"] = 0
+        current_data["change_left"] = 0
+
+        user_states[chat_id] = {
+            "action": "awaiting_sale", 
+            "step": 6, 
+            "data": current_data
+        }
+
+        # Show surcharge breakdown
+        message = f"📱 *Ecocash Payment*\n\n"
+        message += get_cart_summary(current_data["cart"])
+        message += f"💰 Subtotal: ${cart_total:.2f}\n"
+        message += f"⚡ Surcharge (10%): ${surcharge:.2f}\n"
+        message += f"💳 *Final Amount: ${final_total:.2f}*\n\n"
+        message += "✅ Ecocash payment confirmed.\n\nConfirm sale? (yes/no)"
+
+        send_message(chat_id, message)
+
+    else:  # swipe
+        # For Swipe, it's always full payment (no surcharge)
+        current_data["sale_type"] = "cash"
+        current_data["payment_type"] = "full"
+        current_data["amount_paid"] = cart_total
+        current_data["pending_amount"] = 0
+        current_data["change_left"] = 0
+
+        user_states[chat_id] = {
+            "action": "awaiting_sale", 
+            "step": 6, 
+            "data": current_data
+        }
+        send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n✅ {payment_method.title()} payment confirmed.\n\nConfirm sale? (yes/no)")
+
+
+def _handle_sale_type(chat_id, user, db, arg):
+    """Cash sale vs credit sale for cash payments."""
+    sale_type = arg
+
+    current_state = user_states.get(chat_id, {})
+    current_data = current_state.get("data", {})
+
+    current_data["sale_type"] = sale_type
+
+    if sale_type == "cash":
+        # For cash sales, ask for amount tendered
+        current_data["payment_type"] = "full"
+        user_states[chat_id] = {
+            "action": "awaiting_sale", 
+            "step": 4, 
+            "data": current_data
+        }
+
+        cart_total = sum(item["subtotal"] for item in current_data["cart"])
+        send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n💵 Enter cash amount tendered by customer:")
+
+    else:  # credit
+        # For credit sales, ask for credit type
+        user_states[chat_id] = {
+            "action": "awaiting_sale", 
+            "step": 3.2, 
+            "data": current_data
+        }
+
+        kb_rows = [
+            [{"text": "💰 Full Credit", "callback_data": "credit_type:full"}],
+            [{"text": "📋 Partial Credit", "callback_data": "credit_type:partial"}],
+            [{"text": "⬅️ Back", "callback_data": "view_cart"}]
+        ]
+
+        cart_total = sum(item["subtotal"] for item in current_data["cart"])
+        send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n\n💳 Select credit type:", {"inline_keyboard": kb_rows})
+
+
+def _handle_credit_type(chat_id, user, db, arg):
+    """Full or partial credit."""
+    credit_type = arg
+
+    current_state = user_states.get(chat_id, {})
+    current_data = current_state.get("data", {})
+
+    current_data["payment_type"] = credit_type
+
+    if credit_type == "full":
+        # Full credit - no payment, go to customer details
+        current_data["amount_paid"] = 0
+        current_data["pending_amount"] = sum(item["subtotal"] for item in current_data["cart"])
+        current_data["change_left"] = 0
+
+        user_states[chat_id] = {
+            "action": "awaiting_sale", 
+            "step": 5, 
+            "data": current_data
+        }
+        send_message(chat_id, "🔄 Full credit sale.\n👤 Enter customer name for credit follow-up:")
+
+    else:  # partial
+        # Partial credit - ask for amount paid
+        user_states[chat_id] = {
+            "action": "awaiting_sale", 
+            "step": 4, 
+            "data": current_data
+        }
+
+        cart_total = sum(item["subtotal"] for item in current_data["cart"])
+        send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n💵 Enter amount paid now (remaining will be credit):")
+
+
+def _handle_has_change(chat_id, user, db, arg):
+    """Whether the shopkeeper has change for the customer."""
+    has_change = arg
+
+    current_state = user_states.get(chat_id, {})
+    current_data = current_state.get("data", {})
+
+    if has_change == YES:
+        # Has change - no customer details needed
+        user_states[chat_id] = {
+            "action": "awaiting_sale", 
+            "step": 6, 
+            "data": current_data
+        }
+        send_message(chat_id, "✅ Change ready. Confirm sale? (yes/no)")
+    else:
+        # No change - need customer details
+        user_states[chat_id] = {
+            "action": "awaiting_sale", 
+            "step": 5, 
+            "data": current_data
+        }
+        send_message(chat_id, "👤 Enter customer name (for change follow-up):")
+
+
+def _handle_record_payment(chat_id, user, db, arg):
+    """Start recording a credit payment or change collection."""
+    # Start payment recording flow
+    user_states[chat_id] = {"action": "record_payment", "step": 1, "data": {}}
+
+    # Ask what type of payment to record
+    kb_rows = [
+        [{"text": "💳 Credit Payment", "callback_data": "payment_type:credit"}],
+        [{"text": "🪙 Change Collection", "callback_data": "payment_type:change"}],
+        [{"text": "⬅️ Cancel", "callback_data": "back_to_menu"}]
+    ]
+
+    send_message(chat_id, "💰 *Record Payment*\n\nSelect payment type:", {"inline_keyboard": kb_rows})
+
+
+def _handle_payment_type(chat_id, user, db, arg):
+    """Choose between credit payment and change collection."""
+    payment_type = arg
+
+    current_state = user_states.get(chat_id, {})
+    current_data = current_state.get("data", {})
+    current_data["payment_type"] = payment_type
+
+    user_states[chat_id] = {"action": "record_payment", "step": 2, "data": current_data}
+
+    if payment_type == "credit":
+        send_message(chat_id, "💳 *Record Credit Payment*\n\nEnter customer name to search:")
+    else:  # change
+        send_message(chat_id, "🪙 *Record Change Collection*\n\nEnter customer name to search:")
+
+
+def _handle_select_customer_payment(chat_id, user, db, arg):
+    """Pick a customer from the payment search results."""
+    try:
+        customer_id_text, _, payment_type = arg.partition(":")
+        customer_id = int(customer_id_text)
+
+        current_state = user_states.get(chat_id, {})
+        current_data = current_state.get("data", {})
+
+        # Find the selected customer from results
+        selected_customer = None
+        for customer in current_data.get("customer_results", []):
+            if customer["customer_id"] == customer_id:
+                selected_customer = customer
+                break
+
+        if selected_customer:
+            current_data["selected_customer"] = selected_customer
+            user_states[chat_id] = {"action": "record_payment", "step": 3, "data": current_data}
+
+            if payment_type == "credit":
+                send_message(chat_id, f"👤 Selected: {selected_customer['name']}\n"
+                                     f"📞 Contact: {selected_customer['contact']}\n"
+                                     f"💳 Total Credit Due: ${selected_customer['total_pending']:.2f}\n"
+                                     f"📊 From {selected_customer['sales_count']} transaction(s)\n\n"
+                                     f"Enter amount received from customer:")
+            else:
+                send_message(chat_id, f"👤 Selected: {selected_customer['name']}\n"
+                                     f"📞 Contact: {selected_customer['contact']}\n"
+                                     f"🪙 Total Change Due: ${selected_customer['total_change']:.2f}\n"
+                                     f"📊 From {selected_customer['sales_count']} transaction(s)\n\n"
+                                     f"Enter amount of change collected from customer:")
+
+        else:
+            send_message(chat_id, "❌ Customer selection failed. Please try again.")
+            user_states.pop(chat_id, None)
+
+    except (ValueError, IndexError):
+        send_message(chat_id, "❌ Invalid customer selection.")
+        user_states.pop(chat_id, None)
+
+
+def _handle_logout(chat_id, user, db, arg):
+    """Unlink this chat from the user (soft logout)."""
+    logger.info(f"🚪 User {user.username} (chat_id={chat_id}) logging out")
+
+    # Clear user session
+    try:
+        # Clear chat_id from user record (soft logout)
+        user.chat_id = None
+        db.commit()
+        invalidate_user_cache(chat_id)
+
+        # Clear any user states
+        user_states.pop(chat_id, None)
+
+        # Send logout confirmation
+        send_message(chat_id, "✅ You have been logged out successfully.\n\nUse /start to login again.")
+
+        logger.info(f"✅ User {user.username} logged out successfully")
+
+    except Exception as e:
+        logger.error(f"❌ Error during logout: {e}")
+        send_message(chat_id, "❌ Error during logout. Please try again.")
+
+
+def _handle_help(chat_id, user, db, arg):
+    """Show help and FAQs."""
+    send_message(chat_id, HELP_TEXT, BACK_TO_MENU_JSON)
+
+
+CALLBACK_HANDLERS = {
+    "add_another_item": _handle_add_another_item,
+    "view_cart": _handle_view_cart,
+    "remove_item": _handle_remove_item,
+    "checkout_cart": _handle_checkout_cart,
+    "cancel_sale": _handle_cancel_sale,
+    "record_payment": _handle_record_payment,
+    "logout": _handle_logout,
+    "help": _handle_help,
+}
+
+# Callbacks in the elif ladder that need a tenant session up front
+TENANT_DB_ACTIONS = frozenset({"view_stock", "update_product"})
+TENANT_DB_PREFIXES = ("products_page:", "select_update:")
+
+# Callbacks of the form "<prefix>:<arg>"
+def _handle_approval(chat_id, user, db, arg, action):
+    if not arg.isdigit():
+        send_message(chat_id, "❌ Invalid approval action.")
+        return
+    if handle_approval_action(chat_id, int(arg), action):
+        send_message(chat_id, "✅ Action approved successfully!" if action == "approved" else "❌ Action rejected.")
+    else:
+        send_message(chat_id, "❌ Failed to approve action." if action == "approved" else "❌ Failed to reject action.")
+
+
+def _handle_approve_action(chat_id, user, db, arg):
+    """Owner approves a pending product add/update."""
+    _handle_approval(chat_id, user, db, arg, "approved")
+
+
+def _handle_reject_action(chat_id, user, db, arg):
+    """Owner rejects a pending product add/update."""
+    _handle_approval(chat_id, user, db, arg, "rejected")
+
+
+def _handle_stock_approval(chat_id, user, db, arg, action):
+    if not arg.isdigit():
+        send_message(chat_id, "❌ Invalid stock approval action.")
+        return
+    if handle_stock_approval_action(chat_id, int(arg), action):
+        send_message(chat_id, "✅ Stock update approved successfully!" if action == "approved" else "❌ Stock update rejected.")
+    else:
+        send_message(chat_id, "❌ Failed to approve stock update." if action == "approved" else "❌ Failed to reject stock update.")
+
+
+def _handle_approve_stock(chat_id, user, db, arg):
+    """Owner approves a pending stock update."""
+    _handle_stock_approval(chat_id, user, db, arg, "approved")
+
+
+def _handle_reject_stock(chat_id, user, db, arg):
+    """Owner rejects a pending stock update."""
+    _handle_stock_approval(chat_id, user, db, arg, "rejected")
+
+
+def _handle_view_approval(chat_id, user, db, arg):
+    """Show the details of one pending approval."""
+    if not arg.isdigit():
+        send_message(chat_id, "❌ Invalid approval ID.")
+        return
+    show_approval_details(chat_id, int(arg))
+
+
+PREFIX_HANDLERS = {
+    "remove_cart_item": _handle_remove_cart_item,
+    "payment_method": _handle_payment_method,
+    "sale_type": _handle_sale_type,
+    "credit_type": _handle_credit_type,
+    "has_change": _handle_has_change,
+    "payment_type": _handle_payment_type,
+    "select_customer_payment": _handle_select_customer_payment,
+    "approve_action": _handle_approve_action,
+    "reject_action": _handle_reject_action,
+    "view_approval": _handle_view_approval,
+    "approve_stock": _handle_approve_stock,
+    "reject_stock": _handle_reject_stock,
+}
+
+# -------------------- Conversation Step Handlers --------------------
+# Message-driven flows keyed by user_states action; each handler takes
+# (chat_id, user, db, state, t) with t the stripped message text. Actions not
+# listed here are still handled by the ladder in _handle_update.
+
+def _state_shop_user_login(chat_id, user, db, state, t):
+    """Admin/shopkeeper login: username → password → (optional) device switch."""
+    step = state.get("step", 1)
+    data = state.get("data", {})
+    tl = t.lower()
+
+    if step == 1:  # Enter Username
+        username = t
+        if not username:
+            send_message(chat_id, "❌ Username cannot be empty. Please enter your username:")
+            return
+
+        # Check if username exists and is NOT an owner (admin or shopkeeper only)
+        candidate = db.query(User).filter(
+            User.username == username,
+            User.role.in_(["admin", "shopkeeper"])  # Only allow admin/shopkeeper
+        ).first()
+
+        if not candidate:
+            send_message(chat_id, "❌ Username not found or invalid user type. Please try again:")
+            return
+
+        # Store username and move to password step
+        data["username"] = username
+        data["candidate_user_id"] = candidate.user_id
+        user_states[chat_id] = {"action": "shop_user_login", "step": 2, "data": data}
+        send_message(chat_id, "🔐 Please enter your password:")
+
+    elif step == 2:  # Enter Password
+        password = t
+        if not password:
+            send_message(chat_id, "❌ Password cannot be empty. Please enter your password:")
+            return
+
+        # Get the candidate user
+        candidate = db.get(User, data["candidate_user_id"])
+
+        if not candidate:
+            send_message(chat_id, "❌ User not found. Please start over with /start")
+            user_states.pop(chat_id, None)
+            return
+
+        # ✅ IMPORTANT: Make sure verify_password is imported
+        # Add this at the top of your file if not already there:
+        # from app.user_management import verify_password
+
+        if not verify_password(password, candidate.password_hash):
+            send_message(chat_id, "❌ Incorrect password. Please try again:")
+            return
+
+        # ✅ CRITICAL: Check if user is already logged in elsewhere
+        if candidate.chat_id and candidate.chat_id != chat_id:
+            # User is logged in from another device - ask if they want to switch
+            send_message(chat_id, "⚠️ This account is already logged in from another device. Do you want to switch to this device? (yes/no)")
+            data["existing_chat_id"] = candidate.chat_id
+            user_states[chat_id] = {"action": "shop_user_login", "step": 3, "data": data}
+            return
+
+        # ✅ Login successful - link Telegram chat_id
+        candidate.chat_id = chat_id
+        db.commit()
+        invalidate_user_cache(chat_id)
+
+        # Welcome message
+        role_display = {
+            "admin": "🛡️ Admin (Full Access)",
+            "shopkeeper": "👨‍💼 Shopkeeper (Limited Access)"
+        }
+        welcome_msg = f"✅ Login successful! Welcome, {candidate.name}.\n"
+        welcome_msg += f"👤 Role: {role_display.get(candidate.role, candidate.role)}"
+
+        # Add shop info if available
+        if candidate.shop_name:
+            welcome_msg += f"\n🏪 Shop: {candidate.shop_name}"
+
+        send_message(chat_id, welcome_msg)
+        user_states.pop(chat_id, None)
+
+        # Show role-based menu
+        kb = role_menu_keyboard(candidate.role)
+        send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
+
+    elif step == 3:  # Handle switching devices
+        confirmation = tl
+        if confirmation == YES:
+            # Get candidate again
+            candidate = db.get(User, data["candidate_user_id"])
+            if candidate:
+                # Switch chat_id to current device
+                candidate.chat_id = chat_id
+                db.commit()
+                invalidate_user_cache(chat_id)
+                invalidate_user_cache(data.get("existing_chat_id"))
+
+                send_message(chat_id, "✅ Device switched successfully!")
+
+                # Show role-based menu
+                kb = role_menu_keyboard(candidate.role)
+                send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
+            else:
+                send_message(chat_id, "❌ User not found. Please start over.")
+        else:
+            send_message(chat_id, "❌ Login cancelled. Account remains on previous device.")
+
+        user_states.pop(chat_id, None)
+
+
+STATE_HANDLERS = {
+    "shop_user_login": _state_shop_user_login,
+}
+
+
+# -------------------- Sale Wizard Steps --------------------
+# Message-driven awaiting_sale steps after checkout, keyed by step; each
+# handler takes (chat_id, user, tenant_db, state, data, t). Steps 1-3 and
+# the callback-driven ones (3.1, 3.2, 4.1) stay in _handle_update.
+
+def _sale_step_amount(chat_id, user, tenant_db, state, data, t):
+    """Step 4: amount tendered."""
+    amount_text = t
+    if not amount_text:
+        send_message(chat_id, "❌ Amount cannot be empty. Please enter a valid amount:")
+        return
+    if not _DEC_RE.fullmatch(amount_text):
+        send_message(chat_id, "❌ Invalid number. Enter a valid amount:")
+        return
+    try:
+        amount_paid = float(amount_text)
+        if amount_paid < 0:
+            send_message(chat_id, "❌ Amount cannot be negative. Please enter a valid amount:")
+            return
+
+        # Calculate cart_total from cart
+        cart_total = sum(item["subtotal"] for item in data["cart"])
+
+        data["amount_paid"] = amount_paid
+        data["cart_total"] = cart_total
+
+        # Calculate based on sale type
+        if data.get("sale_type") == "credit":
+            # Credit sale with partial payment
+            data["pending_amount"] = max(cart_total - amount_paid, 0)
+            data["change_left"] = 0  # No change for credit sales
+
+            # Always ask for customer details for credit sales
+            state["step"] = 5
+            send_message(chat_id, f"📋 Partial credit sale.\nAmount paid: ${amount_paid:.2f}\nPending: ${data['pending_amount']:.2f}\n\n👤 Enter customer name:")
+
+        else:  # cash sale
+            data["pending_amount"] = 0
+            data["change_left"] = max(amount_paid - cart_total, 0)
+
+            # Show payment summary
+            summary_msg = f"💵 Payment Summary:\n"
+            summary_msg += get_cart_summary(data["cart"])
+            summary_msg += f"💰 Total: ${cart_total:.2f}\n"
+            summary_msg += f"💵 Tendered: ${amount_paid:.2f}\n"
+
+            if data["change_left"] > 0:
+                summary_msg += f"🪙 Change Due: ${data['change_left']:.2f}\n\n"
+                # Ask if shopkeeper has change
+                kb_rows = [
+                    [{"text": "✅ Yes, I have change", "callback_data": "has_change:yes"}],
+                    [{"text": "❌ No, need customer details", "callback_data": "has_change:no"}]
+                ]
+                summary_msg += "Do you have change for the customer?"
+                send_message(chat_id, summary_msg, {"inline_keyboard": kb_rows})
+                state["step"] = 4.1
+            else:
+                # No change due - go straight to confirmation
+                summary_msg += "✅ Exact amount received.\n\nConfirm sale? (yes/no)"
+                state["step"] = 6
+                logger.info(f"🔍 STEP 4 → STEP 6 - No change due, awaiting confirmation. Chat: {chat_id}, Customer Name: {data.get('customer_name')}")
+                send_message(chat_id, summary_msg)
+
+    except ValueError:
+        send_message(chat_id, "❌ Invalid number. Enter a valid amount:")
+
+
+def _sale_step_customer_name(chat_id, user, tenant_db, state, data, t):
+    """Step 5: customer name (only for credit sales or change due)."""
+    customer_name = t
+    if not customer_name:
+        send_message(chat_id, "❌ Customer name cannot be empty. Please enter customer name:")
+        return
+
+    data["customer_name"] = customer_name
+
+    # FIXED: Always go to step 6 for contact collection
+    # Whether it's credit sale or change due, we should collect contact
+    state["step"] = 6
+
+    # Ask for contact (optional)
+    if data.get("sale_type") == "credit":
+        send_message(chat_id, "📞 Enter customer contact number (optional for credit follow-up) or type 'skip':")
+    else:
+        send_message(chat_id, "📞 Enter customer contact number (optional for change follow-up) or type 'skip':")
+
+
+def _sale_step_customer_contact(chat_id, user, tenant_db, state, data, t):
+    """Steps 5.1 / 6: optional customer contact - never records the sale."""
+    logger.info(f"🔍 STEP 6 ENTERED - Collecting contact - Chat: {chat_id}, Text: '{t}'")
+
+    # This should ONLY be for collecting customer contact
+    customer_contact = t
+
+    # Handle "skip" for optional contact
+    if customer_contact.lower() == "skip":
+        customer_contact = ""
+
+    data["customer_contact"] = customer_contact
+    state["step"] = 7
+
+    # Now ask for confirmation
+    send_message(chat_id, f"✅ Customer info recorded. Confirm sale? (yes/no)")
+
+
+def _sale_step_confirm(chat_id, user, tenant_db, state, data, t):
+    """Step 7: final confirmation - the only step that records the sale."""
+    tl = t.lower()
+    logger.info(f"🔍 STEP 7 ENTERED - Final confirmation - Chat: {chat_id}, Text: '{t}'")
+
+    if not tl:
+        send_message(chat_id, "⚠️ Please confirm with 'yes' or 'no':")
+        return
+
+    _finalize_sale(tenant_db, chat_id, user, tl, data)
+
+
+SALE_STEP_HANDLERS = {
+    4: _sale_step_amount,
+    5: _sale_step_customer_name,
+    5.1: _sale_step_customer_contact,
+    6: _sale_step_customer_contact,
+    7: _sale_step_confirm,
+}
+
+
+# -------------------- Webhook --------------------
+# Updates are acknowledged straight away and processed after the response
+# is sent, so Telegram never waits on DB work or outbound messages.
+# A fixed array of locks striped by chat_id: bounded memory however many
+# chats write in; two chats sharing a stripe only queue behind each other.
+CHAT_LOCK_STRIPES = 256
+_chat_locks = [threading.Lock() for _ in range(CHAT_LOCK_STRIPES)]
+
+# With several workers the same chat can land on two processes at once; a
+# Redis lock keeps their hydrate -> handle -> flush cycles from
+# interleaving and overwriting each other's conversation state. The TTL
+# only matters if the worker dies: while a handler runs, the renewer
+# thread below keeps resetting it, however long the handler takes.
+CHAT_LOCK_PREFIX = f"{BOT_KEY_PREFIX}lock:"
+CHAT_LOCK_TTL = 30          # seconds; reset every TTL/3 while held
+CHAT_LOCK_WAIT = 10         # seconds to wait for another worker
+CHAT_LOCK_RETRIES = 3       # re-queues before an update is dropped
+CHAT_LOCK_RETRY_DELAY = 2   # seconds between re-queues
+
+_chat_lock_renewer = LockRenewer(CHAT_LOCK_TTL / 3)
+
+
+class ChatLockBusy(Exception):
+    """The cross-worker lock for a chat could not be taken."""
+
+
+if _redis is not None:
+    _chat_lock_renewer.start(name="chat-lock-renewer")
+
+
+@contextmanager
+def _chat_lock(chat_id):
+    """
+    Serialize updates for one chat within this process and, with Redis,
+    across workers. Raises ChatLockBusy rather than running the update
+    unlocked when the Redis lock can't be taken.
+    """
+    with _chat_locks[hash(chat_id) % CHAT_LOCK_STRIPES]:
+        if _redis is None or chat_id is None:
+            yield
+            return
+        # thread_local=False: the renewer thread reacquires with this token
+        lock = _redis.lock(
+            f"{CHAT_LOCK_PREFIX}{chat_id}", timeout=CHAT_LOCK_TTL,
+            blocking_timeout=CHAT_LOCK_WAIT, thread_local=False,
+        )
+        try:
+            acquired = lock.acquire()
+        except Exception as e:
+            raise ChatLockBusy(f"chat lock unavailable: {e}") from e
+        if not acquired:
+            raise ChatLockBusy("chat lock held by another worker")
+        _chat_lock_renewer.add(lock)
+        try:
+            yield
+        finally:
+            _chat_lock_renewer.discard(lock)
+            try:
+                lock.release()
+            except Exception as e:
+                logger.warning(f"⚠️ Could not release chat lock for {chat_id}: {e}")
+
+# Telegram redelivers an update it thinks failed; remember recent update_ids
+# long enough to cover its retry window.
+UPDATE_DEDUP_TTL = 120
+UPDATE_DEDUP_PREFIX = f"{BOT_KEY_PREFIX}upd:"
+seen_updates = TTLDict(ttl=UPDATE_DEDUP_TTL)
+_seen_updates_lock = threading.Lock()
+
+
+def _first_delivery(update_id):
+    """True the first time an update_id is seen, False for redeliveries."""
+    if update_id is None:
+        return True
+    if _redis is not None:
+        try:
+            return bool(_redis.set(f"{UPDATE_DEDUP_PREFIX}{update_id}", 1, nx=True, ex=UPDATE_DEDUP_TTL))
+        except Exception as e:
+            logger.warning(f"⚠️ Update dedup via Redis failed, using local check: {e}")
+    with _seen_updates_lock:
+        if update_id in seen_updates:
+            return False
+        seen_updates[update_id] = True
+        return True
+
+
+@router.post("/telegram/webhook")
+async def telegram_webhook(request: Request, background_tasks: BackgroundTasks):
+    data = orjson.loads(await request.body())
+    # Stop the button spinner before any processing (or lock waiting) happens
+    callback_query = data.get("callback_query")
+    if callback_query and "id" in callback_query:
+        answer_callback_query(callback_query["id"])
+    background_tasks.add_task(process_update, data)
+    return {"ok": True}
+
+
+def process_update(data):
+    """
+    Run one Telegram update through the bot (threadpool, after the ack).
+    Updates from the same chat are serialized so conversation state
+    is never stepped by two updates at once.
+    """
+    if not _first_delivery(data.get("update_id")):
+        logger.info(f"🔁 Skipping duplicate update {data.get('update_id')}")
+        return None
+    return _run_update(data, defer_text=True)
+
+
+def _run_update(data, defer_text=False, attempt=0, pending=None):
+    """
+    Handle one update under its chat lock. pending is set when a debounce
+    timer replays buffered free text: (action, step, token) it was armed for.
+    """
+    message = data.get("message") or (data.get("callback_query") or {}).get("message") or {}
+    chat_id = message.get("chat", {}).get("id")
+
+    db = SessionLocal()
+    try:
+        with _chat_lock(chat_id):
+            if chat_id is None:
+                return _handle_update(data, db)
+            # Pick up state another worker may have written, and share ours after
+            user_states.hydrate(chat_id)
+            try:
+                if pending is not None:
+                    data = _take_pending_text(chat_id, data, pending)
+                    if data is None:
+                        return None
+                elif defer_text and _defer_free_text(chat_id, data):
+                    return None
+                return _handle_update(data, db)
+            finally:
+                user_states.flush(chat_id)
+    except ChatLockBusy as e:
+        _requeue_update(data, defer_text, attempt, chat_id, e, pending)
+        return None
+    finally:
+        db.close()
+
+
+def _requeue_update(data, defer_text, attempt, chat_id, reason, pending=None):
+    """Retry an update whose chat lock was busy, or drop it after the last try."""
+    update_id = data.get("update_id")
+    if attempt >= CHAT_LOCK_RETRIES:
+        logger.error(f"❌ Dropping update {update_id} for {chat_id} after {attempt} retries: {reason}")
+        return
+    logger.warning(f"⏳ Re-queuing update {update_id} for {chat_id} ({reason})")
+    timer = threading.Timer(
+        CHAT_LOCK_RETRY_DELAY, _run_update,
+        args=(data, defer_text), kwargs={"attempt": attempt + 1, "pending": pending},
+    )
+    timer.daemon = True
+    timer.start()
+
+
+# -------------------- Free-text Debounce --------------------
+# In the shop / product setup flows users often split an answer over two
+# messages, or send a correction a second later. Hold free-text input
+# briefly and act once on the merged text, instead of advancing (and
+# committing) once per message. The buffer lives in the chat's own state,
+# so it is shared through Redis and only touched under the chat lock; the
+# timer replays it through _run_update like any other update.
+DEBOUNCE_SECONDS = 1.5
+DEBOUNCED_STEPS = {
+    "setup_shop": {1, 2, 3},      # name, location, contact
+    "add_shop": {1, 2, 3},        # name, location, contact
+    "awaiting_product": {1},      # product name
+}
+# Steps that take a single value: a later message is a correction and
+# replaces the earlier one ("Sugr" then "Sugar" saves "Sugar")
+LAST_LINE_STEPS = {
+    ("setup_shop", 1), ("setup_shop", 3),
+    ("add_shop", 1), ("add_shop", 3),
+    ("awaiting_product", 1),
+}
+
+
+def _defer_free_text(chat_id, data):
+    """Buffer a free-text answer in the chat state; returns True if the update was deferred."""
+    text = (data.get("message") or {}).get("text", "").strip()
+    if not text or text.startswith("/"):
+        return False
+
+    state = user_states.get(chat_id)
+    if not state or state.get("step") not in DEBOUNCED_STEPS.get(state.get("action"), ()):
+        return False
+
+    state.setdefault("pending_text", []).append(text)
+    state["pending_token"] = token = secrets.token_hex(4)
+    user_states[chat_id] = state
+
+    # Only the timer armed by the latest message replays; older ones see a stale token
+    timer = threading.Timer(
+        DEBOUNCE_SECONDS, _run_update,
+        args=(data,), kwargs={"pending": (state["action"], state["step"], token)},
+    )
+    timer.daemon = True
+    timer.start()
+    return True
+
+
+def _take_pending_text(chat_id, data, pending):
+    """
+    Pop the chat's buffered text and return data carrying the merged text,
+    or None if the buffer is gone, a newer message re-armed it, or the
+    conversation has moved to another step since.
+    """
+    state = user_states.get(chat_id)
+    action, step, token = pending
+    if not state or state.get("pending_token") != token:
+        return None
+    texts = state.pop("pending_text", [])
+    state.pop("pending_token", None)
+    user_states[chat_id] = state
+    if not texts or state.get("action") != action or state.get("step") != step:
+        return None
+
+    if (action, step) in LAST_LINE_STEPS:
+        merged = texts[-1]
+    else:
+        # Free-form answers (the location) sent in pieces keep one per line
+        merged = "\n".join(texts)
+    message = dict(data["message"], text=merged)
+    return dict(data, message=message)
+
+
+def _handle_update(data, db):
+    tenant_db = None  # closed in finally whichever branch opened it
+    try:
+        logger.debug("📩 Incoming Telegram update id=%s", data.get("update_id"))
+
+        chat_id = None
+        text = ""
+        update_type = None
+        
+        # Determine the update type
+        if "message" in data:
+            chat_id = data["message"]["chat"]["id"]
+            text = data["message"].get("text", "").strip()
+            update_type = "message"
+        elif "callback_query" in data:
+            chat_id = data["callback_query"]["message"]["chat"]["id"]
+            text = data["callback_query"]["data"]
+            update_type = "callback"
+
+        if not chat_id:
             return {"ok": True}
 
-        # 1. Get user from central DB
-        user = db.query(User).filter(User.chat_id == chat_id).first()
+        # 1. Get user from central DB (cached per chat)
+        user = get_user_by_chat(chat_id, db)
 
         # 🔍 DEBUG: Log user info
         if user:
-            print(f"🔍 DEBUG: User found - ID: {user.user_id}, Username: {user.username}, Role: {user.role}, Tenant Schema: {user.tenant_schema}")
+            logger.debug("🔍 DEBUG: User found - ID: %s, Username: %s, Role: %s, Tenant Schema: %s", user.user_id, user.username, user.role, user.tenant_schema)
         else:
-            print(f"🔍 DEBUG: No user found for chat_id: {chat_id}")
+            logger.debug("🔍 DEBUG: No user found for chat_id: %s", chat_id)
 
         # ✅ SECURITY: Fix schema assignment ONLY for owners
         if user and user.role == "owner" and user.tenant_schema:
@@ -2446,15 +3841,15 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                     schema_name = create_tenant_db(chat_id, user.role)
                     user.tenant_schema = schema_name
                     db.commit()
+                    invalidate_user_cache(chat_id)
                     logger.info(f"✅ Security fix: {user.username} → {schema_name}")
             
                     # Verify connection
-                    tenant_db = get_tenant_session(schema_name, chat_id)
-                    if tenant_db:
-                        product_count = tenant_db.query(ProductORM).count()
-                        if product_count > 0:
-                            logger.warning(f"⚠️ Found {product_count} products in corrected schema")
-                        tenant_db.close()
+                    with tenant_session(schema_name, chat_id) as check_db:
+                        if check_db:
+                            product_count = check_db.query(ProductORM).count()
+                            if product_count > 0:
+                                logger.warning(f"⚠️ Found {product_count} products in corrected schema")
                 except Exception as e:
                     logger.error(f"❌ Security fix failed: {e}")
                         
@@ -2467,14 +3862,14 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                 user_type = text.split(":")[1]
         
                 if user_type == "owner":
-                    print(f"🔍 DEBUG [user_type:owner]: Starting owner creation for chat_id={chat_id}")
+                    logger.debug("🔍 DEBUG [user_type:owner]: Starting owner creation for chat_id=%s", chat_id)
                     
                     # Create new owner with generated credentials
                     generated_username = create_username(f"Owner{chat_id}")
                     from app.user_management import generate_password, hash_password
                     generated_password = generate_password()
                     generated_email = f"{chat_id}_{int(time.time())}@example.com"
-                    print(f"🔍 DEBUG: Generated username: {generated_username}")
+                    logger.debug("🔍 DEBUG: Generated username: %s", generated_username)
 
                     new_user = User(
                         name=f"Owner{chat_id}",
@@ -2486,43 +3881,24 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                     )
                     db.add(new_user)
                     db.commit()
-                    db.refresh(new_user)
-                    print(f"🔍 DEBUG: User created with ID: {new_user.user_id}")
+                    logger.debug("🔍 DEBUG: User created for chat_id: %s", chat_id)
 
-                    # Create tenant schema
-                    try:
-                        schema_name, _ = create_tenant_db(chat_id)
-                        print(f"🔍 DEBUG: Creating tenant schema: {schema_name}")
-                        new_user.tenant_schema = schema_name
-                        db.commit()
-                        logger.info(f"✅ New owner created: {generated_username} with schema '{schema_name}'")
-                        print(f"🔍 DEBUG: Tenant schema created and linked")
-                    except Exception as e:
-                        logger.error(f"❌ Failed to create tenant schema: {e}")
-                        send_message(chat_id, "❌ Could not initialize store database.")
-                        return {"ok": True}
-
-                    # DEBUG: Test send_message directly
-                    print(f"🔍 DEBUG: Testing send_message...")
-                    try:
-                        send_message(chat_id, "🔍 DEBUG: Test message from bot")
-                        print(f"🔍 DEBUG: Test message sent successfully")
-                    except Exception as e:
-                        print(f"❌ ERROR in send_message test: {e}")
-                        import traceback
-                        traceback.print_exc()
+                    # Create tenant schema in the background while the owner
+                    # enters shop details; setup_shop step 3 waits for it
+                    provision_tenant(chat_id)
+                    logger.info(f"✅ New owner created: {generated_username}, provisioning tenant schema")
 
                     # Send credentials and start shop setup
-                    print(f"🔍 DEBUG: Calling send_owner_credentials...")
+                    logger.debug("🔍 DEBUG: Calling send_owner_credentials...")
                     send_owner_credentials(chat_id, generated_username, generated_password)
-                    print(f"🔍 DEBUG: Credentials function called")
+                    logger.debug("🔍 DEBUG: Credentials function called")
                     
-                    print(f"🔍 DEBUG: Sending shop setup prompt...")
+                    logger.debug("🔍 DEBUG: Sending shop setup prompt...")
                     send_message(chat_id, "🏪 Let's set up your shop! Please enter the shop name:")
-                    print(f"🔍 DEBUG: Shop setup prompt sent")
+                    logger.debug("🔍 DEBUG: Shop setup prompt sent")
                     
                     user_states[chat_id] = {"action": "setup_shop", "step": 1, "data": {}}
-                    print(f"🔍 DEBUG: user_state set: setup_shop")
+                    logger.debug("🔍 DEBUG: user_state set: setup_shop")
                     
                 else:  # shopkeeper
                     # Step-by-step shopkeeper login
@@ -2538,12 +3914,28 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                 return {"ok": True}
 
             role = user.role
+
+            # -------------------- Tenant DB for data callbacks --------------------
+            # These callbacks all need the tenant session; open it once and
+            # bounce early instead of checking in every branch.
+            if text in TENANT_DB_ACTIONS or text.startswith(TENANT_DB_PREFIXES):
+                tenant_db = get_tenant_session(user.tenant_schema, chat_id)
+                if tenant_db is None:
+                    send_message(chat_id, "⚠️ Tenant database not linked. Please restart with /start.")
+                    return {"ok": True}
+
+            # -------------------- Table-driven callbacks --------------------
+            prefix, sep, arg = text.partition(":")
+            handler = PREFIX_HANDLERS.get(prefix) if sep else CALLBACK_HANDLERS.get(text)
+            if handler:
+                handler(chat_id, user, db, arg)
+                return {"ok": True}
     
             # -------------------- Cancel button --------------------
             if text == "back_to_menu":
                 user_states.pop(chat_id, None)
-                kb_dict = main_menu(role)
-                send_message(chat_id, "🏠 Main Menu:", kb_dict)
+                kb = MAIN_MENU_JSON_BY_ROLE.get(role) or main_menu(role)
+                send_message(chat_id, "🏠 Main Menu:", kb)
                 return {"ok": True}
 
             # -------------------- Unified Shop Management (Owner only) --------------------
@@ -2725,7 +4117,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         send_message(chat_id, "❌ Unable to access store database.")
                         return {"ok": True}
         
-                    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                    shop = tenant_db.get(ShopORM, shop_id)
                     if not shop:
                         send_message(chat_id, "❌ Shop not found.")
                         tenant_db.close()
@@ -2800,6 +4192,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                     new_password = reset_shop_user_password(db, username)
         
                     if new_password:
+                        invalidate_user_cache_for_username(db, username)
                         success_msg = (
                             f"✅ *Password Reset Successful*\n\n"
                             f"👤 **Username:** `{username}`\n"
@@ -2918,152 +4311,16 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                     shop_id = int(text.split(":")[1])
         
                     # Get shop info
-                    tenant_db = get_tenant_session(user.tenant_schema, chat_id)
-                    if not tenant_db:
-                        send_message(chat_id, "❌ Unable to access store database.")
-                        return {"ok": True}
-        
-                    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
-                    if not shop:
-                        send_message(chat_id, "❌ Shop not found.")
-                        tenant_db.close()
-                        return {"ok": True}
-        
-                    # Get users for this shop
-                    shop_users = db.query(User).filter(
-                        User.shop_id == shop_id,
-                        User.role.in_(["admin", "shopkeeper"])
-                    ).all()
-        
-                    tenant_db.close()
-        
-                    # Build message
-                    message = f"🏪 *{shop.name} - User Management*\n\n"
-        
-                    if not shop_users:
-                        message += "No users created for this shop yet.\n\n"
-                    else:
-                        message += f"**Users ({len(shop_users)}):**\n"
-                        for i, shop_user in enumerate(shop_users, 1):
-                            role_icon = "🛡️" if shop_user.role == 'admin' else "👨‍💼"
-                            status = "✅" if shop_user.chat_id else "❌"
-                            message += f"{i}. {role_icon} `{shop_user.username}` ({shop_user.role}) {status}\n"
-                        message += "\n✅ = Telegram linked\n❌ = Not linked yet\n\n"
-        
-                    # Create management buttons
-                    kb_rows = [
-                        [{"text": "➕ Create New User", "callback_data": f"create_user_for_shop:{shop_id}"}],
-                        [{"text": "🔄 Reset Password", "callback_data": f"reset_user_password:{shop_id}"}],
-                        [{"text": "🗑 Delete User", "callback_data": f"delete_shop_user:{shop_id}"}],
-                        [{"text": "🔙 Back to Shop List", "callback_data": "manage_users"}]
-                    ]
-        
-                    send_message(chat_id, message, {"inline_keyboard": kb_rows})
-        
-                except Exception as e:
-                    logger.error(f"❌ Error managing shop users: {e}")
-                    send_message(chat_id, "❌ Error loading shop users.")
-    
-                return {"ok": True}
-    
-            elif text.startswith("create_user_for_shop:") and role == "owner":
-                try:
-                    shop_id = int(text.split(":")[1])
-        
-                    # Get shop info
-                    tenant_db = get_tenant_session(user.tenant_schema, chat_id)
-                    if not tenant_db:
-                        send_message(chat_id, "❌ Unable to access store database.")
-                        return {"ok": True}
-        
-                    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
-                    if not shop:
-                        send_message(chat_id, "❌ Shop not found.")
-                        tenant_db.close()
-                        return {"ok": True}
-        
-                    tenant_db.close()
-        
-                    # Start user creation flow
-                    user_states[chat_id] = {
-                        "action": "create_user_for_shop",
-                        "step": 1,
-                        "data": {
-                            "shop_id": shop_id,
-                            "shop_name": shop.name
-                        }
-                    }
-        
-                    send_message(chat_id, f"👤 *Create User for {shop.name}*\n\nEnter username for the new user:")
-        
-                except Exception as e:
-                    logger.error(f"❌ Error creating user: {e}")
-                    send_message(chat_id, "❌ Error starting user creation.")
-    
-                return {"ok": True}
-    
-            elif text.startswith("reset_user_password:") and role == "owner":
-                try:
-                    shop_id = int(text.split(":")[1])
-        
-                    # Get users for this shop
-                    shop_users = db.query(User).filter(
-                        User.shop_id == shop_id,
-                        User.role.in_(["admin", "shopkeeper"])
-                    ).all()
-        
-                    if not shop_users:
-                        send_message(chat_id, "❌ No users found for this shop.")
-                        return {"ok": True}
-        
-                    # Create user selection keyboard
-                    kb_rows = []
-                    for shop_user in shop_users:
-                        role_icon = "🛡️" if shop_user.role == 'admin' else "👨‍💼"
-                        kb_rows.append([{
-                            "text": f"{role_icon} Reset: {shop_user.username} ({shop_user.role})",
-                            "callback_data": f"reset_password_for:{shop_user.username}"
-                        }])
-        
-                    kb_rows.append([{"text": "🔙 Back", "callback_data": f"manage_shop_users:{shop_id}"}])
-        
-                    send_message(chat_id, "👤 Select user to reset password:", {"inline_keyboard": kb_rows})
-        
-                except Exception as e:
-                    logger.error(f"❌ Error resetting password: {e}")
-                    send_message(chat_id, "❌ Error resetting password.")
-    
-                return {"ok": True}
-    
-            elif text.startswith("reset_password_for:") and role == "owner":
-                try:
-                    username = text.split(":")[1]
-        
-                    # Reset password
-                    from app.user_management import reset_user_password
-                    new_password = reset_user_password(username)
-        
-                    if new_password:
-                        # Get user info
-                        target_user = db.query(User).filter(User.username == username).first()
-            
-                        # Format credentials message
-                        from app.user_management import format_user_credentials_message
-                        credentials_msg = format_user_credentials_message(target_user, new_password, target_user.role)
-            
-                        send_message(chat_id, credentials_msg)
-                    else:
-                        send_message(chat_id, f"❌ Failed to reset password for {username}")
-        
-                except Exception as e:
-                    logger.error(f"❌ Error resetting password: {e}")
-                    send_message(chat_id, "❌ Error resetting password.")
-    
-                return {"ok": True}
-    
-            elif text.startswith("delete_shop_user:") and role == "owner":
-                try:
-                    shop_id = int(text.split(":")[1])
+                    tenant_db = get_tenant_session(user.tenant_schema, chat_id)
+                    if not tenant_db:
+                        send_message(chat_id, "❌ Unable to access store database.")
+                        return {"ok": True}
+        
+                    shop = tenant_db.get(ShopORM, shop_id)
+                    if not shop:
+                        send_message(chat_id, "❌ Shop not found.")
+                        tenant_db.close()
+                        return {"ok": True}
         
                     # Get users for this shop
                     shop_users = db.query(User).filter(
@@ -3071,44 +4328,34 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         User.role.in_(["admin", "shopkeeper"])
                     ).all()
         
-                    if not shop_users:
-                        send_message(chat_id, "❌ No users found for this shop.")
-                        return {"ok": True}
-        
-                    # Create user selection keyboard
-                    kb_rows = []
-                    for shop_user in shop_users:
-                        role_icon = "🛡️" if shop_user.role == 'admin' else "👨‍💼"
-                        kb_rows.append([{
-                            "text": f"{role_icon} Delete: {shop_user.username} ({shop_user.role})",
-                            "callback_data": f"delete_user:{shop_user.username}"
-                        }])
-        
-                    kb_rows.append([{"text": "🔙 Back", "callback_data": f"manage_shop_users:{shop_id}"}])
+                    tenant_db.close()
         
-                    send_message(chat_id, "⚠️ Select user to DELETE (cannot be undone):", {"inline_keyboard": kb_rows})
+                    # Build message
+                    message = f"🏪 *{shop.name} - User Management*\n\n"
         
-                except Exception as e:
-                    logger.error(f"❌ Error deleting user: {e}")
-                    send_message(chat_id, "❌ Error deleting user.")
-    
-                return {"ok": True}
-    
-            elif text.startswith("delete_user:") and role == "owner":
-                try:
-                    username = text.split(":")[1]
+                    if not shop_users:
+                        message += "No users created for this shop yet.\n\n"
+                    else:
+                        message += f"**Users ({len(shop_users)}):**\n"
+                        for i, shop_user in enumerate(shop_users, 1):
+                            role_icon = "🛡️" if shop_user.role == 'admin' else "👨‍💼"
+                            status = "✅" if shop_user.chat_id else "❌"
+                            message += f"{i}. {role_icon} `{shop_user.username}` ({shop_user.role}) {status}\n"
+                        message += "\n✅ = Telegram linked\n❌ = Not linked yet\n\n"
         
-                    # Confirm deletion
-                    user_states[chat_id] = {
-                        "action": "confirm_delete_user",
-                        "data": {"username": username}
-                    }
+                    # Create management buttons
+                    kb_rows = [
+                        [{"text": "➕ Create New User", "callback_data": f"create_user_for_shop:{shop_id}"}],
+                        [{"text": "🔄 Reset Password", "callback_data": f"reset_user_password:{shop_id}"}],
+                        [{"text": "🗑 Delete User", "callback_data": f"delete_shop_user:{shop_id}"}],
+                        [{"text": "🔙 Back to Shop List", "callback_data": "manage_users"}]
+                    ]
         
-                    send_message(chat_id, f"⚠️ **Confirm Deletion**\n\nDelete user `{username}`?\n\nType 'YES' to confirm or 'NO' to cancel:")
+                    send_message(chat_id, message, {"inline_keyboard": kb_rows})
         
                 except Exception as e:
-                    logger.error(f"❌ Error deleting user: {e}")
-                    send_message(chat_id, "❌ Error deleting user.")
+                    logger.error(f"❌ Error managing shop users: {e}")
+                    send_message(chat_id, "❌ Error loading shop users.")
     
                 return {"ok": True}
     
@@ -3199,9 +4446,10 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
     
                 # Reset password
                 from app.user_management import reset_user_password
-                new_password = reset_user_password(username)
+                new_password = reset_user_password(db, username)
     
                 if new_password:
+                    invalidate_user_cache_for_username(db, username)
                     # Get user info
                     target_user = db.query(User).filter(
                         User.username == username,
@@ -3301,7 +4549,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                 if recent_sales:
                     dashboard_msg += f"\n📈 **Recent Sales:**\n"
                     for sale in recent_sales:
-                        product = tenant_db.query(ProductORM).filter(ProductORM.product_id == sale.product_id).first()
+                        product = tenant_db.get(ProductORM, sale.product_id)
                         product_name = product.name if product else f"Product {sale.product_id}"
                         dashboard_msg += f"• {product_name}: ${sale.total_amount:.2f}\n"
     
@@ -3335,7 +4583,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
         
                     # Get admin's assigned shop
                     tenant_db = get_tenant_session(user.tenant_schema, chat_id)
-                    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == user.shop_id).first()
+                    shop = tenant_db.get(ShopORM, user.shop_id)
                     tenant_db.close()
         
                     if not shop:
@@ -3385,7 +4633,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         send_message(chat_id, "❌ Unable to access store database.")
                         return {"ok": True}
         
-                    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                    shop = tenant_db.get(ShopORM, shop_id)
                     tenant_db.close()
         
                     if shop:
@@ -3403,45 +4651,13 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
     
                 return {"ok": True}
         
-            # -------------------- Approval Callbacks --------------------
-            elif text.startswith("approve_action:"):
-                try:
-                    approval_id = int(text.split(":")[1])
-                    # Handle approval logic
-                    if handle_approval_action(chat_id, approval_id, "approved"):
-                        send_message(chat_id, "✅ Action approved successfully!")
-                    else:
-                        send_message(chat_id, "❌ Failed to approve action.")
-                except (ValueError, IndexError):
-                    send_message(chat_id, "❌ Invalid approval action.")
-
-            elif text.startswith("reject_action:"):
-                try:
-                    approval_id = int(text.split(":")[1])
-                    # Handle rejection logic
-                    if handle_approval_action(chat_id, approval_id, "rejected"):
-                        send_message(chat_id, "❌ Action rejected.")
-                    else:
-                        send_message(chat_id, "❌ Failed to reject action.")
-                except (ValueError, IndexError):
-                    send_message(chat_id, "❌ Invalid rejection action.")
-
-            elif text.startswith("view_approval:"):
-                try:
-                    approval_id = int(text.split(":")[1])
-                    # Show approval details
-                    show_approval_details(chat_id, approval_id)
-                except (ValueError, IndexError):
-                    send_message(chat_id, "❌ Invalid approval ID.")
-                return {"ok": True}  # ← ADD THIS LINE
-            
             # ==================== INLINE CONFIRMATION HANDLERS ====================
             
             # ✅ Handle delete confirmation from inline buttons
             elif text.startswith("confirm_delete_"):
                 confirmation = text.split("_")[-1]  # "yes" or "no"
                 
-                if confirmation == "yes":
+                if confirmation == YES:
                     # Get current state to find username
                     current_state = user_states.get(chat_id, {})
                     username = current_state.get("data", {}).get("username")
@@ -3452,7 +4668,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         return {"ok": True}
                     
                     # Get admin user to verify shop assignment
-                    admin_user = db.query(User).filter(User.chat_id == chat_id).first()
+                    admin_user = user  # already loaded for this chat
                     if not admin_user or admin_user.role != 'admin':
                         send_message(chat_id, "❌ Unauthorized: Admin access required.")
                         user_states.pop(chat_id, None)
@@ -3468,9 +4684,12 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         ).first()
                         
                         if shopkeeper:
-                            # Delete the shopkeeper
+                            # Delete the shopkeeper; drop its cached row only once the
+                            # delete is committed so a concurrent lookup can't re-cache it
+                            shopkeeper_chat_id = shopkeeper.chat_id
                             db.delete(shopkeeper)
                             db.commit()
+                            invalidate_user_cache(shopkeeper_chat_id)
                             
                             send_message(chat_id, f"✅ Shopkeeper `{username}` has been successfully deleted!")
                         else:
@@ -3560,7 +4779,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         user_states[chat_id] = {"action": "quick_stock_update", "step": 2, "data": current_data}
             
                         # Get shop name for message
-                        shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                        shop = tenant_db.get(ShopORM, shop_id)
                         shop_name = shop.name if shop else f"Shop {shop_id}"
             
                         send_message(chat_id, f"📦 Selected: {selected_product['name']}\n🏪 Shop: {shop_name}\n📊 Current stock: {current_stock}\n\nEnter quantity to ADD to stock:")
@@ -3589,7 +4808,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         return {"ok": True}
         
                     # Get shop info
-                    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                    shop = tenant_db.get(ShopORM, shop_id)
                     if not shop:
                         send_message(chat_id, "❌ Shop not found.")
                         user_states.pop(chat_id, None)
@@ -3645,31 +4864,10 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
             elif text == "cancel_quick_stock":
                 user_states.pop(chat_id, None)
                 send_message(chat_id, "❌ Quick stock update cancelled.")
-                from app.user_management import get_role_based_menu
-                kb = get_role_based_menu(user.role)
+                kb = role_menu_keyboard(user.role)
                 send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
                 return {"ok": True}
                     
-            elif text.startswith("approve_stock:"):
-                try:
-                    approval_id = int(text.split(":")[1])
-                    if handle_stock_approval_action(chat_id, approval_id, "approved"):
-                        send_message(chat_id, "✅ Stock update approved successfully!")
-                    else:
-                        send_message(chat_id, "❌ Failed to approve stock update.")
-                except (ValueError, IndexError):
-                    send_message(chat_id, "❌ Invalid stock approval action.")
-
-            elif text.startswith("reject_stock:"):
-                try:
-                    approval_id = int(text.split(":")[1])
-                    if handle_stock_approval_action(chat_id, approval_id, "rejected"):
-                        send_message(chat_id, "❌ Stock update rejected.")
-                    else:
-                        send_message(chat_id, "❌ Failed to reject stock update.")
-                except (ValueError, IndexError):
-                    send_message(chat_id, "❌ Invalid stock rejection action.")
-        
             elif text == "add_new_shop":
                 if user.role != "owner":
                     send_message(chat_id, "❌ Only store owners can add shops.")
@@ -3777,7 +4975,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         return {"ok": True}
 
                     # Get shop info
-                    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                    shop = tenant_db.get(ShopORM, shop_id)
                     if not shop:
                         send_message(chat_id, "❌ Shop not found.")
                         return {"ok": True}
@@ -3794,9 +4992,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                     else:
                         message = f"🏪 *{shop.name} - Stock Report*\n\n"
                         for item in stock_items:
-                            product = tenant_db.query(ProductORM).filter(
-                                ProductORM.product_id == item.product_id
-                            ).first()
+                            product = tenant_db.get(ProductORM, item.product_id)
                 
                             if product:
                                 status = "🟢" if item.stock > item.low_stock_threshold else "🔴" if item.stock == 0 else "🟡"
@@ -3823,11 +5019,6 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
 
             # -------------------- Update Product --------------------
             elif text == "update_product":
-                tenant_db = get_tenant_session(user.tenant_schema, chat_id)
-                if not tenant_db:
-                    send_message(chat_id, "⚠️ Tenant database not linked. Please restart with /start.")
-                    return {"ok": True}
-
                 logger.debug(f"🧩 In update_product flow, tenant_db ready for chat_id={chat_id}")
     
                 # ✅ FIXED: Admin can only update products in their shop
@@ -3843,15 +5034,8 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
     
             # -------------------- Paginated Product List --------------------
             elif text.startswith("products_page:"):
-                try:
-                    page = int(text.split(":")[1])
-                except (IndexError, ValueError):
-                    page = 1
-
-                tenant_db = get_tenant_session(user.tenant_schema, chat_id)
-                if not tenant_db:
-                    send_message(chat_id, "⚠️ Tenant database not linked. Please restart with /start.")
-                    return {"ok": True}
+                # arg is the part after ":" from the partition above
+                page = int(arg) if arg.isdigit() else 1
 
                 text_msg, kb = products_page_view(tenant_db, page=page)
                 send_message(chat_id, text_msg, kb)
@@ -3861,21 +5045,14 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
             elif text.startswith("select_update:"):
                 logger.info(f"🧩 Processing select_update callback: {text}")
                 
-                # Extract product ID
-                try:
-                    product_id = int(text.split(":")[1])
-                except (IndexError, ValueError):
+                # Extract product ID (arg from the partition above)
+                if not arg.isdigit():
                     send_message(chat_id, "⚠️ Invalid product selection.")
                     return {"ok": True}
-
-                # Create tenant session
-                tenant_db = get_tenant_session(user.tenant_schema, chat_id)
-                if not tenant_db:
-                    send_message(chat_id, "❌ Unable to access tenant database.")
-                    return {"ok": True}
+                product_id = int(arg)
 
                 # Fetch product
-                product = tenant_db.query(ProductORM).filter(ProductORM.product_id == product_id).first()
+                product = tenant_db.get(ProductORM, product_id)
                 
                 if not product:
                     logger.error(f"❌ Product {product_id} not found in callback")
@@ -3992,7 +5169,8 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                     # Get sales stats for this shop
                     sales_today = tenant_db.query(SaleORM).filter(
                         SaleORM.shop_id == shop.shop_id,
-                        func.date(SaleORM.sale_date) == func.current_date()
+                        SaleORM.sale_date >= func.current_date(),
+                        SaleORM.sale_date < func.current_date() + 1
                     ).count()
         
                     total_sales = tenant_db.query(SaleORM).filter(
@@ -4030,7 +5208,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         send_message(chat_id, "❌ Unable to access store database.")
                         return {"ok": True}
 
-                    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                    shop = tenant_db.get(ShopORM, shop_id)
                     if not shop:
                         send_message(chat_id, "❌ Shop not found.")
                         return {"ok": True}
@@ -4136,7 +5314,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         stock_id = int(parts[2])
                         
                         # Get product and stock info
-                        product = tenant_db.query(ProductORM).filter(ProductORM.product_id == product_id).first()
+                        product = tenant_db.get(ProductORM, product_id)
                         stock_item = tenant_db.query(ProductShopStockORM).filter(
                             ProductShopStockORM.id == stock_id,
                             ProductShopStockORM.shop_id == shop_id
@@ -4145,460 +5323,47 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                     else:
                         # Old format - find stock_id
                         product_id = int(parts[1])
-                        product = tenant_db.query(ProductORM).filter(ProductORM.product_id == product_id).first()
+                        product = tenant_db.get(ProductORM, product_id)
                         stock_item = tenant_db.query(ProductShopStockORM).filter(
                             ProductShopStockORM.product_id == product_id,
                             ProductShopStockORM.shop_id == shop_id
                         ).first()
         
                     if not product:
-                        send_message(chat_id, "❌ Product not found. Please try again.")
-                        return {"ok": True}
-                    
-                    if not stock_item:
-                        send_message(chat_id, f"❌ {product.name} not available in this shop's stock.")
-                        return {"ok": True}
-        
-                    # Store selected product and preserve existing cart
-                    current_data["current_product"] = {
-                        "product_id": product.product_id,
-                        "name": product.name,
-                        "price": float(product.price),
-                        "unit_type": product.unit_type,
-                        "available_stock": stock_item.stock,  # FIXED: Use stock_item.stock
-                        "stock_id": stock_item.id  # Store for stock update
-                    }
-        
-                    # Update state with preserved cart and new product
-                    user_states[chat_id] = {
-                        "action": "awaiting_sale", 
-                        "step": 2, 
-                        "data": current_data  # This preserves the cart!
-                    }
-        
-                    send_message(chat_id, f"📦 Selected {product.name} ({product.unit_type}). Enter quantity to add:")
-        
-                except (ValueError, IndexError) as e:
-                    logger.error(f"❌ Error in select_sale handler: {e}")
-                    send_message(chat_id, "❌ Invalid product selection.")
-    
-                return {"ok": True}
-                        
-            # -------------------- Cart Management Callbacks --------------------
-            elif text == "add_another_item":
-                logger.info(f"🎯 Processing callback: add_another_item from chat_id={chat_id}")
-    
-                # ✅ FIX: Get current state from user_states, not callback data
-                current_state = user_states.get(chat_id, {})
-                current_data = current_state.get("data", {})
-    
-                logger.info(f"🔍 CART DEBUG [add_another_item] - Chat: {chat_id}, Items: {len(current_data.get('cart', []))}")
-    
-                # Preserve existing cart and data
-                user_states[chat_id] = {
-                    "action": "awaiting_sale", 
-                    "step": 1, 
-                    "data": current_data  # This preserves the cart!
-                }
-                send_message(chat_id, "➕ Add another item. Enter product name:")
-                return {"ok": True}
-    
-            elif text == "view_cart":
-                # ✅ FIX: Get cart from current state, not callback data
-                current_state = user_states.get(chat_id, {})
-                current_data = current_state.get("data", {})
-                cart = current_data.get("cart", [])
-    
-                logger.info(f"🔍 CART DEBUG [view_cart] - Chat: {chat_id}, Items: {len(cart)}")
-    
-                cart_summary = get_cart_summary(cart)
-                kb_rows = [
-                    [{"text": "➕ Add Item", "callback_data": "add_another_item"}],
-                    [{"text": "🗑 Remove Item", "callback_data": "remove_item"}],
-                    [{"text": "✅ Checkout", "callback_data": "checkout_cart"}],
-                    [{"text": "❌ Cancel Sale", "callback_data": "cancel_sale"}]
-                ]
-                send_message(chat_id, cart_summary, {"inline_keyboard": kb_rows})
-                return {"ok": True}
-    
-            elif text == "remove_item":
-                # ✅ FIX: Get cart from current state
-                current_state = user_states.get(chat_id, {})
-                current_data = current_state.get("data", {})
-                cart = current_data.get("cart", [])
-    
-                logger.info(f"🔍 CART DEBUG [remove_item] - Chat: {chat_id}, Items: {len(cart)}")
-    
-                if not cart:
-                    send_message(chat_id, "🛒 Cart is empty. Add items first.")
-                    return {"ok": True}
-    
-                kb_rows = []
-                for i, item in enumerate(cart, 1):
-                    kb_rows.append([{"text": f"Remove: {item['name']} ({item['quantity']})", "callback_data": f"remove_cart_item:{i-1}"}])
-                kb_rows.append([{"text": "⬅️ Back to Cart", "callback_data": "view_cart"}])
-    
-                send_message(chat_id, "🗑 Select item to remove:", {"inline_keyboard": kb_rows})
-                return {"ok": True}
-
-            elif text == "checkout_cart":
-                logger.info(f"🎯 Processing callback: checkout_cart from chat_id={chat_id}")
-    
-                # ✅ FIX: Get cart from current state
-                current_state = user_states.get(chat_id, {})
-                current_data = current_state.get("data", {})
-                cart = current_data.get("cart", [])
-    
-                logger.info(f"🔍 CART DEBUG [checkout_cart] - Chat: {chat_id}, Items: {len(cart)}")
-    
-                if not cart:
-                    send_message(chat_id, "❌ Cart is empty! Add items first.")
-                    return {"ok": True}
-    
-                # Move to checkout step
-                user_states[chat_id] = {
-                    "action": "awaiting_sale", 
-                    "step": 3, 
-                    "data": current_data  # Preserve cart for checkout
-                }
-    
-                # Show payment options - UPDATED: Cash, Ecocash, Swipe
-                kb_rows = [
-                    [{"text": "💵 Cash", "callback_data": "payment_method:cash"}],
-                    [{"text": "📱 Ecocash", "callback_data": "payment_method:ecocash"}],
-                    [{"text": "💳 Swipe", "callback_data": "payment_method:swipe"}],
-                    [{"text": "⬅️ Back to Cart", "callback_data": "view_cart"}]
-                ]
-    
-                cart_summary = get_cart_summary(cart)
-                total = sum(item["subtotal"] for item in cart)
-                message = f"🛒 Checkout\n\n{cart_summary}\n💰 Total: ${total:.2f}\n\n💳 Select payment method:"
-    
-                send_message(chat_id, message, {"inline_keyboard": kb_rows})
-                return {"ok": True}
-
-            elif text == "cancel_sale":
-                logger.info(f"🎯 Processing callback: cancel_sale from chat_id={chat_id}")
-    
-                current_state = user_states.get(chat_id, {})
-                current_data = current_state.get("data", {})
-                cart = current_data.get("cart", [])
-                logger.info(f"🔍 CART DEBUG [cancel_sale] - Chat: {chat_id}, Items: {len(cart)}")
-    
-                user_states.pop(chat_id, None)
-                send_message(chat_id, "❌ Sale cancelled.")
-                from app.user_management import get_role_based_menu
-                kb = get_role_based_menu(user.role)
-                send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
-                return {"ok": True}
-
-            # Handle remove cart item callbacks
-            elif text.startswith("remove_cart_item:"):
-                # ✅ FIX: Get cart from current state
-                current_state = user_states.get(chat_id, {})
-                current_data = current_state.get("data", {})
-                cart = current_data.get("cart", [])
-    
-                logger.info(f"🔍 CART DEBUG [before_remove] - Chat: {chat_id}, Items: {len(cart)}")
-    
-                try:
-                    index = int(text.split(":")[1])
-                    if 0 <= index < len(cart):
-                        removed_item = cart.pop(index)
-            
-                        # Update the state with modified cart
-                        user_states[chat_id] = {
-                            "action": "awaiting_sale",
-                            "step": 1, 
-                            "data": current_data
-                        }
-            
-                        logger.info(f"🔍 CART DEBUG [after_remove] - Chat: {chat_id}, Items: {len(cart)}")
-            
-                        send_message(chat_id, f"✅ Removed: {removed_item['name']}")
-            
-                        # Show updated cart
-                        cart_summary = get_cart_summary(cart)
-                        kb_rows = [
-                            [{"text": "➕ Add Item", "callback_data": "add_another_item"}],
-                            [{"text": "🗑 Remove Item", "callback_data": "remove_item"}],
-                            [{"text": "✅ Checkout", "callback_data": "checkout_cart"}],
-                            [{"text": "❌ Cancel Sale", "callback_data": "cancel_sale"}]
-                        ]
-                        send_message(chat_id, cart_summary, {"inline_keyboard": kb_rows})
-                    else:
-                        send_message(chat_id, "❌ Invalid item selection.")
-                except (ValueError, IndexError):
-                    send_message(chat_id, "❌ Error removing item.")
-                return {"ok": True}
-
-            # ✅ UPDATED: Payment method selection with Ecocash surcharge
-            elif text.startswith("payment_method:"):
-                payment_method = text.split(":")[1]
-    
-                # Get current state
-                current_state = user_states.get(chat_id, {})
-                current_data = current_state.get("data", {})
-    
-                logger.info(f"🔍 CART DEBUG [payment_method] - Chat: {chat_id}, Items: {len(current_data.get('cart', []))}, Method: {payment_method}")
-    
-                current_data["payment_method"] = payment_method
-    
-                # Calculate cart total
-                cart_total = sum(item["subtotal"] for item in current_data["cart"])
-    
-                if payment_method == "cash":
-                    # For cash, ask for sale type (cash/credit)
-                    user_states[chat_id] = {
-                        "action": "awaiting_sale", 
-                        "step": 3.1, 
-                        "data": current_data
-                    }
-        
-                    kb_rows = [
-                        [{"text": "💵 Cash Sale", "callback_data": "sale_type:cash"}],
-                        [{"text": "🔄 Credit Sale", "callback_data": "sale_type:credit"}],
-                        [{"text": "⬅️ Back", "callback_data": "view_cart"}]
-                    ]
-        
-                    send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n\n💳 Select sale type:", {"inline_keyboard": kb_rows})
-    
-                elif payment_method == "ecocash":
-                    # ✅ Apply 10% surcharge for Ecocash
-                    surcharge = cart_total * 0.10
-                    final_total = cart_total + surcharge
-                    current_data["original_total"] = cart_total  # Store original for receipt
-                    current_data["surcharge"] = surcharge
-                    current_data["final_total"] = final_total
-        
-                    # For Ecocash, it's always full payment with surcharge
-                    current_data["sale_type"] = "cash"
-                    current_data["payment_type"] = "full"
-                    current_data["amount_paid"] = final_total
-                    current_data["pending_amount"] = 0
-                    current_data["change_left"] = 0
-        
-                    user_states[chat_id] = {
-                        "action": "awaiting_sale", 
-                        "step": 6, 
-                        "data": current_data
-                    }
-        
-                    # Show surcharge breakdown
-                    message = f"📱 *Ecocash Payment*\n\n"
-                    message += get_cart_summary(current_data["cart"])
-                    message += f"💰 Subtotal: ${cart_total:.2f}\n"
-                    message += f"⚡ Surcharge (10%): ${surcharge:.2f}\n"
-                    message += f"💳 *Final Amount: ${final_total:.2f}*\n\n"
-                    message += "✅ Ecocash payment confirmed.\n\nConfirm sale? (yes/no)"
-        
-                    send_message(chat_id, message)
-    
-                else:  # swipe
-                    # For Swipe, it's always full payment (no surcharge)
-                    current_data["sale_type"] = "cash"
-                    current_data["payment_type"] = "full"
-                    current_data["amount_paid"] = cart_total
-                    current_data["pending_amount"] = 0
-                    current_data["change_left"] = 0
-        
-                    user_states[chat_id] = {
-                        "action": "awaiting_sale", 
-                        "step": 6, 
-                        "data": current_data
-                    }
-                    send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n✅ {payment_method.title()} payment confirmed.\n\nConfirm sale? (yes/no)")
-    
-                return {"ok": True}
-    
-            # ✅ NEW: Sale type selection for cash
-            elif text.startswith("sale_type:"):
-                sale_type = text.split(":")[1]
-    
-                current_state = user_states.get(chat_id, {})
-                current_data = current_state.get("data", {})
-    
-                current_data["sale_type"] = sale_type
-    
-                if sale_type == "cash":
-                    # For cash sales, ask for amount tendered
-                    current_data["payment_type"] = "full"
-                    user_states[chat_id] = {
-                        "action": "awaiting_sale", 
-                        "step": 4, 
-                        "data": current_data
-                    }
-        
-                    cart_total = sum(item["subtotal"] for item in current_data["cart"])
-                    send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n💵 Enter cash amount tendered by customer:")
-    
-                else:  # credit
-                    # For credit sales, ask for credit type
-                    user_states[chat_id] = {
-                        "action": "awaiting_sale", 
-                        "step": 3.2, 
-                        "data": current_data
-                    }
-        
-                    kb_rows = [
-                        [{"text": "💰 Full Credit", "callback_data": "credit_type:full"}],
-                        [{"text": "📋 Partial Credit", "callback_data": "credit_type:partial"}],
-                        [{"text": "⬅️ Back", "callback_data": "view_cart"}]
-                    ]
-        
-                    cart_total = sum(item["subtotal"] for item in current_data["cart"])
-                    send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n\n💳 Select credit type:", {"inline_keyboard": kb_rows})
-    
-                return {"ok": True}
-
-            # ✅ NEW: Credit type selection
-            elif text.startswith("credit_type:"):
-                credit_type = text.split(":")[1]
-    
-                current_state = user_states.get(chat_id, {})
-                current_data = current_state.get("data", {})
-    
-                current_data["payment_type"] = credit_type
-    
-                if credit_type == "full":
-                    # Full credit - no payment, go to customer details
-                    current_data["amount_paid"] = 0
-                    current_data["pending_amount"] = sum(item["subtotal"] for item in current_data["cart"])
-                    current_data["change_left"] = 0
+                        send_message(chat_id, "❌ Product not found. Please try again.")
+                        return {"ok": True}
+                    
+                    if not stock_item:
+                        send_message(chat_id, f"❌ {product.name} not available in this shop's stock.")
+                        return {"ok": True}
         
-                    user_states[chat_id] = {
-                        "action": "awaiting_sale", 
-                        "step": 5, 
-                        "data": current_data
-                    }
-                    send_message(chat_id, "🔄 Full credit sale.\n👤 Enter customer name for credit follow-up:")
-    
-                else:  # partial
-                    # Partial credit - ask for amount paid
-                    user_states[chat_id] = {
-                        "action": "awaiting_sale", 
-                        "step": 4, 
-                        "data": current_data
+                    # Store selected product and preserve existing cart
+                    current_data["current_product"] = {
+                        "product_id": product.product_id,
+                        "name": product.name,
+                        "price": float(product.price),
+                        "unit_type": product.unit_type,
+                        "available_stock": stock_item.stock,  # FIXED: Use stock_item.stock
+                        "stock_id": stock_item.id  # Store for stock update
                     }
         
-                    cart_total = sum(item["subtotal"] for item in current_data["cart"])
-                    send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n💵 Enter amount paid now (remaining will be credit):")
-    
-                return {"ok": True}
-
-            # ✅ NEW: Change availability check
-            elif text.startswith("has_change:"):
-                has_change = text.split(":")[1]
-    
-                current_state = user_states.get(chat_id, {})
-                current_data = current_state.get("data", {})
-    
-                if has_change == "yes":
-                    # Has change - no customer details needed
-                    user_states[chat_id] = {
-                        "action": "awaiting_sale", 
-                        "step": 6, 
-                        "data": current_data
-                    }
-                    send_message(chat_id, "✅ Change ready. Confirm sale? (yes/no)")
-                else:
-                    # No change - need customer details
+                    # Update state with preserved cart and new product
                     user_states[chat_id] = {
                         "action": "awaiting_sale", 
-                        "step": 5, 
-                        "data": current_data
+                        "step": 2, 
+                        "data": current_data  # This preserves the cart!
                     }
-                    send_message(chat_id, "👤 Enter customer name (for change follow-up):")
-    
-                return {"ok": True}
-                    
-            # -------------------- Record Payment/Credit/Change Collection --------------------
-            elif text == "record_payment":
-                # Start payment recording flow
-                user_states[chat_id] = {"action": "record_payment", "step": 1, "data": {}}
-    
-                # Ask what type of payment to record
-                kb_rows = [
-                    [{"text": "💳 Credit Payment", "callback_data": "payment_type:credit"}],
-                    [{"text": "🪙 Change Collection", "callback_data": "payment_type:change"}],
-                    [{"text": "⬅️ Cancel", "callback_data": "back_to_menu"}]
-                ]
-    
-                send_message(chat_id, "💰 *Record Payment*\n\nSelect payment type:", {"inline_keyboard": kb_rows})
-                return {"ok": True}
-
-            elif text.startswith("payment_type:"):
-                payment_type = text.split(":")[1]
-    
-                current_state = user_states.get(chat_id, {})
-                current_data = current_state.get("data", {})
-                current_data["payment_type"] = payment_type
-    
-                user_states[chat_id] = {"action": "record_payment", "step": 2, "data": current_data}
-    
-                if payment_type == "credit":
-                    send_message(chat_id, "💳 *Record Credit Payment*\n\nEnter customer name to search:")
-                else:  # change
-                    send_message(chat_id, "🪙 *Record Change Collection*\n\nEnter customer name to search:")
-    
-                return {"ok": True}
-    
-            elif text.startswith("select_customer_payment:"):
-                try:
-                    parts = text.split(":")
-                    customer_id = int(parts[1])
-                    payment_type = parts[2]
-        
-                    current_state = user_states.get(chat_id, {})
-                    current_data = current_state.get("data", {})
         
-                    # Find the selected customer from results
-                    selected_customer = None
-                    for customer in current_data.get("customer_results", []):
-                        if customer["customer_id"] == customer_id:
-                            selected_customer = customer
-                            break
-        
-                    if selected_customer:
-                        current_data["selected_customer"] = selected_customer
-                        user_states[chat_id] = {"action": "record_payment", "step": 3, "data": current_data}
-            
-                        # Get tenant session for shop info
-                        tenant_db = get_tenant_session(user.tenant_schema, chat_id)
-                        if not tenant_db:
-                            send_message(chat_id, "❌ Unable to access store database.")
-                            return {"ok": True}
-            
-                        if payment_type == "credit":
-                            send_message(chat_id, f"👤 Selected: {selected_customer['name']}\n"
-                                                 f"📞 Contact: {selected_customer['contact']}\n"
-                                                 f"💳 Total Credit Due: ${selected_customer['total_pending']:.2f}\n"
-                                                 f"📊 From {selected_customer['sales_count']} transaction(s)\n\n"
-                                                 f"Enter amount received from customer:")
-                        else:
-                            send_message(chat_id, f"👤 Selected: {selected_customer['name']}\n"
-                                                 f"📞 Contact: {selected_customer['contact']}\n"
-                                                 f"🪙 Total Change Due: ${selected_customer['total_change']:.2f}\n"
-                                                 f"📊 From {selected_customer['sales_count']} transaction(s)\n\n"
-                                                 f"Enter amount of change collected from customer:")
+                    send_message(chat_id, f"📦 Selected {product.name} ({product.unit_type}). Enter quantity to add:")
         
-                    else:
-                        send_message(chat_id, "❌ Customer selection failed. Please try again.")
-                        user_states.pop(chat_id, None)
-    
-                except (ValueError, IndexError):
-                    send_message(chat_id, "❌ Invalid customer selection.")
-                    user_states.pop(chat_id, None)
+                except (ValueError, IndexError) as e:
+                    logger.error(f"❌ Error in select_sale handler: {e}")
+                    send_message(chat_id, "❌ Invalid product selection.")
     
                 return {"ok": True}
-    
+                        
             # -------------------- View Stock --------------------
             elif text == "view_stock":
-                tenant_db = get_tenant_session(user.tenant_schema, chat_id)
-                if not tenant_db:
-                    send_message(chat_id, "⚠️ Cannot view stock: tenant DB unavailable.")
-                    return {"ok": True}
-
                 # ✅ FIXED: Get shops based on role
                 if user.role == "owner":
                     shops = tenant_db.query(ShopORM).all()
@@ -4609,7 +5374,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         tenant_db.close()
                         return {"ok": True}
         
-                    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == user.shop_id).first()
+                    shop = tenant_db.get(ShopORM, user.shop_id)
                     if not shop:
                         send_message(chat_id, "❌ Your assigned shop not found.")
                         tenant_db.close()
@@ -4623,23 +5388,21 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         tenant_db.close()
                         return {"ok": True}
         
-                    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == user.shop_id).first()
+                    shop = tenant_db.get(ShopORM, user.shop_id)
                     if not shop:
                         send_message(chat_id, "❌ Your assigned shop not found.")
                         tenant_db.close()
                         return {"ok": True}
         
                     shops = [shop]
-    
-                tenant_db.close()
 
                 if not shops:
                     send_message(chat_id, "🏪 No shops found. Please create a shop first.")
+                    tenant_db.close()
                     return {"ok": True}
 
                 if len(shops) == 1:
                     # Only one shop - show stock directly
-                    tenant_db = get_tenant_session(user.tenant_schema, chat_id)
                     stock_list = get_stock_list(tenant_db, shops[0].shop_id)
                     tenant_db.close()
 
@@ -4688,7 +5451,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         return {"ok": True}
         
                     # Get shop name
-                    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                    shop = tenant_db.get(ShopORM, shop_id)
                     if not shop:
                         send_message(chat_id, "❌ Shop not found.")
                         tenant_db.close()
@@ -4700,18 +5463,16 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
         
                     # Create management buttons for owners
                     if user.role == "owner":
-                        kb_rows = [
+                        kb = {"inline_keyboard": [
                             [{"text": "🏪 View Another Shop", "callback_data": "view_stock"}],
                             [{"text": "📊 Manage Shop Stock", "callback_data": f"manage_shop_stock:{shop_id}"}],
                             [{"text": "⬅️ Back to Menu", "callback_data": "back_to_menu"}]
-                        ]
+                        ]}
                     else:
                         # Non-owners get limited options
-                        kb_rows = [
-                            [{"text": "⬅️ Back to Menu", "callback_data": "back_to_menu"}]
-                        ]
+                        kb = BACK_TO_MENU_JSON
         
-                    send_message(chat_id, stock_list, {"inline_keyboard": kb_rows})
+                    send_message(chat_id, stock_list, kb)
         
                 except (ValueError, IndexError):
                     send_message(chat_id, "❌ Invalid shop selection.")
@@ -4730,8 +5491,8 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                     current_data = current_state.get("data", {})
                     shop_name = current_data.get("selected_shop_name")
     
-                # Generate appropriate menu
-                kb_dict = report_menu_keyboard(user.role, is_shop_specific, shop_name)
+                # Generate appropriate menu (pre-serialized per role)
+                kb_dict = report_menu_json(user.role, is_shop_specific, shop_name)
     
                 # Custom message based on context
                 if is_shop_specific and shop_name:
@@ -4758,8 +5519,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
             # -------------------- Owner Report Selection Callbacks --------------------
             elif text == "report_all_shops" and user.role == "owner":
                 # Show standard report menu for all shops
-                kb_dict = report_menu_keyboard(user.role)
-                send_message(chat_id, "📊 *All Shops Report*\n\nSelect report type:", kb_dict)
+                send_message(chat_id, "📊 *All Shops Report*\n\nSelect report type:", REPORT_MENU_JSON_BY_ROLE["owner"])
                 return {"ok": True}
 
             elif text == "report_select_shop" and user.role == "owner":
@@ -4845,14 +5605,14 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                     # Get shop name
                     tenant_db = get_tenant_session(user.tenant_schema, chat_id)
                     if tenant_db:
-                        shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                        shop = tenant_db.get(ShopORM, shop_id)
                         current_data["selected_shop_name"] = shop.name if shop else f"Shop {shop_id}"
                         tenant_db.close()
         
                     user_states[chat_id] = {"action": "awaiting_shop_report", "data": current_data}
         
                     # Show enhanced report menu for specific shop
-                    kb_dict = report_menu_keyboard(user.role, is_shop_specific=True, shop_name=current_data["selected_shop_name"])
+                    kb_dict = report_menu_json(user.role, is_shop_specific=True, shop_name=current_data["selected_shop_name"])
                     send_message(chat_id, f"📊 *Reports for {current_data['selected_shop_name']}*\n\nSelect report type:", kb_dict)
         
                 except (ValueError, IndexError):
@@ -4923,9 +5683,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                 return {"ok": True}
     
             # -------------------- Report Callbacks (UPDATED FOR MULTI-SHOP) --------------------
-            elif text in ["report_daily", "report_weekly", "report_monthly", "report_low_stock", 
-                          "report_top_products", "report_aov", "report_stock_turnover", 
-                          "report_credits", "report_change", "report_payment_summary"]:
+            elif text in REPORT_CALLBACKS:
 
                 logger.info(f"🎯 Processing callback: {text} from chat_id={chat_id}, role={user.role}")
 
@@ -4967,7 +5725,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         report_title = f"All Shops - {report_title}"
 
                     # ✅ Generate report with shop filtering (if specified)
-                    report = generate_report(tenant_db, text, shop_id=shop_id, shop_name=shop_name)
+                    report = cached_report(user.tenant_schema, tenant_db, text, shop_id=shop_id, shop_name=shop_name)
         
                     # Add header based on scope
                     if shop_name:
@@ -4982,9 +5740,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                     logger.info(f"✅ Report '{text}' generated successfully for chat_id={chat_id}")
 
                 except Exception as e:
-                    logger.error(f"❌ {text} failed for chat_id={chat_id}: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    logger.exception(f"❌ {text} failed for chat_id={chat_id}: {e}")
 
                     error_msg = f"❌ Failed to generate {text.replace('_', ' ')}."
                     if "division by zero" in str(e):
@@ -5000,60 +5756,10 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
             elif text == "back_to_menu":
                 logger.info(f"🎯 Processing callback: back_to_menu from chat_id={chat_id}")
     
-                from app.user_management import get_role_based_menu
-                kb = get_role_based_menu(user.role)
+                kb = role_menu_keyboard(user.role)
                 send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
                 return {"ok": True}
     
-            # -------------------- Logout Callback --------------------
-            elif text == "logout":
-                logger.info(f"🚪 User {user.username} (chat_id={chat_id}) logging out")
-    
-                # Clear user session
-                try:
-                    # Clear chat_id from user record (soft logout)
-                    user.chat_id = None
-                    db.commit()
-        
-                    # Clear any user states
-                    user_states.pop(chat_id, None)
-        
-                    # Send logout confirmation
-                    send_message(chat_id, "✅ You have been logged out successfully.\n\nUse /start to login again.")
-        
-                    logger.info(f"✅ User {user.username} logged out successfully")
-        
-                except Exception as e:
-                    logger.error(f"❌ Error during logout: {e}")
-                    send_message(chat_id, "❌ Error during logout. Please try again.")
-    
-                return {"ok": True}
-    
-            # -------------------- Help --------------------
-            elif text == "help":
-                help_text = (
-                    "❓ *Help & FAQs*\n\n"
-                    "📌 *Getting Started*\n"
-                    "• Owners: setup shop and add products.\n"
-                    "• Shopkeepers: record sales, check stock.\n\n"
-                    "🛒 *Managing Products*\n"
-                    "• Owners can add/update all product fields.\n"
-                    "• Shopkeepers can suggest new products or update quantity/unit only.\n\n"
-                    "📦 *Stock Management*\n"
-                    "• Check View Stock before recording sales.\n"
-                    "• Low stock alerts will appear automatically to owners.\n\n"
-                    "📊 *Reports*\n"
-                    "• Owners: full reports\n"
-                    "• Shopkeepers: limited access\n\n"
-                    "⚠️ *Common Issues*\n"
-                    "• Bot unresponsive → /start\n"
-                    "• Always follow input formats.\n\n"
-                    "👨‍💻 Contact support for more help."
-                )
-                kb_dict = {"inline_keyboard": [[{"text": "⬅️ Back to Menu", "callback_data": "back_to_menu"}]]}
-                send_message(chat_id, help_text, kb_dict)
-                return {"ok": True}
-
             else:
                 logger.warning(f"⚠️ Unknown callback action received: {text}")
                 send_message(chat_id, f"⚠️ Unknown action: {text}")
@@ -5074,8 +5780,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
             
             # -------------------- /start --------------------
             if text == "/start":
-                user = db.query(User).filter(User.chat_id == chat_id).first()
-
+                # `user` was already loaded for this chat at the top of the handler
                 if user:
                     # ✅ CASE: User already exists and chat_id is linked
                     role_display = {
@@ -5091,8 +5796,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         welcome_msg += f"\n🏪 Shop: {user.shop_name}"
 
                     # Show role-based menu immediately
-                    from app.user_management import get_role_based_menu
-                    kb = get_role_based_menu(user.role)
+                    kb = role_menu_keyboard(user.role)
                     send_message(chat_id, welcome_msg, keyboard=kb)
 
                 else:
@@ -5130,15 +5834,14 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                     )
                     db.add(new_user)
                     db.commit()
-                    db.refresh(new_user)
 
                     # ✅ UPDATED: Create tenant schema WITHOUT default users
                     try:
                         # ✅ Updated: create_tenant_db returns only owner credentials now
+                        # (it also links users.tenant_schema; mirror that without another UPDATE)
                         schema_name, credentials_dict = create_tenant_db(chat_id)
-                        new_user.tenant_schema = schema_name
+                        set_committed_value(new_user, "tenant_schema", schema_name)
                         # ❌ REMOVE: new_user.shop_id = 1  # No default shop ID yet
-                        db.commit()
                         logger.info(f"✅ New owner created: {generated_username} with schema '{schema_name}'")
 
                         # ✅ Send ONLY owner credentials
@@ -5170,115 +5873,20 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                 action = state.get("action")
                 step = state.get("step", 1)
                 data = state.get("data", {})
-
-                # ✅ SHOP USER LOGIN (for admin/shopkeeper users - first time linking chat_id)
-                if action == "shop_user_login":
-                    if step == 1:  # Enter Username
-                        username = text.strip()
-                        if not username:
-                            send_message(chat_id, "❌ Username cannot be empty. Please enter your username:")
-                            return {"ok": True}
-
-                        # Check if username exists and is NOT an owner (admin or shopkeeper only)
-                        candidate = db.query(User).filter(
-                            User.username == username,
-                            User.role.in_(["admin", "shopkeeper"])  # Only allow admin/shopkeeper
-                        ).first()
-
-                        if not candidate:
-                            send_message(chat_id, "❌ Username not found or invalid user type. Please try again:")
-                            return {"ok": True}
-
-                        # Store username and move to password step
-                        data["username"] = username
-                        data["candidate_user_id"] = candidate.user_id
-                        user_states[chat_id] = {"action": "shop_user_login", "step": 2, "data": data}
-                        send_message(chat_id, "🔐 Please enter your password:")
-
-                    elif step == 2:  # Enter Password
-                        password = text.strip()
-                        if not password:
-                            send_message(chat_id, "❌ Password cannot be empty. Please enter your password:")
-                            return {"ok": True}
-
-                        # Get the candidate user
-                        candidate = db.query(User).filter(User.user_id == data["candidate_user_id"]).first()
-
-                        if not candidate:
-                            send_message(chat_id, "❌ User not found. Please start over with /start")
-                            user_states.pop(chat_id, None)
-                            return {"ok": True}
-
-                        # ✅ IMPORTANT: Make sure verify_password is imported
-                        # Add this at the top of your file if not already there:
-                        # from app.user_management import verify_password
-        
-                        if not verify_password(password, candidate.password_hash):
-                            send_message(chat_id, "❌ Incorrect password. Please try again:")
-                            return {"ok": True}
-
-                        # ✅ CRITICAL: Check if user is already logged in elsewhere
-                        if candidate.chat_id and candidate.chat_id != chat_id:
-                            # User is logged in from another device - ask if they want to switch
-                            send_message(chat_id, "⚠️ This account is already logged in from another device. Do you want to switch to this device? (yes/no)")
-                            data["existing_chat_id"] = candidate.chat_id
-                            user_states[chat_id] = {"action": "shop_user_login", "step": 3, "data": data}
-                            return {"ok": True}
-        
-                        # ✅ Login successful - link Telegram chat_id
-                        candidate.chat_id = chat_id
-                        db.commit()
-
-                        # Welcome message
-                        role_display = {
-                            "admin": "🛡️ Admin (Full Access)",
-                            "shopkeeper": "👨‍💼 Shopkeeper (Limited Access)"
-                        }
-                        welcome_msg = f"✅ Login successful! Welcome, {candidate.name}.\n"
-                        welcome_msg += f"👤 Role: {role_display.get(candidate.role, candidate.role)}"
-
-                        # Add shop info if available
-                        if candidate.shop_name:
-                            welcome_msg += f"\n🏪 Shop: {candidate.shop_name}"
-
-                        send_message(chat_id, welcome_msg)
-                        user_states.pop(chat_id, None)
-
-                        # Show role-based menu
-                        from app.user_management import get_role_based_menu
-                        kb = get_role_based_menu(candidate.role)
-                        send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
-        
-                    elif step == 3:  # Handle switching devices
-                        confirmation = text.strip().lower()
-                        if confirmation == "yes":
-                            # Get candidate again
-                            candidate = db.query(User).filter(User.user_id == data["candidate_user_id"]).first()
-                            if candidate:
-                                # Switch chat_id to current device
-                                candidate.chat_id = chat_id
-                                db.commit()
-                
-                                send_message(chat_id, "✅ Device switched successfully!")
-                
-                                # Show role-based menu
-                                from app.user_management import get_role_based_menu
-                                kb = get_role_based_menu(candidate.role)
-                                send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
-                            else:
-                                send_message(chat_id, "❌ User not found. Please start over.")
-                        else:
-                            send_message(chat_id, "❌ Login cancelled. Account remains on previous device.")
-        
-                        user_states.pop(chat_id, None)
-                        return {"ok": True}
-
+                # Normalise the input once for every step below
+                t = text.strip()
+                tl = t.lower()
+
+                # Table-driven conversation steps (see STATE_HANDLERS)
+                state_handler = STATE_HANDLERS.get(action)
+                if state_handler:
+                    state_handler(chat_id, user, db, state, t)
                     return {"ok": True}
-                            
+
                 # -------------------- Unified Shop Setup/Update (Owner only) --------------------
-                elif action == "setup_shop" and user.role == "owner":  # CHANGED: "owner" only, not "owner, admin"
+                if action == "setup_shop" and user.role == "owner":  # CHANGED: "owner" only, not "owner, admin"
                     if step == 1:  # Shop Name
-                        shop_name = text.strip()
+                        shop_name = t
                         if not shop_name:
                             send_message(chat_id, "❌ Shop name cannot be empty. Please enter your shop name:")
                             return {"ok": True}
@@ -5287,16 +5895,31 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         send_message(chat_id, "📍 Now enter the shop location:")
 
                     elif step == 2:  # Shop Location
-                        location = text.strip()
+                        location = t
                         if location:
                             data["location"] = location
                         user_states[chat_id] = {"action": action, "step": 3, "data": data}
                         send_message(chat_id, "📞 Enter the shop contact number (optional):")
 
                     elif step == 3:  # Shop Contact (optional)
-                        contact = text.strip()
-                        if contact:
-                            data["contact"] = contact
+                        # After a provisioning wait the contact is already in
+                        # data; the next message only resumes the save
+                        if not data.pop("awaiting_schema", False):
+                            contact = t
+                            if contact:
+                                data["contact"] = contact
+
+                        # New owners: the schema is provisioned in the background.
+                        # Read tenant_schema from the DB (not the user cache);
+                        # if it is still unset, (re)start provisioning and keep
+                        # the entered details until the owner's next message
+                        db.refresh(user)
+                        if not user.tenant_schema:
+                            provision_tenant(chat_id)
+                            data["awaiting_schema"] = True
+                            user_states[chat_id] = {"action": action, "step": 3, "data": data}
+                            send_message(chat_id, "⏳ Your shop database is still being set up. Your details are saved - once I tell you it's ready, send any message to finish creating your shop.")
+                            return {"ok": True}
 
                         # Save the shop
                         tenant_db = get_tenant_session(user.tenant_schema, chat_id)
@@ -5374,8 +5997,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
 
                         # Clear state and return to menu
                         user_states.pop(chat_id, None)
-                        from app.user_management import get_role_based_menu
-                        kb = get_role_based_menu(user.role)
+                        kb = role_menu_keyboard(user.role)
                         send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
 
                     return {"ok": True}
@@ -5395,26 +6017,26 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         user_states.pop(chat_id, None)
                         return {"ok": True}
 
-                    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                    shop = tenant_db.get(ShopORM, shop_id)
                     if not shop:
                         send_message(chat_id, "❌ Shop not found.")
                         user_states.pop(chat_id, None)
                         return {"ok": True}
 
                     if step == 1:  # New Name
-                        new_name = text.strip()
+                        new_name = t
                         if new_name != "-":
                             shop.name = new_name
                         user_states[chat_id] = {"action": action, "step": 2, "data": data}
 
                     if step == 2:  # New Location
-                        new_location = text.strip()
+                        new_location = t
                         if new_location != "-":
                             shop.location = new_location
                         user_states[chat_id] = {"action": action, "step": 3, "data": data}
 
                     if step == 3:  # New Contact
-                        new_contact = text.strip()
+                        new_contact = t
                         if new_contact != "-":
                             shop.contact = new_contact
 
@@ -5434,8 +6056,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
         
                         # Clear state and return to menu
                         user_states.pop(chat_id, None)
-                        from app.user_management import get_role_based_menu
-                        kb = get_role_based_menu(user.role)
+                        kb = role_menu_keyboard(user.role)
                         send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
 
                     return {"ok": True}
@@ -5443,7 +6064,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                 # -------------------- User Creation Flow (Owner/Admin only) --------------------
                 elif action == "create_user" and user.role in ["owner", "admin"]:
                     if step == 1:  # Select Role
-                        role_selection = text.strip().lower()
+                        role_selection = tl
         
                         # ✅ RESTRICTION: Admin can only create shopkeepers
                         if user.role == "admin" and role_selection != "shopkeeper":
@@ -5468,7 +6089,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         # ✅ DIFFERENT LOGIC FOR ADMIN vs OWNER
                         if user.role == "admin":
                             # Admin can only create users for their own shop
-                            shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == user.shop_id).first()
+                            shop = tenant_db.get(ShopORM, user.shop_id)
                             if not shop:
                                 send_message(chat_id, "❌ You are not assigned to any shop.")
                                 user_states.pop(chat_id, None)
@@ -5503,7 +6124,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         pass
     
                     elif step == 3:  # Custom name (optional)
-                        custom_name = text.strip()
+                        custom_name = t
                         if custom_name.lower() == "skip":
                             custom_name = None
         
@@ -5530,8 +6151,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
         
                         # Clear state and return to menu
                         user_states.pop(chat_id, None)
-                        from app.user_management import get_role_based_menu
-                        kb = get_role_based_menu(user.role)
+                        kb = role_menu_keyboard(user.role)
                         send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
     
                     return {"ok": True}
@@ -5539,7 +6159,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                 # -------------------- Add Shop Flow (Owner only) --------------------
                 elif action == "add_shop" and user.role == "owner":  # CHANGED: owner only
                     if step == 1:  # Shop Name
-                        shop_name = text.strip()
+                        shop_name = t
                         if not shop_name:
                             send_message(chat_id, "❌ Shop name cannot be empty. Please enter shop name:")
                             return {"ok": True}
@@ -5548,7 +6168,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         send_message(chat_id, "📍 Enter shop location:")
 
                     elif step == 2:  # Shop Location
-                        location = text.strip()
+                        location = t
                         if not location:
                             send_message(chat_id, "❌ Location cannot be empty. Please enter shop location:")
                             return {"ok": True}
@@ -5557,7 +6177,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         send_message(chat_id, "📞 Enter shop contact number:")
 
                     elif step == 3:  # Shop Contact
-                        contact = text.strip()
+                        contact = t
                         if not contact:
                             send_message(chat_id, "❌ Contact cannot be empty. Please enter contact number:")
                             return {"ok": True}
@@ -5628,21 +6248,24 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
 
                         # Clear state and return to menu
                         user_states.pop(chat_id, None)
-                        from app.user_management import get_role_based_menu
-                        kb = get_role_based_menu(user.role)
+                        kb = role_menu_keyboard(user.role)
                         send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
 
                     return {"ok": True}
     
                 elif action == "confirm_delete_user":
-                    confirmation = text.strip().upper()
+                    confirmation = tl
     
-                    if confirmation == "YES":
+                    if confirmation == YES:
                         username = data.get("username")
         
                         # Delete the user
                         from app.user_management import delete_user
-                        if delete_user(username):
+                        # Look the chat up before the row is gone; drop its cache after the commit
+                        target_chat_id = db.query(User.chat_id).filter(User.username == username).scalar()
+                        if delete_user(db, username):
+                            if target_chat_id:
+                                invalidate_user_cache(target_chat_id)
                             send_message(chat_id, f"✅ User `{username}` deleted successfully.")
                         else:
                             send_message(chat_id, f"❌ Failed to delete user `{username}`.")
@@ -5650,16 +6273,15 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         send_message(chat_id, "❌ Deletion cancelled.")
     
                     user_states.pop(chat_id, None)
-                    from app.user_management import get_role_based_menu
-                    kb = get_role_based_menu(user.role)
+                    kb = role_menu_keyboard(user.role)
                     send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
                     return {"ok": True}
     
                 # ==================== STEP 2: ADMIN SHOPKEEPER DELETION CONFIRMATION ====================
                 elif text == "confirm_delete_shopkeeper_admin":
-                    confirmation = text.strip().upper()
+                    confirmation = tl
     
-                    if confirmation == "YES":
+                    if confirmation == YES:
                         username = data.get("username")
                         
                         if not username:
@@ -5668,7 +6290,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             return {"ok": True}
                         
                         # Get admin user to verify shop assignment
-                        admin_user = db.query(User).filter(User.chat_id == chat_id).first()
+                        admin_user = user  # already loaded for this chat
                         if not admin_user or admin_user.role != 'admin':
                             send_message(chat_id, "❌ Unauthorized: Admin access required.")
                             user_states.pop(chat_id, None)
@@ -5684,9 +6306,12 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             ).first()
                             
                             if shopkeeper:
-                                # Delete the shopkeeper
+                                # Delete the shopkeeper; drop its cached row only once the
+                                # delete is committed so a concurrent lookup can't re-cache it
+                                shopkeeper_chat_id = shopkeeper.chat_id
                                 db.delete(shopkeeper)
                                 db.commit()
+                                invalidate_user_cache(shopkeeper_chat_id)
                                 
                                 send_message(chat_id, f"✅ Shopkeeper `{username}` has been successfully deleted!")
                             else:
@@ -5704,8 +6329,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                     user_states.pop(chat_id, None)
                     
                     # Show admin menu
-                    from app.user_management import get_role_based_menu
-                    kb = get_role_based_menu('admin')
+                    kb = role_menu_keyboard('admin')
                     send_message(chat_id, "🛡️ Admin Menu:", keyboard=kb)
                     return {"ok": True}
                 # ==================== END STEP 2 ====================
@@ -5713,7 +6337,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                 # -------------------- Admin Create Shopkeeper Flow --------------------
                 elif action == "create_shopkeeper_admin" and user.role == "admin":
                     if step == 1:  # Enter username
-                        username = text.strip()
+                        username = t
                         if not username:
                             send_message(chat_id, "❌ Username cannot be empty. Enter username:")
                             return {"ok": True}
@@ -5733,7 +6357,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         send_message(chat_id, "👤 Enter name for shopkeeper (press Enter to skip):")
     
                     elif step == 2:  # Enter name (optional)
-                        name = text.strip()
+                        name = t
                         if name:
                             data["name"] = name
         
@@ -5783,38 +6407,41 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                 # -------------------- Add Product --------------------
                 elif action == "awaiting_product":
                     # Add comprehensive debug
-                    print(f"🔍 DEBUG [awaiting_product]: Action triggered")
-                    print(f"  Step: {step}")
-                    print(f"  Text received: '{text}'")
-                    print(f"  Data keys: {list(data.keys())}")
-                    print(f"  Shop ID in data: {data.get('shop_id')}")
-                    print(f"  Shop Name in data: {data.get('shop_name')}")
+                    logger.debug("🔍 DEBUG [awaiting_product]: Action triggered")
+                    logger.debug("  Step: %s", step)
+                    logger.debug("  Text received: '%s'", text)
+                    logger.debug("  Data keys: %s", list(data.keys()))
+                    logger.debug("  Shop ID in data: %s", data.get('shop_id'))
+                    logger.debug("  Shop Name in data: %s", data.get('shop_name'))
     
                     tenant_db = get_tenant_session(user.tenant_schema, chat_id)
                     if tenant_db is None:
-                        print(f"❌ DEBUG: Failed to get tenant session")
+                        logger.error("❌ Failed to get tenant session")
                         send_message(chat_id, "❌ Unable to access tenant database.")
                         return {"ok": True}
     
-                    print(f"✅ DEBUG: Tenant session obtained")
+                    logger.debug("✅ DEBUG: Tenant session obtained")
 
                     # -------------------- Step Handling --------------------
                     if step == 1:  # Product Name
-                        product_name = text.strip()
+                        product_name = t
                         if not product_name:
                             send_message(chat_id, "❌ Product name cannot be empty. Please enter a valid product name:")
                             return {"ok": True}
                         data["name"] = product_name
                         user_states[chat_id] = {"action": action, "step": 2, "data": data}
                         send_message(chat_id, "📦 Enter quantity:")
-                        print(f"🔍 DEBUG: Product name saved, moving to step 2")
+                        logger.debug("🔍 DEBUG: Product name saved, moving to step 2")
                         return {"ok": True}
 
                     elif step == 2:  # Quantity
-                        qty_text = text.strip()
+                        qty_text = t
                         if not qty_text:
                             send_message(chat_id, "❌ Quantity cannot be empty. Please enter a valid quantity:")
                             return {"ok": True}
+                        if not _INT_RE.fullmatch(qty_text):
+                            send_message(chat_id, "❌ Invalid quantity. Please enter a positive number:")
+                            return {"ok": True}
                         try:
                             qty = int(qty_text)
                             if qty < 0:
@@ -5823,13 +6450,13 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             data["quantity"] = qty
                             user_states[chat_id] = {"action": action, "step": 3, "data": data}
                             send_message(chat_id, "📏 Enter unit type (e.g., piece, pack, box, carton):")
-                            print(f"🔍 DEBUG: Quantity saved, moving to step 3")
+                            logger.debug("🔍 DEBUG: Quantity saved, moving to step 3")
                         except ValueError:
                             send_message(chat_id, "❌ Invalid quantity. Please enter a positive number:")
                         return {"ok": True}
 
                     elif step == 3:  # Unit Type - SIMPLIFIED
-                        unit_type = text.strip().lower()
+                        unit_type = tl
                         if not unit_type:
                             send_message(chat_id, "❌ Unit type cannot be empty. Please enter a unit type:")
                             return {"ok": True}
@@ -5842,14 +6469,17 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         data["unit_type"] = unit_type
                         user_states[chat_id] = {"action": action, "step": 4, "data": data}
                         send_message(chat_id, "💲 Enter product price:")
-                        print(f"🔍 DEBUG: Unit type '{unit_type}' saved, moving to step 4")
+                        logger.debug("🔍 DEBUG: Unit type '%s' saved, moving to step 4", unit_type)
                         return {"ok": True}
 
                     elif step == 4:  # Price
-                        price_text = text.strip()
+                        price_text = t
                         if not price_text:
                             send_message(chat_id, "❌ Price cannot be empty. Please enter a valid price:")
                             return {"ok": True}
+                        if not _DEC_RE.fullmatch(price_text):
+                            send_message(chat_id, "❌ Invalid price. Please enter a positive number:")
+                            return {"ok": True}
                         try:
                             price = float(price_text)
                             if price <= 0:
@@ -5858,16 +6488,19 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             data["price"] = price
                             user_states[chat_id] = {"action": action, "step": 5, "data": data}
                             send_message(chat_id, "📊 Enter minimum stock level (e.g., 10):")
-                            print(f"🔍 DEBUG: Price saved, moving to step 5")
+                            logger.debug("🔍 DEBUG: Price saved, moving to step 5")
                         except ValueError:
                             send_message(chat_id, "❌ Invalid price. Please enter a positive number:")
                         return {"ok": True}
 
                     elif step == 5:  # Min Stock Level
-                        min_stock_text = text.strip()
+                        min_stock_text = t
                         if not min_stock_text:
                             send_message(chat_id, "❌ Minimum stock level cannot be empty. Please enter a valid number:")
                             return {"ok": True}
+                        if not _INT_RE.fullmatch(min_stock_text):
+                            send_message(chat_id, "❌ Invalid number. Please enter a valid minimum stock level:")
+                            return {"ok": True}
                         try:
                             min_stock = int(min_stock_text)
                             if min_stock < 0:
@@ -5876,16 +6509,19 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             data["min_stock_level"] = min_stock
                             user_states[chat_id] = {"action": action, "step": 6, "data": data}
                             send_message(chat_id, "⚠️ Enter low stock threshold (e.g., 5):")
-                            print(f"🔍 DEBUG: Min stock saved, moving to step 6")
+                            logger.debug("🔍 DEBUG: Min stock saved, moving to step 6")
                         except ValueError:
                             send_message(chat_id, "❌ Invalid number. Please enter a valid minimum stock level:")
                         return {"ok": True}
 
                     elif step == 6:  # Low Stock Threshold
-                        threshold_text = text.strip()
+                        threshold_text = t
                         if not threshold_text:
                             send_message(chat_id, "❌ Low stock threshold cannot be empty. Please enter a valid number:")
                             return {"ok": True}
+                        if not _INT_RE.fullmatch(threshold_text):
+                            send_message(chat_id, "❌ Invalid number. Please enter a valid low stock threshold:")
+                            return {"ok": True}
                         try:
                             threshold = int(threshold_text)
                             if threshold < 0:
@@ -5893,7 +6529,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                                 return {"ok": True}
                             data["low_stock_threshold"] = threshold
 
-                            print(f"🔍 DEBUG: Calling add_product function with data: {data}")
+                            logger.debug("🔍 DEBUG: Calling add_product function with data: %s", data)
                             # ✅ CORRECT: Call add_product with the right parameters (no 'user' parameter)
                             from app.routes.telegram import add_product
                             result = add_product(tenant_db, chat_id, data)
@@ -5908,24 +6544,21 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                                 pass
                 
                             user_states.pop(chat_id, None)
-                            print(f"🔍 DEBUG: Product saved, clearing state")
+                            logger.debug("🔍 DEBUG: Product saved, clearing state")
             
                             # Return to main menu
-                            from app.user_management import get_role_based_menu
-                            kb = get_role_based_menu(user.role)
+                            kb = role_menu_keyboard(user.role)
                             send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
             
                         except ValueError as e:
                             send_message(chat_id, f"❌ Invalid number: {e}")
                         except Exception as e:
-                            print(f"❌ DEBUG: Exception in step 6: {e}")
-                            import traceback
-                            traceback.print_exc()
+                            logger.exception("❌ Exception in step 6: %s", e)
                             send_message(chat_id, f"❌ Error saving product: {e}")
                         return {"ok": True}
 
                     else:
-                        print(f"❌ DEBUG: Unknown step {step} in awaiting_product")
+                        logger.error("❌ Unknown step %s in awaiting_product", step)
                         send_message(chat_id, "❌ Invalid step in product creation. Please start over.")
                         user_states.pop(chat_id, None)
                         return {"ok": True}
@@ -5942,7 +6575,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
 
                     # STEP 1: Search for product
                     if step == 1:
-                        product_name = text.strip()
+                        product_name = t
                         if not product_name:
                             send_message(chat_id, "❌ Product name cannot be empty. Please enter a product name:")
                             return {"ok": True}
@@ -6036,7 +6669,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
             
                             data["selected_shop_id"] = user.shop_id
                             # Get shop name for display
-                            shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == user.shop_id).first()
+                            shop = tenant_db.get(ShopORM, user.shop_id)
                             data["selected_shop_name"] = shop.name if shop else "Your Shop"
             
                             # Show product selection
@@ -6078,11 +6711,14 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
 
                     # STEP 2: Enter quantity to add
                     elif step == 2:
-                        quantity_text = text.strip()
+                        quantity_text = t
                         if not quantity_text:
                             send_message(chat_id, "❌ Quantity cannot be empty. Enter quantity to add:")
                             return {"ok": True}
 
+                        if not _INT_RE.fullmatch(quantity_text):
+                            send_message(chat_id, "❌ Invalid quantity. Enter a valid number:")
+                            return {"ok": True}
                         try:
                             quantity_to_add = int(quantity_text)
                             if quantity_to_add <= 0:
@@ -6098,7 +6734,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                                 return {"ok": True}
 
                             # Get shop name for display
-                            shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                            shop = tenant_db.get(ShopORM, shop_id)
                             shop_name = shop.name if shop else f"Shop ID: {shop_id}"
             
                             if user.role == "owner":
@@ -6136,8 +6772,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
 
                                 # Return to main menu
                                 user_states.pop(chat_id, None)
-                                from app.user_management import get_role_based_menu
-                                kb = get_role_based_menu(user.role)
+                                kb = role_menu_keyboard(user.role)
                                 send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
                 
                             else:
@@ -6172,9 +6807,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                                 }
 
                                 # Create pending approval for stock update
-                                from app.core import SessionLocal
-                                central_db = SessionLocal()
-                                shopkeeper_user = central_db.query(User).filter(User.chat_id == chat_id).first()
+                                shopkeeper_user = user
 
                                 if shopkeeper_user:
                                     pending_stock = PendingApprovalORM(
@@ -6187,33 +6820,28 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                                     )
 
                                     tenant_db.add(pending_stock)
+                                    tenant_db.flush()  # approval_id comes back from the INSERT
+                                    approval_id = pending_stock.approval_id
                                     tenant_db.commit()
-                                    tenant_db.refresh(pending_stock)
 
                                     # Notify owner
-                                    owner = central_db.query(User).filter(
-                                        User.tenant_schema == shopkeeper_user.tenant_schema,
-                                        User.role == 'owner'
-                                    ).first()
+                                    owner_chat_id = get_owner_chat_id(db, shopkeeper_user.tenant_schema)
 
-                                    if owner:
+                                    if owner_chat_id:
                                         from app.telegram_notifications import notify_owner_of_stock_update_request
                                         notify_owner_of_stock_update_request(
-                                            owner.chat_id,
+                                            owner_chat_id,
                                             product["name"],
                                             old_stock,
                                             new_stock,
                                             shopkeeper_user.name,
-                                            pending_stock.approval_id,
+                                            approval_id,
                                             shop_id
                                         )
 
-                                    central_db.close()
-
                                     send_message(chat_id, f"✅ Stock update request submitted for approval. Owner will review adding +{quantity_to_add} to {product['name']} at {shop_name}.")
                                 else:
                                     send_message(chat_id, "❌ Failed to submit stock update request.")
-                                    central_db.close()
 
                                 user_states.pop(chat_id, None)
 
@@ -6235,19 +6863,20 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                     data = state.get("data", {})
 
                     if step == 2:  # Search product
-                        product_name = text.strip()
+                        product_name = t
                         if not product_name:
                             send_message(chat_id, "❌ Product name cannot be empty. Please enter product name:")
                             return {"ok": True}
 
-                        # Search for products
+                        # Search for products (one extra row tells us the list was cut)
                         matches = tenant_db.query(ProductORM).filter(
                             ProductORM.name.ilike(f"%{product_name}%")
-                        ).all()
+                        ).order_by(ProductORM.name).limit(PRODUCT_SEARCH_LIMIT + 1).all()
 
                         if not matches:
                             send_message(chat_id, "❌ No products found. Please try again:")
                             return {"ok": True}
+                        matches, more = matches[:PRODUCT_SEARCH_LIMIT], len(matches) > PRODUCT_SEARCH_LIMIT
 
                         if len(matches) == 1:
                             product = matches[0]
@@ -6272,14 +6901,17 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                                 }])
                             kb_rows.append([{"text": "❌ Cancel", "callback_data": "view_all_shops"}])
             
-                            send_message(chat_id, "🔍 Multiple products found. Select one:", {"inline_keyboard": kb_rows})
+                            send_message(chat_id, "🔍 Multiple products found. Select one:" + (SEARCH_MORE_HINT if more else ""), {"inline_keyboard": kb_rows})
 
                     elif step == 3:  # Enter stock quantity
-                        quantity_text = text.strip()
+                        quantity_text = t
                         if not quantity_text:
                             send_message(chat_id, "❌ Quantity cannot be empty. Enter initial stock quantity:")
                             return {"ok": True}
 
+                        if not _INT_RE.fullmatch(quantity_text):
+                            send_message(chat_id, "❌ Invalid quantity. Enter a valid number:")
+                            return {"ok": True}
                         try:
                             quantity = int(quantity_text)
                             if quantity < 0:
@@ -6320,8 +6952,8 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             tenant_db.commit()
 
                             # Get product and shop names for confirmation
-                            product = tenant_db.query(ProductORM).filter(ProductORM.product_id == product_id).first()
-                            shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+                            product = tenant_db.get(ProductORM, product_id)
+                            shop = tenant_db.get(ShopORM, shop_id)
 
                             if product and shop:
                                 message += f"\n\n🏪 *{shop.name}*\n"
@@ -6336,8 +6968,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
 
                         # Clear state and return to menu
                         user_states.pop(chat_id, None)
-                        from app.user_management import get_role_based_menu
-                        kb = get_role_based_menu(user.role)
+                        kb = role_menu_keyboard(user.role)
                         send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
 
                     return {"ok": True}
@@ -6355,11 +6986,11 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
 
                     # -------------------- STEP 1: Search by product name --------------------
                     if step == 1:
-                        if not text or not text.strip():
+                        if not t:
                             send_message(chat_id, "⚠️ Please enter a product name to search:")
                             return {"ok": True}
 
-                        query_text = text.strip()
+                        query_text = t
     
                         # DEBUG: Check what we're working with
                         logger.info(f"🔍 SEARCH DEBUG: Using tenant_schema: {user.tenant_schema}")
@@ -6372,10 +7003,13 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             ).filter(
                                 ProductORM.name.ilike(f"%{query_text}%"),
                                 ProductShopStockORM.shop_id == user.shop_id
-                            ).all()
+                            ).order_by(ProductORM.name).limit(PRODUCT_SEARCH_LIMIT + 1).all()
                         else:
                             # Owner can see all products
-                            matches = tenant_db.query(ProductORM).filter(ProductORM.name.ilike(f"%{query_text}%")).all()
+                            matches = tenant_db.query(ProductORM).filter(
+                                ProductORM.name.ilike(f"%{query_text}%")
+                            ).order_by(ProductORM.name).limit(PRODUCT_SEARCH_LIMIT + 1).all()
+                        matches, more = matches[:PRODUCT_SEARCH_LIMIT], len(matches) > PRODUCT_SEARCH_LIMIT
     
                         logger.info(f"🔍 SEARCH DEBUG: Found {len(matches)} products: {[f'ID:{m.product_id} {m.name}' for m in matches]}")
 
@@ -6398,7 +7032,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                               "callback_data": f"select_update:{p.product_id}"}] for p in matches
                         ]
                         kb_rows.append([{"text": "⬅️ Cancel", "callback_data": "back_to_menu"}])
-                        send_message(chat_id, "🔹 Multiple products found. Please select:", {"inline_keyboard": kb_rows})
+                        send_message(chat_id, "🔹 Multiple products found. Please select:" + (SEARCH_MORE_HINT if more else ""), {"inline_keyboard": kb_rows})
                         return {"ok": True}
 
                     # -------------------- STEP 2+: update fields --------------------
@@ -6409,7 +7043,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             user_states.pop(chat_id, None)
                             return {"ok": True}
 
-                        product = tenant_db.query(ProductORM).filter(ProductORM.product_id == product_id).first()
+                        product = tenant_db.get(ProductORM, product_id)
                         if not product:
                             send_message(chat_id, "⚠️ Product not found. Please start again.")
                             user_states.pop(chat_id, None)
@@ -6417,7 +7051,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
 
                         # --- Proceed step-by-step: name → price → unit → category/shop (REMOVED: quantity, min_stock, low_threshold) ---
                         if step == 2:  # new name
-                            val = text.strip()
+                            val = t
                             if val == "":
                                 send_message(chat_id, "⚠️ Please enter a valid name or '-' to keep current:")
                                 return {"ok": True}
@@ -6428,11 +7062,14 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             return {"ok": True}
 
                         if step == 3:  # price
-                            val = text.strip()
+                            val = t
                             if val == "":
                                 send_message(chat_id, "⚠️ Please enter a valid price or '-' to keep current:")
                                 return {"ok": True}
                             if val != "-":
+                                if not _DEC_RE.fullmatch(val):
+                                    send_message(chat_id, "❌ Invalid price. Enter a number or `-` to skip:")
+                                    return {"ok": True}
                                 try:
                                     price_val = float(val)
                                     if price_val <= 0:
@@ -6447,7 +7084,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             return {"ok": True}
 
                         if step == 4:  # unit
-                            val = text.strip()
+                            val = t
                             if val == "":
                                 send_message(chat_id, "⚠️ Please enter a valid unit type or '-' to keep current:")
                                 return {"ok": True}
@@ -6460,12 +7097,12 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             return {"ok": True}
 
                         if step == 5:  # update shop stocks?
-                            val = text.strip().lower()
+                            val = tl
                             if val == "":
                                 send_message(chat_id, "⚠️ Please enter 'yes' to update shop stocks or '-' to skip:")
                                 return {"ok": True}
                             
-                            if val == "yes":
+                            if val == YES:
                                 # Get all shops that have this product in stock
                                 shop_stocks = tenant_db.query(ProductShopStockORM).filter(
                                     ProductShopStockORM.product_id == product_id
@@ -6486,7 +7123,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                                 
                                 # Get shop name for first shop
                                 first_stock = shop_stocks[0]
-                                shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == first_stock.shop_id).first()
+                                shop = tenant_db.get(ShopORM, first_stock.shop_id)
                                 shop_name = shop.name if shop else f"Shop {first_stock.shop_id}"
                                 
                                 user_states[chat_id] = {"action": "awaiting_update", "step": 6, "data": data}
@@ -6499,7 +7136,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                                 return {"ok": True}
 
                         if step == 6:  # update stock for each shop
-                            val = text.strip()
+                            val = t
                             current_index = data.get("current_shop_index", 0)
                             shop_stocks = data.get("shop_stocks", [])
                             
@@ -6509,6 +7146,9 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                                 return {"ok": True}
                             
                             if val != "-":
+                                if not _INT_RE.fullmatch(val):
+                                    send_message(chat_id, "❌ Invalid number. Enter an integer or `-` to skip:")
+                                    return {"ok": True}
                                 try:
                                     new_stock = int(val)
                                     if new_stock < 0:
@@ -6527,7 +7167,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             if next_index < len(shop_stocks):
                                 # Get next shop info
                                 next_stock = shop_stocks[next_index]
-                                shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == next_stock["shop_id"]).first()
+                                shop = tenant_db.get(ShopORM, next_stock["shop_id"])
                                 shop_name = shop.name if shop else f"Shop {next_stock['shop_id']}"
                                 
                                 user_states[chat_id] = {"action": "awaiting_update", "step": 6, "data": data}
@@ -6539,16 +7179,15 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             return {"ok": True}
 
                         if step == 7:  # confirmation
-                            val = text.strip().lower()
+                            val = tl
                             if val == "":
                                 send_message(chat_id, "⚠️ Please enter 'yes' or 'no':")
                                 return {"ok": True}
                             
-                            if val != "yes":
+                            if val != YES:
                                 send_message(chat_id, "❌ Update cancelled.")
                                 user_states.pop(chat_id, None)
-                                from app.user_management import get_role_based_menu
-                                kb = get_role_based_menu(user.role)
+                                kb = role_menu_keyboard(user.role)
                                 send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
                                 return {"ok": True}
                             
@@ -6579,8 +7218,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             
                             # ✅ Return to main menu
                             user_states.pop(chat_id, None)  # Clear state
-                            from app.user_management import get_role_based_menu
-                            kb = get_role_based_menu(user.role)
+                            kb = role_menu_keyboard(user.role)
                             send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
                             return {"ok": True}
                                                         
@@ -6592,7 +7230,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         send_message(chat_id, "❌ Unable to access tenant database.")
                         return {"ok": True}
 
-                    data = state.get("data", {})
+                    data = state.setdefault("data", {})
     
                     # Initialize cart if not exists
                     if "cart" not in data:
@@ -6603,7 +7241,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
         
                     # STEP 1: search by product name (Add to cart)
                     if step == 1:
-                        if not text or not text.strip():
+                        if not t:
                             send_message(chat_id, "⚠️ Please enter a product name to add to cart:")
                             return {"ok": True}
 
@@ -6624,11 +7262,12 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         ).filter(
                             ProductShopStockORM.shop_id == shop_id,
                             ProductORM.name.ilike(f"%{text}%")
-                        ).all()
+                        ).order_by(ProductORM.name).limit(PRODUCT_SEARCH_LIMIT + 1).all()
                         
                         if not matches:
                             send_message(chat_id, "⚠️ No products found with that name in this shop. Try again:")
                             return {"ok": True}
+                        matches, more = matches[:PRODUCT_SEARCH_LIMIT], len(matches) > PRODUCT_SEARCH_LIMIT
 
                         if len(matches) == 1:
                             stock_item, product = matches[0]
@@ -6640,7 +7279,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                                 "available_stock": stock_item.stock,  # CORRECT: Shop-specific stock
                                 "stock_id": stock_item.id  # For updating stock later
                             }
-                            user_states[chat_id] = {"action": "awaiting_sale", "step": 2, "data": data}
+                            state["step"] = 2
                             send_message(chat_id, f"📦 Selected {product.name} ({product.unit_type}). Enter quantity to add:")
                             return {"ok": True}
 
@@ -6654,7 +7293,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             }])
                         
                         kb_rows.append([{"text": "🛒 View Cart", "callback_data": "view_cart"}])
-                        send_message(chat_id, "🔹 Multiple products found. Please select:", {"inline_keyboard": kb_rows})
+                        send_message(chat_id, "🔹 Multiple products found. Please select:" + (SEARCH_MORE_HINT if more else ""), {"inline_keyboard": kb_rows})
                         return {"ok": True}
 
                     # STEP 2: quantity for current product
@@ -6662,10 +7301,13 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                         logger.info(f"🔍 DEBUG: Current product data: {data.get('current_product')}")  # Debug
                         logger.info(f"🔍 DEBUG: Full data: {data}")  # Debug
                         
-                        qty_text = text.strip()
+                        qty_text = t
                         if not qty_text:
                             send_message(chat_id, "❌ Quantity cannot be empty. Please enter a valid quantity:")
                             return {"ok": True}
+                        if not _INT_RE.fullmatch(qty_text):
+                            send_message(chat_id, "❌ Invalid quantity. Enter a positive integer:")
+                            return {"ok": True}
                         try:
                             qty = int(qty_text)
                             if qty <= 0:
@@ -6708,7 +7350,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             
                             # ✅ CRITICAL: Update state with cart data preserved
                             data.pop("current_product", None)  # Clear current product
-                            user_states[chat_id] = {"action": "awaiting_sale", "step": 1, "data": data}  # Stay at step 1 but with updated cart
+                            state["step"] = 1  # Stay at step 1 but with updated cart
                             
                         except ValueError:
                             send_message(chat_id, "❌ Invalid quantity. Enter a positive integer:")
@@ -6716,11 +7358,11 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
 
                     # STEP 3: checkout - payment method
                     elif step == 3:
-                        payment_method = text.strip().lower()
+                        payment_method = tl
                         if not payment_method:
                             send_message(chat_id, "❌ Payment method cannot be empty. Choose: cash, ecocash, swipe:")
                             return {"ok": True}
-                        if payment_method not in ["cash", "ecocash", "swipe"]:
+                        if payment_method not in PAYMENT_METHODS:
                             send_message(chat_id, "❌ Invalid method. Choose: cash, ecocash, swipe:")
                             return {"ok": True}
 
@@ -6732,7 +7374,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
     
                         # If payment method is CASH, ask for sale type (cash/credit)
                         if payment_method == "cash":
-                            user_states[chat_id] = {"action": "awaiting_sale", "step": 3.1, "data": data}
+                            state["step"] = 3.1
         
                             kb_rows = [
                                 [{"text": "💵 Cash Sale", "callback_data": "sale_type:cash"}],
@@ -6749,237 +7391,28 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             data["pending_amount"] = 0
                             data["change_left"] = 0
         
-                            user_states[chat_id] = {"action": "awaiting_sale", "step": 6, "data": data}
+                            state["step"] = 6
                             send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n✅ {payment_method.title()} payment confirmed.\n\nConfirm sale? (yes/no)")
     
                         return {"ok": True}
                             
-                    # STEP 3.1: Cash sale type selection (callback handler)
-                    elif text.startswith("sale_type:"):
-                        sale_type = text.split(":")[1]
-    
-                        # Get current state
-                        current_state = user_states.get(chat_id, {})
-                        current_data = current_state.get("data", {})
-    
-                        current_data["sale_type"] = sale_type
-    
-                        if sale_type == "cash":
-                            # For cash sales, ask for amount tendered
-                            current_data["payment_type"] = "full"  # Cash sales are always full payment
-                            user_states[chat_id] = {"action": "awaiting_sale", "step": 4, "data": current_data}
-        
-                            cart_total = sum(item["subtotal"] for item in current_data["cart"])
-                            send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n💵 Enter cash amount tendered by customer:")
-    
-                        else:  # credit
-                            # For credit sales, ask for payment type (full/partial credit)
-                            user_states[chat_id] = {"action": "awaiting_sale", "step": 3.2, "data": current_data}
-        
-                            kb_rows = [
-                                [{"text": "💰 Full Credit", "callback_data": "credit_type:full"}],
-                                [{"text": "📋 Partial Credit", "callback_data": "credit_type:partial"}],
-                                [{"text": "⬅️ Back", "callback_data": "view_cart"}]
-                            ]
-        
-                            cart_total = sum(item["subtotal"] for item in current_data["cart"])
-                            send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n\n💳 Select credit type:", {"inline_keyboard": kb_rows})
-    
-                        return {"ok": True}
-    
-                    # STEP 3.2: Credit type selection (callback handler)
-                    elif text.startswith("credit_type:"):
-                        credit_type = text.split(":")[1]
-    
-                        # Get current state
-                        current_state = user_states.get(chat_id, {})
-                        current_data = current_state.get("data", {})
-    
-                        current_data["payment_type"] = credit_type  # full or partial
-    
-                        if credit_type == "full":
-                            # Full credit - no payment, go straight to customer details
-                            current_data["amount_paid"] = 0
-                            current_data["pending_amount"] = current_data["cart_total"]
-                            current_data["change_left"] = 0
-        
-                            user_states[chat_id] = {"action": "awaiting_sale", "step": 5, "data": current_data}
-                            send_message(chat_id, "🔄 Full credit sale.\n👤 Enter customer name for credit follow-up:")
-    
-                        else:  # partial
-                            # Partial credit - ask for amount paid
-                            user_states[chat_id] = {"action": "awaiting_sale", "step": 4, "data": current_data}
-        
-                            cart_total = sum(item["subtotal"] for item in current_data["cart"])
-                            send_message(chat_id, f"💰 Cart Total: ${cart_total:.2f}\n💵 Enter amount paid now (remaining will be credit):")
-    
+                    # STEP 3.1 / 3.2: sale type and credit type arrive as callbacks;
+                    # typed equivalents share the callback handlers
+                    elif text.startswith(("sale_type:", "credit_type:")):
+                        prefix, _, arg = text.partition(":")
+                        PREFIX_HANDLERS[prefix](chat_id, user, db, arg)
                         return {"ok": True}
     
-                    # STEP 4: amount tendered
-                    elif step == 4:
-                        amount_text = text.strip()
-                        if not amount_text:
-                            send_message(chat_id, "❌ Amount cannot be empty. Please enter a valid amount:")
-                            return {"ok": True}
-                        try:
-                            amount_paid = float(amount_text)
-                            if amount_paid < 0:
-                                send_message(chat_id, "❌ Amount cannot be negative. Please enter a valid amount:")
-                                return {"ok": True}
-        
-                            # Calculate cart_total from cart
-                            cart_total = sum(item["subtotal"] for item in data["cart"])
-        
-                            data["amount_paid"] = amount_paid
-                            data["cart_total"] = cart_total
-        
-                            # Calculate based on sale type
-                            if data.get("sale_type") == "credit":
-                                # Credit sale with partial payment
-                                data["pending_amount"] = max(cart_total - amount_paid, 0)
-                                data["change_left"] = 0  # No change for credit sales
-            
-                                # Always ask for customer details for credit sales
-                                user_states[chat_id] = {"action": "awaiting_sale", "step": 5, "data": data}
-                                send_message(chat_id, f"📋 Partial credit sale.\nAmount paid: ${amount_paid:.2f}\nPending: ${data['pending_amount']:.2f}\n\n👤 Enter customer name:")
-            
-                            else:  # cash sale
-                                data["pending_amount"] = 0
-                                data["change_left"] = max(amount_paid - cart_total, 0)
-            
-                                # Show payment summary
-                                summary_msg = f"💵 Payment Summary:\n"
-                                summary_msg += get_cart_summary(data["cart"])
-                                summary_msg += f"💰 Total: ${cart_total:.2f}\n"
-                                summary_msg += f"💵 Tendered: ${amount_paid:.2f}\n"
-            
-                                if data["change_left"] > 0:
-                                    summary_msg += f"🪙 Change Due: ${data['change_left']:.2f}\n\n"
-                                    # Ask if shopkeeper has change
-                                    kb_rows = [
-                                        [{"text": "✅ Yes, I have change", "callback_data": "has_change:yes"}],
-                                        [{"text": "❌ No, need customer details", "callback_data": "has_change:no"}]
-                                    ]
-                                    summary_msg += "Do you have change for the customer?"
-                                    send_message(chat_id, summary_msg, {"inline_keyboard": kb_rows})
-                                    user_states[chat_id] = {"action": "awaiting_sale", "step": 4.1, "data": data}
-                                else:
-                                    # No change due - go straight to confirmation
-                                    summary_msg += "✅ Exact amount received.\n\nConfirm sale? (yes/no)"
-                                    user_states[chat_id] = {"action": "awaiting_sale", "step": 6, "data": data}
-                                    logger.info(f"🔍 STEP 4 → STEP 6 - No change due, awaiting confirmation. Chat: {chat_id}, Customer Name: {data.get('customer_name')}")
-                                    send_message(chat_id, summary_msg)
-                                            
-                        except ValueError:
-                            send_message(chat_id, "❌ Invalid number. Enter a valid amount:")
+                    # STEPS 4-7: see SALE_STEP_HANDLERS
+                    elif step in SALE_STEP_HANDLERS:
+                        SALE_STEP_HANDLERS[step](chat_id, user, tenant_db, state, data, t)
                         return {"ok": True}
-        
+
                     # STEP 4.1: Change availability check (callback handler)
                     elif text.startswith("has_change:"):
-                        has_change = text.split(":")[1]
-    
-                        # Get current state
-                        current_state = user_states.get(chat_id, {})
-                        current_data = current_state.get("data", {})
-    
-                        if has_change == "yes":
-                            # Has change - no customer details needed
-                            user_states[chat_id] = {"action": "awaiting_sale", "step": 6, "data": current_data}
-                            send_message(chat_id, "✅ Change ready. Confirm sale? (yes/no)")
-                        else:
-                            # No change - need customer details for follow-up
-                            user_states[chat_id] = {"action": "awaiting_sale", "step": 5, "data": current_data}
-                            send_message(chat_id, "👤 Enter customer name (for change follow-up):")
-    
-                        return {"ok": True}
-                        
-                    # STEP 5: customer name (ONLY when needed - credit or no change)
-                    elif step == 5:
-                        customer_name = text.strip()
-                        if not customer_name:
-                            send_message(chat_id, "❌ Customer name cannot be empty. Please enter customer name:")
-                            return {"ok": True}
-    
-                        data["customer_name"] = customer_name
-    
-                        # FIXED: Always go to step 6 for contact collection
-                        # Whether it's credit sale or change due, we should collect contact
-                        user_states[chat_id] = {"action": "awaiting_sale", "step": 6, "data": data}
-    
-                        # Ask for contact (optional)
-                        if data.get("sale_type") == "credit":
-                            send_message(chat_id, "📞 Enter customer contact number (optional for credit follow-up) or type 'skip':")
-                        else:
-                            send_message(chat_id, "📞 Enter customer contact number (optional for change follow-up) or type 'skip':")
-    
-                        return {"ok": True}
-    
-                    # STEP 5.1: Customer contact (optional)
-                    elif step == 5.1:
-                        customer_contact = text.strip()
-                        if customer_contact.lower() == "skip":
-                            customer_contact = ""
-    
-                        data["customer_contact"] = customer_contact
-                        user_states[chat_id] = {"action": "awaiting_sale", "step": 6, "data": data}
-                        send_message(chat_id, f"✅ Customer info recorded. Confirm sale? (yes/no)")
-                        return {"ok": True}
-        
-                    # STEP 6: customer contact OR confirmation ONLY collect contact info - NEVER record sales here
-                    elif step == 6:
-                        logger.info(f"🔍 STEP 6 ENTERED - Collecting contact - Chat: {chat_id}, Text: '{text}'")
-    
-                        # This should ONLY be for collecting customer contact
-                        customer_contact = text.strip()
-    
-                        # Handle "skip" for optional contact
-                        if customer_contact.lower() == "skip":
-                            customer_contact = ""
-    
-                        data["customer_contact"] = customer_contact
-                        user_states[chat_id] = {"action": "awaiting_sale", "step": 7, "data": data}
-    
-                        # Now ask for confirmation
-                        send_message(chat_id, f"✅ Customer info recorded. Confirm sale? (yes/no)")
+                        _handle_has_change(chat_id, user, db, text.partition(":")[2])
                         return {"ok": True}
 
-                    # STEP 7: ONLY record sales here - this is the final confirmation step
-                    elif step == 7:
-                        logger.info(f"🔍 STEP 7 ENTERED - Final confirmation - Chat: {chat_id}, Text: '{text}'")
-    
-                        confirmation = text.strip().lower()
-                        if not confirmation:
-                            send_message(chat_id, "⚠️ Please confirm with 'yes' or 'no':")
-                            return {"ok": True}
-    
-                        if confirmation != "yes":
-                            send_message(chat_id, "❌ Sale cancelled.")
-                            user_states.pop(chat_id, None)
-                            from app.user_management import get_role_based_menu
-                            kb = get_role_based_menu(user.role)
-                            send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
-                            return {"ok": True}
-    
-                        logger.info(f"🎯 STEP 7 → Recording sale - Chat: {chat_id}")
-    
-                        # Record the sale (ONLY HERE!)
-                        record_sale_result = record_cart_sale(tenant_db, chat_id, data)
-    
-                        if record_sale_result:
-                            logger.info(f"✅ STEP 7 → Sale recorded successfully - Chat: {chat_id}")
-        
-                            # Clear state and return to menu
-                            user_states.pop(chat_id, None)
-                            from app.user_management import get_role_based_menu
-                            kb = get_role_based_menu(user.role)
-                            send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
-                        else:
-                            logger.error(f"❌ STEP 7 → Sale recording failed - Chat: {chat_id}")
-                            send_message(chat_id, "❌ Failed to record sale. Please try again.")
-                            user_states.pop(chat_id, None)
-    
-                        return {"ok": True}
-                                                                    
                 # -------------------- Record Payment Flow --------------------
                 elif action == "record_payment":
                     tenant_db = get_tenant_session(user.tenant_schema, chat_id)
@@ -6994,7 +7427,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
     
                     # STEP 2: Search for customer
                     if step == 2:
-                        customer_name = text.strip()
+                        customer_name = t
                         if not customer_name:
                             send_message(chat_id, "❌ Customer name cannot be empty. Please enter customer name:")
                             return {"ok": True}
@@ -7013,9 +7446,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             for sale in sales_with_credit:
                                 if sale.customer_id and sale.customer_id not in customer_ids:
                                     customer_ids.add(sale.customer_id)
-                                    customer = tenant_db.query(CustomerORM).filter(
-                                        CustomerORM.customer_id == sale.customer_id
-                                    ).first()
+                                    customer = tenant_db.get(CustomerORM, sale.customer_id)
                                     if customer and customer_name.lower() in customer.name.lower():
                                         # Calculate total pending for this customer
                                         customer_sales = tenant_db.query(SaleORM).filter(
@@ -7045,9 +7476,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             for sale in sales_with_change:
                                 if sale.customer_id and sale.customer_id not in customer_ids:
                                     customer_ids.add(sale.customer_id)
-                                    customer = tenant_db.query(CustomerORM).filter(
-                                        CustomerORM.customer_id == sale.customer_id
-                                    ).first()
+                                    customer = tenant_db.get(CustomerORM, sale.customer_id)
                                     if customer and customer_name.lower() in customer.name.lower():
                                         # Calculate total change due for this customer
                                         customer_sales = tenant_db.query(SaleORM).filter(
@@ -7131,10 +7560,13 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
     
                     # STEP 3: Enter payment amount
                     elif step == 3:
-                        amount_text = text.strip()
+                        amount_text = t
                         if not amount_text:
                             send_message(chat_id, "❌ Amount cannot be empty. Please enter amount:")
                             return {"ok": True}
+                        if not _DEC_RE.fullmatch(amount_text):
+                            send_message(chat_id, "❌ Invalid amount. Please enter a valid number:")
+                            return {"ok": True}
         
                         try:
                             amount = float(amount_text)
@@ -7192,8 +7624,8 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             pass
                         else:
                             # Change collection confirmation
-                            confirmation = text.strip().upper()
-                            if confirmation != "YES":
+                            confirmation = tl
+                            if confirmation != YES:
                                 send_message(chat_id, "❌ Change collection cancelled.")
                                 user_states.pop(chat_id, None)
                                 return {"ok": True}
@@ -7285,8 +7717,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
             
                             # Clear state and return to menu
                             user_states.pop(chat_id, None)
-                            from app.user_management import get_role_based_menu
-                            kb = get_role_based_menu(user.role)
+                            kb = role_menu_keyboard(user.role)
                             send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
         
                         return {"ok": True}
@@ -7298,8 +7729,8 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                             user_states.pop(chat_id, None)
                             return {"ok": True}
         
-                        confirmation = text.strip().upper()
-                        if confirmation != "YES":
+                        confirmation = tl
+                        if confirmation != YES:
                             send_message(chat_id, "❌ Credit payment cancelled.")
                             user_states.pop(chat_id, None)
                             return {"ok": True}
@@ -7396,8 +7827,7 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
         
                         # Clear state and return to menu
                         user_states.pop(chat_id, None)
-                        from app.user_management import get_role_based_menu
-                        kb = get_role_based_menu(user.role)
+                        kb = role_menu_keyboard(user.role)
                         send_message(chat_id, "🏠 Main Menu:", keyboard=kb)
         
                         return {"ok": True}
@@ -7405,14 +7835,17 @@ async def telegram_webhook(request: Request, db: Session = Depends(get_db)):
                           
                 # Reports
                 elif text == "📊 Reports":
-                    kb_dict = report_menu_keyboard(user.role)
-                    send_message(chat_id, "📊 Select a report:", kb_dict)
+                    kb = report_menu_json(user.role)
+                    send_message(chat_id, "📊 Select a report:", kb)
                     return {"ok": True}
                                                             
         return {"ok": True}
 
     
     except Exception as e:
-        print("❌ Webhook crashed with error:", str(e))
-        traceback.print_exc()
+        logger.exception(f"❌ Webhook crashed with error: {e}")
         return {"status": "error", "detail": str(e)}
+    finally:
+        # Hand the tenant connection back to its pool even on early return / error
+        if tenant_db is not None:
+            tenant_db.close()
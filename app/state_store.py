@@ -0,0 +1,205 @@
+# app/state_store.py
+import asyncio
+import functools
+import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Conversations idle for longer than this are dropped by the sweeper
+STATE_TTL_SECONDS = 1800
+SWEEP_INTERVAL_SECONDS = 60
+# Hard cap on locally held entries; least recently used are dropped first
+STATE_MAX_ENTRIES = 10_000
+
+
+# -------------------- TTL Conversation Store --------------------
+class TTLDict:
+    """
+    Dict-like store for per-chat conversation state.
+    Every read or write refreshes the entry's timestamp; entries left
+    idle (abandoned flows) are evicted by sweep(), and once more than
+    maxsize are held the least recently used one is dropped.
+    Instances are shared by threadpool, timer and executor threads, so
+    every access to the ordered dict goes through one lock.
+    """
+
+    def __init__(self, ttl=STATE_TTL_SECONDS, maxsize=STATE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (value, last_access), LRU first
+        self._lock = threading.RLock()
+
+    def _touch(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __setitem__(self, key, value):
+        self._touch(key, value)
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._data[key][0]
+            self._touch(key, value)
+            return value
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            self._touch(key, entry[0])
+            return entry[0]
+
+    def pop(self, key, *default):
+        with self._lock:
+            if default:
+                entry = self._data.pop(key, None)
+                return entry[0] if entry is not None else default[0]
+            return self._data.pop(key)[0]
+
+    def sweep(self):
+        """Remove entries idle for longer than the TTL. Returns number evicted."""
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            expired = [k for k, (_, ts) in self._data.items() if ts < cutoff]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+    def hydrate(self, key):
+        """Load the latest copy of one entry before handling an update (no-op in memory)."""
+
+    def flush(self, key):
+        """Persist one entry after handling an update (no-op in memory)."""
+
+
+# -------------------- Redis --------------------
+@functools.lru_cache(maxsize=None)
+def redis_client(url):
+    """One shared (connection-pooled) Redis client per URL."""
+    import redis
+
+    return redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2)
+
+
+# -------------------- Redis Lock Renewal --------------------
+class LockRenewer:
+    """
+    Background thread that resets the TTL of every registered Redis lock
+    each interval, so a lock held by a slow handler only expires if the
+    process dies. Locks must be created with thread_local=False: the
+    renewer thread has to see the token the handler thread acquired with.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._locks = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, lock):
+        with self._lock:
+            self._locks.add(lock)
+
+    def discard(self, lock):
+        with self._lock:
+            self._locks.discard(lock)
+
+    def renew_once(self):
+        """Reset the TTL of every held lock. Returns the number renewed."""
+        with self._lock:
+            locks = list(self._locks)
+        renewed = 0
+        for lock in locks:
+            try:
+                lock.reacquire()
+                renewed += 1
+            except Exception as e:
+                logger.warning(f"⚠️ Could not renew lock {lock.name}: {e}")
+        return renewed
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.renew_once()
+
+    def start(self, name="lock-renewer"):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+            self._thread.start()
+
+
+# -------------------- Redis-backed Conversation Store --------------------
+class RedisStateStore(TTLDict):
+    """
+    TTLDict whose entries are shared through Redis so any worker can continue
+    a conversation. The handler still works on the in-memory dict (including
+    in-place edits); hydrate() pulls the chat's state in before an update and
+    flush() writes it back afterwards with the same TTL.
+    Values are pickled: state holds Decimals and nested dicts that must come
+    back unchanged, and only this app ever writes them.
+    """
+
+    def __init__(self, url, ttl=STATE_TTL_SECONDS, prefix="tg:st:", maxsize=STATE_MAX_ENTRIES):
+        import redis
+
+        super().__init__(ttl, maxsize)
+        self.prefix = prefix
+        self._redis = redis_client(url)
+        self._errors = (redis.RedisError,)
+
+    def _key(self, key):
+        return f"{self.prefix}{key}"
+
+    def hydrate(self, key):
+        try:
+            raw = self._redis.get(self._key(key))
+        except self._errors as e:
+            logger.warning(f"⚠️ Redis unavailable, using local state for {key}: {e}")
+            return
+        if raw is None:
+            self.pop(key, None)
+        else:
+            self._touch(key, pickle.loads(raw))
+
+    def flush(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+        try:
+            if entry is None:
+                self._redis.delete(self._key(key))
+            else:
+                self._redis.set(self._key(key), pickle.dumps(entry[0]), ex=self.ttl)
+        except self._errors as e:
+            logger.warning(f"⚠️ Could not persist state for {key} to Redis: {e}")
+
+
+async def ttl_sweeper(store, interval=SWEEP_INTERVAL_SECONDS):
+    """Background task: periodically evict idle conversation state."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            evicted = store.sweep()
+            if evicted:
+                logger.info(f"🧹 Evicted {evicted} idle conversation state(s)")
+        except Exception as e:
+            logger.error(f"❌ State sweeper error: {e}")
@@ -1,92 +1,94 @@
 # app/telegram_notifications.py
-
-# TEMPORARY DEBUG - Add at the VERY TOP of telegram_notifications.py
-import os
-print("🟢 DEBUG: telegram_notifications.py is loading")
-print(f"🟢 DEBUG: TELEGRAM_BOT_TOKEN from os.getenv: {os.getenv('TELEGRAM_BOT_TOKEN')}")
+import logging
 
 from config import TELEGRAM_BOT_TOKEN
-print(f"🟢 DEBUG: TELEGRAM_BOT_TOKEN from config import: {TELEGRAM_BOT_TOKEN}")
-
-# Then your existing code...
 from telebot import TeleBot, types
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 from app.models.central_models import User
 from app.models.models import ProductORM, CustomerORM, SaleORM, PendingApprovalORM, ShopORM, ProductShopStockORM
 
-import re
+logger = logging.getLogger(__name__)
 
 LOW_STOCK_THRESHOLD = 10
 TOP_PRODUCT_THRESHOLD = 50
 HIGH_VALUE_SALE_THRESHOLD = 100
 
-# DEBUG: Bot initialization
-print(f"🟢 [telegram_notifications] Initializing bot...")
-print(f"🟢 [telegram_notifications] TELEGRAM_BOT_TOKEN length: {len(TELEGRAM_BOT_TOKEN)}")
-print(f"🟢 [telegram_notifications] TELEGRAM_BOT_TOKEN first 10 chars: {TELEGRAM_BOT_TOKEN[:10]}...")
-
 bot = TeleBot(TELEGRAM_BOT_TOKEN)
-print(f"🟢 [telegram_notifications] Bot initialized: {bot}")
+logger.info("🟢 Telegram notification bot initialized")
+
+# Every MarkdownV2 special character maps to its backslash-escaped form
+_MDV2_ESCAPES = str.maketrans({c: "\\" + c for c in r'_*[]()~`>#+-=|{}.!'})
+
 
 def escape_markdown_v2(text: str) -> str:
     """
     Safely escape text for Telegram MarkdownV2.
     """
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text or '')
+    return (text or '').translate(_MDV2_ESCAPES)
 
 # -------------------- Generic Message Sender --------------------
+def build_markup(keyboard):
+    """
+    Turn a keyboard (dict or InlineKeyboardMarkup) into something bot.send_message accepts.
+    Pre-serialized JSON (str/bytes) is passed through untouched.
+    """
+    # Case 0: Already serialized JSON → telebot sends strings as-is
+    if isinstance(keyboard, bytes):
+        return keyboard.decode("utf-8")
+    if isinstance(keyboard, str):
+        return keyboard
+
+    # Case 1: Already a valid InlineKeyboardMarkup
+    if isinstance(keyboard, types.InlineKeyboardMarkup):
+        return keyboard
+
+    # Case 2: Dict → Convert to InlineKeyboardMarkup
+    if isinstance(keyboard, dict) and "inline_keyboard" in keyboard:
+        markup = types.InlineKeyboardMarkup()
+        for row in keyboard["inline_keyboard"]:
+            buttons = []
+            for btn in row:
+                text_val = btn.get("text")
+                cb_val = btn.get("callback_data")
+                if not text_val or not cb_val:
+                    continue  # skip invalid buttons
+                # Escape button text as well
+                safe_btn_text = escape_markdown_v2(str(text_val))
+                buttons.append(
+                    types.InlineKeyboardButton(text=safe_btn_text, callback_data=cb_val)
+                )
+            if buttons:
+                markup.add(*buttons)
+        return markup
+
+    return None
+
+
+def keyboard_json(keyboard):
+    """Serialize a keyboard dict once so static menus can be sent without rebuilding."""
+    markup = build_markup(keyboard)
+    return markup.to_json() if markup is not None else None
+
+
 def send_message(user_id, text, keyboard=None):
     """
-    Send Telegram message with optional inline keyboard (dict or InlineKeyboardMarkup).
+    Send Telegram message with optional inline keyboard
+    (dict, InlineKeyboardMarkup, or pre-serialized JSON str/bytes).
     Escapes text safely for MarkdownV2.
     """
-    print(f"🟢 [send_message] START: user_id={user_id}, text={text[:50]}...")
-    
     try:
-        markup = None
-
         # Escape the text for MarkdownV2
         safe_text = escape_markdown_v2(text)
-        print(f"🟢 [send_message] Text escaped: {safe_text[:50]}...")
-
-        # Case 1: Already a valid InlineKeyboardMarkup
-        if isinstance(keyboard, types.InlineKeyboardMarkup):
-            markup = keyboard
-            print(f"🟢 [send_message] Using InlineKeyboardMarkup")
-
-        # Case 2: Dict → Convert to InlineKeyboardMarkup
-        elif isinstance(keyboard, dict) and "inline_keyboard" in keyboard:
-            markup = types.InlineKeyboardMarkup()
-            print(f"🟢 [send_message] Converting dict to keyboard")
-            for row in keyboard["inline_keyboard"]:
-                buttons = []
-                for btn in row:
-                    text_val = btn.get("text")
-                    cb_val = btn.get("callback_data")
-                    if not text_val or not cb_val:
-                        continue  # skip invalid buttons
-                    # Escape button text as well
-                    safe_btn_text = escape_markdown_v2(str(text_val))
-                    buttons.append(
-                        types.InlineKeyboardButton(text=safe_btn_text, callback_data=cb_val)
-                    )
-                if buttons:
-                    markup.add(*buttons)
-            print(f"🟢 [send_message] Keyboard created with {len(keyboard['inline_keyboard'])} rows")
+        markup = build_markup(keyboard)
 
         # Send safely using MarkdownV2
-        print(f"🟢 [send_message] Calling bot.send_message...")
         result = bot.send_message(user_id, safe_text, reply_markup=markup, parse_mode="MarkdownV2")
-        print(f"✅ [send_message] SUCCESS: Message sent to {user_id}, message_id: {result.message_id}")
+        logger.debug("✅ [send_message] Sent to %s, message_id: %s", user_id, result.message_id)
         return True
 
     except Exception as e:
-        print(f"❌ [send_message] ERROR: {e}")
-        print("➡️ Keyboard passed in:", keyboard)
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ [send_message] Failed for {user_id} (keyboard: {keyboard!r}): {e}")
         return False
 
 # ==================== SHOP-SPECIFIC NOTIFICATIONS ====================
@@ -203,7 +205,7 @@ def notify_high_value_sale(db: Session, sale: SaleORM):
     """
     if sale.total_amount >= HIGH_VALUE_SALE_THRESHOLD:
         # Get shop info
-        shop = db.query(ShopORM).filter(ShopORM.shop_id == sale.shop_id).first()
+        shop = db.get(ShopORM, sale.shop_id) if sale.shop_id else None
         shop_name = shop.name if shop else f"Shop {sale.shop_id}"
         
         # Get recipients
@@ -236,19 +238,23 @@ def send_daily_sales_summary(db: Session, shop_id: int = None):
     """
     Send daily sales summary to owner(s) and shop admins.
     """
-    from datetime import date, datetime
+    from datetime import date, datetime, timedelta
     today = date.today()
+    day_start = datetime.combine(today, datetime.min.time())
     
-    # Build query based on shop_id
+    # Build query based on shop_id (range filter so the sale_date index applies)
     query = db.query(
         func.sum(SaleORM.quantity).label("total_qty"),
         func.sum(SaleORM.total_amount).label("total_revenue"),
         func.count(SaleORM.sale_id).label("total_sales")
-    ).filter(func.date(SaleORM.sale_date) == today)
+    ).filter(
+        SaleORM.sale_date >= day_start,
+        SaleORM.sale_date < day_start + timedelta(days=1)
+    )
     
     if shop_id:
         query = query.filter(SaleORM.shop_id == shop_id)
-        shop = db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+        shop = db.get(ShopORM, shop_id)
         shop_name = shop.name if shop else f"Shop {shop_id}"
         scope = f"Shop: {shop_name}"
     else:
@@ -296,7 +302,7 @@ def notify_owner_of_new_product(shopkeeper_chat_id: int, product_data: dict, ten
     Notify owner when a shopkeeper adds a new product (awaiting approval).
     """
     # Get shop info
-    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+    shop = tenant_db.get(ShopORM, shop_id)
     shop_name = shop.name if shop else f"Shop {shop_id}"
     
     # Get shopkeeper info
@@ -328,7 +334,7 @@ def notify_owner_of_product_update(shopkeeper_chat_id: int, product: ProductORM,
     Notify owner when a shopkeeper updates product details (limited: quantity, unit type).
     """
     # Get shop info
-    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
+    shop = tenant_db.get(ShopORM, shop_id)
     shop_name = shop.name if shop else f"Shop {shop_id}"
     
     # Get shopkeeper info
@@ -359,7 +365,7 @@ def notify_owner_of_new_shop_user(user: User, tenant_db: Session):
     Notify the owner when a new shop user (admin/shopkeeper) is created.
     """
     # Get shop info
-    shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == user.shop_id).first()
+    shop = tenant_db.get(ShopORM, user.shop_id) if user.shop_id else None
     shop_name = shop.name if shop else f"Shop {user.shop_id}"
     
     # Get owner(s)
@@ -388,11 +394,10 @@ def notify_owner_of_pending_approval(owner_chat_id: int, action_type: str, produ
         shop_info = ""
         if shop_id:
             from app.core import SessionLocal
-            tenant_db = SessionLocal()
-            shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
-            if shop:
-                shop_info = f"\n🏪 *Shop:* {shop.name}"
-            tenant_db.close()
+            with SessionLocal() as tenant_db:
+                shop = tenant_db.get(ShopORM, shop_id)
+                if shop:
+                    shop_info = f"\n🏪 *Shop:* {shop.name}"
         
         # Create the notification message
         message = f"🔄 *Pending Approval Required*\n\n"
@@ -417,7 +422,7 @@ def notify_owner_of_pending_approval(owner_chat_id: int, action_type: str, produ
         return True
 
     except Exception as e:
-        print(f"❌ Failed to send approval notification: {e}")
+        logger.error(f"❌ Failed to send approval notification: {e}")
         return False
 
 def notify_shopkeeper_of_approval_result(shopkeeper_chat_id: int, product_name: str, action: str, approved: bool, shop_id: int = None):
@@ -429,11 +434,10 @@ def notify_shopkeeper_of_approval_result(shopkeeper_chat_id: int, product_name:
         shop_info = ""
         if shop_id:
             from app.core import SessionLocal
-            tenant_db = SessionLocal()
-            shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
-            if shop:
-                shop_info = f"\n🏪 *Shop:* {shop.name}"
-            tenant_db.close()
+            with SessionLocal() as tenant_db:
+                shop = tenant_db.get(ShopORM, shop_id)
+                if shop:
+                    shop_info = f"\n🏪 *Shop:* {shop.name}"
         
         if approved:
             message = f"✅ *Approval Granted*\n\n"
@@ -450,7 +454,7 @@ def notify_shopkeeper_of_approval_result(shopkeeper_chat_id: int, product_name:
         return True
 
     except Exception as e:
-        print(f"❌ Failed to send approval result notification: {e}")
+        logger.error(f"❌ Failed to send approval result notification: {e}")
         return False
 
 def notify_owner_of_stock_update_request(shopkeeper_chat_id: int, product_name: str, old_stock: int, new_stock: int, shopkeeper_name: str, approval_id: int, shop_id: int):
@@ -460,10 +464,9 @@ def notify_owner_of_stock_update_request(shopkeeper_chat_id: int, product_name:
     try:
         # Get shop info
         from app.core import SessionLocal
-        tenant_db = SessionLocal()
-        shop = tenant_db.query(ShopORM).filter(ShopORM.shop_id == shop_id).first()
-        shop_name = shop.name if shop else f"Shop {shop_id}"
-        tenant_db.close()
+        with SessionLocal() as tenant_db:
+            shop = tenant_db.get(ShopORM, shop_id)
+            shop_name = shop.name if shop else f"Shop {shop_id}"
         
         message = f"📈 *Stock Update Request*\n\n"
         message += f"🏪 *Shop:* {shop_name}\n"
@@ -487,7 +490,7 @@ def notify_owner_of_stock_update_request(shopkeeper_chat_id: int, product_name:
         return True
 
     except Exception as e:
-        print(f"❌ Failed to send stock update notification: {e}")
+        logger.error(f"❌ Failed to send stock update notification: {e}")
         return False
 
 # ==================== SHOP-SPECIFIC USER NOTIFICATIONS ====================
@@ -550,6 +553,6 @@ def notify_owner_of_new_shopkeeper(owner_chat_id: int, shopkeeper_username: str,
         return True
 
     except Exception as e:
-        print(f"❌ Failed to send new shopkeeper notification: {e}")
+        logger.error(f"❌ Failed to send new shopkeeper notification: {e}")
         return False
     
\ No newline at end of file
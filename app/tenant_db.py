@@ -1,13 +1,14 @@
 # app/tenant_db.py
 import os
 import logging
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 import re
 import secrets
 import string
 import time
+from contextlib import contextmanager
 from app.models.central_models import User
 from app.models.models import ProductORM, CustomerORM, SaleORM, PendingApprovalORM, ShopORM, ProductShopStockORM
 from app.models.central_models import Tenant
@@ -83,34 +84,36 @@ def create_tenant_db(chat_id: int, role: str = "owner") -> tuple:
     logger.info(f"📌 Creating tenant schema: {schema_name} for chat_id={chat_id}")
 
     try:
-        with engine.connect() as conn:
+        # Schema and tenant record go in one transaction
+        with engine.begin() as conn:
             # 1. CREATE SCHEMA
             conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema_name}"'))
-            conn.commit()
             logger.info(f"✅ Schema '{schema_name}' created")
             
-            # 2. CREATE TENANT RECORD (if not exists)
-            existing_tenant = conn.execute(
-                text("SELECT tenant_id FROM tenants WHERE telegram_owner_id = :oid"),
-                {"oid": chat_id},
-            ).fetchone()
+            # 2. CREATE TENANT RECORD (if not exists) - telegram_owner_id is unique
+            conn.execute(
+                text("""
+                    INSERT INTO tenants (tenant_id, store_name, telegram_owner_id, database_url, created_at)
+                    VALUES (gen_random_uuid(), :store, :oid, :url, NOW())
+                    ON CONFLICT (telegram_owner_id) DO NOTHING
+                """),
+                {
+                    "store": f"Store_{chat_id}",
+                    "oid": chat_id,
+                    "url": database_url,
+                },
+            )
+            logger.info(f"✅ Tenant record ensured for {chat_id}")
 
-            if not existing_tenant:
-                conn.execute(
-                    text("""
-                        INSERT INTO tenants (tenant_id, store_name, telegram_owner_id, database_url, created_at)
-                        VALUES (gen_random_uuid(), :store, :oid, :url, NOW())
-                    """),
-                    {
-                        "store": f"Store_{chat_id}",
-                        "oid": chat_id,
-                        "url": database_url,
-                    },
-                )
-                conn.commit()
-                logger.info(f"✅ Tenant record created for {chat_id}")
-            
-            # 3. UPDATE USER'S tenant_schema FIELD
+        # 3. CREATE TABLES IN THE SCHEMA
+        if not ensure_tenant_tables(database_url, schema_name):
+            # users.tenant_schema stays NULL, so provisioning is retried later
+            return None, {}
+        logger.info(f"✅ All tables created in '{schema_name}'")
+
+        # 4. UPDATE USER'S tenant_schema FIELD - last, so a linked schema
+        # always has its tables
+        with engine.begin() as conn:
             result = conn.execute(
                 text("UPDATE users SET tenant_schema = :schema WHERE chat_id = :cid RETURNING username"),
                 {"schema": schema_name, "cid": chat_id},
@@ -120,12 +123,6 @@ def create_tenant_db(chat_id: int, role: str = "owner") -> tuple:
                 logger.info(f"✅ Linked user {result[0]} → {schema_name}")
             else:
                 logger.warning(f"⚠️ User with chat_id {chat_id} not found")
-            
-            conn.commit()
-
-        # 4. CREATE TABLES IN THE SCHEMA
-        ensure_tenant_tables(database_url, schema_name)
-        logger.info(f"✅ All tables created in '{schema_name}'")
 
         # 5. RETURN SUCCESS
         return schema_name, {}
@@ -135,6 +132,8 @@ def create_tenant_db(chat_id: int, role: str = "owner") -> tuple:
         import traceback
         traceback.print_exc()
         return None, {}
+    finally:
+        engine.dispose()
         
 # ======================================================
 # 🔹 CREATE SHOP-SPECIFIC USERS (NEW FUNCTION)
@@ -245,7 +244,10 @@ def create_shop_users(chat_id: int, shop_id: int, shop_name: str):
 # 🔹 ENSURE TENANT TABLES (UPDATED FOR SHOP_ID IN PRODUCTS)
 # ======================================================
 def ensure_tenant_tables(base_url: str, schema_name: str):
-    """Ensure all tenant tables exist in the correct schema using raw SQL."""
+    """
+    Ensure all tenant tables exist in the correct schema using raw SQL.
+    Returns True on success, False if the tables could not be created.
+    """
     logger.info(f"🔄 Ensuring tables in schema: {schema_name}")
     
     try:
@@ -462,57 +464,224 @@ def ensure_tenant_tables(base_url: str, schema_name: str):
             except Exception as e:
                 logger.info(f"ℹ️ Foreign key might already exist: {e}")
             
+            ensure_product_search_index(conn, schema_name)
+            ensure_sales_date_index(conn, schema_name)
+            ensure_product_name_index(conn, schema_name)
+
             # 8. ✅ REMOVED: Don't create default main shop
             # Shops will be created by the owner during setup
             
             logger.info(f"✅ All tables created successfully in '{schema_name}'.")
+            return True
             
     except Exception as e:
         logger.error(f"❌ Failed to create tenant tables in {schema_name}: {e}")
         logger.error(f"❌ Error details: {str(e)}")
+        return False
+
+def ensure_product_search_index(conn, schema_name: str):
+    """
+    Trigram GIN index on products.name so the ILIKE '%term%' product
+    searches use an index instead of scanning the whole table.
+    Safe to call repeatedly; skipped if pg_trgm can't be installed.
+    """
+    try:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_products_name_trgm "
+            f"ON {schema_name}.products USING gin (name gin_trgm_ops)"
+        ))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.info(f"ℹ️ Product search index not created in {schema_name}: {e}")
+
+
+def ensure_sales_date_index(conn, schema_name: str):
+    """
+    B-tree index on sales.sale_date for the date-range report filters
+    (daily / weekly / monthly), which otherwise scan every sale.
+    Safe to call repeatedly.
+    """
+    try:
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_sales_sale_date "
+            f"ON {schema_name}.sales (sale_date)"
+        ))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.info(f"ℹ️ Sales date index not created in {schema_name}: {e}")
+
+
+def ensure_product_name_index(conn, schema_name: str):
+    """
+    Expression index on LOWER(products.name) for the case-insensitive
+    duplicate check in add_product. Not unique: existing tenants may
+    already hold case-variant duplicates across shops.
+    Safe to call repeatedly.
+    """
+    try:
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_products_lower_name "
+            f"ON {schema_name}.products (lower(name))"
+        ))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.info(f"ℹ️ Product name index not created in {schema_name}: {e}")
+
+# ======================================================
+# 🔹 BACKFILL INDEXES FOR EXISTING TENANTS
+# ======================================================
+# Tenants created before an index existed get it here, from a one-off
+# management run (python -m app.tenant_db) rather than on the request
+# path. CONCURRENTLY builds don't lock out writes to the table, but they
+# can't run inside a transaction, hence the AUTOCOMMIT engine.
+TENANT_BACKFILL_INDEXES = [
+    ("ix_products_name_trgm", "products USING gin (name gin_trgm_ops)"),
+    ("ix_sales_sale_date", "sales (sale_date)"),
+    ("ix_products_lower_name", "products (lower(name))"),
+]
+# Indexes no tenant query uses any more; dropped so sale INSERTs stop
+# maintaining them
+TENANT_DROPPED_INDEXES = [
+    "ix_sales_sale_day",
+]
+
+
+def _build_index_concurrently(conn, schema_name: str, index_name: str, definition: str) -> bool:
+    """
+    Build one index with CREATE INDEX CONCURRENTLY.
+    A build that failed halfway leaves an INVALID index behind, which
+    IF NOT EXISTS would skip, so that one is dropped and rebuilt.
+    Returns True if an index was built.
+    """
+    valid = conn.execute(
+        text("""
+            SELECT i.indisvalid
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = :schema AND c.relname = :name
+        """),
+        {"schema": schema_name, "name": index_name},
+    ).scalar()
+    if valid:
+        return False
+    if valid is False:
+        logger.warning(f"⚠️ Rebuilding invalid index {schema_name}.{index_name}")
+        conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{schema_name}".{index_name}'))
+    conn.execute(text(
+        f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON "{schema_name}".{definition}'
+    ))
+    return True
+
+
+def backfill_tenant_indexes():
+    """
+    Create any missing TENANT_BACKFILL_INDEXES in every tenant schema
+    and drop TENANT_DROPPED_INDEXES.
+    Safe to re-run; failures are logged per index and skipped.
+    """
+    engine = create_engine(DATABASE_URL, isolation_level="AUTOCOMMIT")
+    try:
+        with engine.connect() as conn:
+            try:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            except Exception as e:
+                logger.info(f"ℹ️ pg_trgm not available: {e}")
+
+            schemas = [
+                row[0] for row in conn.execute(text(
+                    "SELECT DISTINCT tenant_schema FROM users WHERE tenant_schema IS NOT NULL"
+                ))
+            ]
+            logger.info(f"🔎 Checking indexes in {len(schemas)} tenant schemas")
+
+            built = 0
+            for schema_name in schemas:
+                for index_name, definition in TENANT_BACKFILL_INDEXES:
+                    try:
+                        if _build_index_concurrently(conn, schema_name, index_name, definition):
+                            built += 1
+                            logger.info(f"✅ Built {schema_name}.{index_name}")
+                    except Exception as e:
+                        logger.warning(f"⚠️ Could not build {schema_name}.{index_name}: {e}")
+                for index_name in TENANT_DROPPED_INDEXES:
+                    try:
+                        conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{schema_name}".{index_name}'))
+                    except Exception as e:
+                        logger.warning(f"⚠️ Could not drop {schema_name}.{index_name}: {e}")
+            logger.info(f"✅ Index backfill done: {built} built")
+    finally:
+        engine.dispose()
 
 # ======================================================
-# 🔹 GET TENANT SESSION (SAME AS BEFORE)
+# 🔹 GET TENANT SESSION (ONE SHARED ENGINE)
 # ======================================================
+# Every tenant schema lives in the same database, so all tenants share
+# one pooled engine. The schema is picked per transaction by the
+# after_begin hook below rather than by a per-schema engine, so the
+# number of connections stays capped however many tenants there are.
+tenant_engine = create_engine(
+    DATABASE_URL,
+    pool_size=5,
+    max_overflow=10,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+)
+TenantSessionLocal = sessionmaker(bind=tenant_engine, autoflush=False, autocommit=False)
+
+
+@event.listens_for(TenantSessionLocal, "after_begin")
+def _set_tenant_search_path(session, transaction, connection):
+    """Point each transaction at the session's schema; SET LOCAL ends with it."""
+    schema_name = session.info.get("tenant_schema")
+    if schema_name:
+        connection.exec_driver_sql(f'SET LOCAL search_path TO "{schema_name}", public')
+
+
 def get_tenant_session(schema_name: str, chat_id: int = None):
     """
-    Create a tenant-scoped SQLAlchemy session.
-    Accepts schema name only.
+    Open a tenant-scoped SQLAlchemy session on the shared tenant engine.
+    Accepts schema name only. Callers must close() the session.
     """
     if not schema_name:
         logger.error(f"❌ No schema_name provided")
         return None
-    
-    # Always use DATABASE_URL from config
-    database_url = DATABASE_URL
-    
-    logger.info(f"🔗 Creating tenant session → {schema_name}")
 
+    session = None
     try:
-        # Create engine with search_path set in connect_args
-        engine = create_engine(
-            database_url,
-            pool_pre_ping=True,
-            pool_recycle=3600,
-            connect_args={"options": f"-csearch_path={schema_name},public"}
-        )
-        
-        # Create session
-        SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
-        session = SessionLocal()
-        
-        # Double-check search_path
-        session.execute(text(f"SET search_path TO {schema_name},public"))
-        result = session.execute(text("SHOW search_path")).fetchone()
-        logger.info(f"🧭 Active search_path: {result[0]}")
-        
-        logger.info(f"✅ ORM session search_path locked to: {schema_name},public")
+        # search_path is applied by _set_tenant_search_path at the start
+        # of every transaction, including the ones after each commit
+        session = TenantSessionLocal(info={"tenant_schema": schema_name})
+        # Check out a connection now (pre_ping makes that a cheap probe)
+        # so a dead database gives None here, as callers expect, rather
+        # than an exception at their first query
+        session.connection()
         return session
         
     except Exception as e:
         logger.error(f"❌ Failed to create tenant session for {schema_name}: {e}")
+        # Hand the connection back to the pool; the caller only sees None
+        if session is not None:
+            session.close()
         return None
 
+@contextmanager
+def tenant_session(schema_name: str, chat_id: int = None):
+    """
+    Context-managed tenant session: yields the session (or None if it
+    could not be opened) and always closes it on exit.
+    """
+    session = get_tenant_session(schema_name, chat_id)
+    try:
+        yield session
+    finally:
+        if session is not None:
+            session.close()
+
 # ======================================================
 # 🔹 ENSURE TENANT SESSION (UPDATED FOR MULTI-ROLE)
 # ======================================================
@@ -605,4 +774,8 @@ def create_additional_shop(tenant_session, shop_name: str, location: str = "", c
     except Exception as e:
         logger.error(f"❌ Failed to create additional shop: {e}")
         tenant_session.rollback()
-        return None
\ No newline at end of file
+        return None
+
+
+if __name__ == "__main__":
+    backfill_tenant_indexes()
@@ -1,4 +1,5 @@
 # app/tenants.py
+import functools
 from sqlalchemy import create_engine, text
 from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.orm import sessionmaker
@@ -35,12 +36,23 @@ def create_tenant_db(tenant_db_url: str):
             # Re-raise other errors
             raise
 
+@functools.lru_cache(maxsize=None)
 def get_engine_for_tenant(tenant_db_url: str):
     """
-    Returns a SQLAlchemy engine for a tenant database.
+    Returns the SQLAlchemy engine for a tenant database.
+    Cached per URL so every caller shares one connection pool.
     """
-    return create_engine(tenant_db_url, echo=False, future=True, pool_pre_ping=True)
+    return create_engine(
+        tenant_db_url,
+        echo=False,
+        future=True,
+        pool_size=5,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+    )
 
+@functools.lru_cache(maxsize=None)
 def get_session_for_tenant(tenant_db_url: str):
     """
     Returns a sessionmaker (factory) for the tenant database.
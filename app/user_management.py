@@ -10,7 +10,7 @@ from app.models.central_models import User
 from app.models.models import ShopORM
 from typing import Dict, Optional, List
 import logging
-import random
+import secrets
 import string
 import bcrypt
 import hashlib  # ⬅️ ADD THIS IMPORT
@@ -18,10 +18,14 @@ import time
 
 logger = logging.getLogger(__name__)
 
+# bcrypt work factor, pinned so hashing cost doesn't drift with library
+# defaults. Each +1 doubles the time; 12 is ~250ms per hash on one core.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
 
 def hash_password(password: str) -> str:
     """Hash a password using bcrypt"""
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
     return hashed.decode('utf-8')
 
@@ -73,11 +77,13 @@ def generate_username(prefix: str, shop_name: str, existing_count: int = 0) -> s
         return f"{prefix}_{clean_name}_{timestamp:04d}"
 
 
+# Only alphanumeric for simplicity in Telegram
+PASSWORD_ALPHABET = string.ascii_letters + string.digits
+
+
 def generate_password(length: int = 10) -> str:
-    """Generate strong random password"""
-    # Use only alphanumeric for simplicity in Telegram
-    chars = string.ascii_letters + string.digits
-    return ''.join(random.choice(chars) for _ in range(length))
+    """Generate strong random password (CSPRNG, not the random module)"""
+    return ''.join(secrets.choice(PASSWORD_ALPHABET) for _ in range(length))
 
 
 def create_default_users(db: Session, tenant_db: Session, owner_user: User) -> Dict:
@@ -35,12 +35,17 @@ twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN) if TWILIO_ACCOUNT_
 # --- Telegram ---
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}" if TELEGRAM_BOT_TOKEN else None
+# Public URL of /telegram/webhook; when set the webhook is (re)registered at startup
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")
+# Concurrent update deliveries Telegram may open to us (1-100, Telegram default 40)
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", "100"))
 
 # --- FastAPI ---
 FASTAPI_SECRET_KEY = os.getenv("FASTAPI_SECRET_KEY", "supersecret")
 
 # --- Redis ---
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Unset → conversation state stays in-process (single worker only)
+REDIS_URL = os.getenv("REDIS_URL")
 
 # --- Tenant DB Base URL (used for schema-based tenants) ---
 if DATABASE_URL:
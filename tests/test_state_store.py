@@ -0,0 +1,43 @@
+import threading
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from app.state_store import LockRenewer
+
+
+def test_renewer_resets_ttl_of_lock_acquired_on_another_thread():
+    r = fakeredis.FakeRedis()
+    lock = r.lock("chat:1", timeout=1, thread_local=False)
+    assert lock.acquire(blocking=False)
+
+    renewer = LockRenewer(interval=0.3)
+    renewer.add(lock)
+    renewer.start()
+    try:
+        # Hold the lock past its TTL; the renewer thread must keep it alive
+        time.sleep(1.5)
+        assert lock.owned()
+        assert r.pttl("chat:1") > 500
+    finally:
+        renewer.discard(lock)
+        lock.release()
+
+
+def test_renew_once_counts_only_locks_it_could_renew():
+    r = fakeredis.FakeRedis()
+    lock = r.lock("chat:2", timeout=5, thread_local=False)
+    assert lock.acquire(blocking=False)
+    renewer = LockRenewer(interval=60)
+    renewer.add(lock)
+
+    results = []
+    t = threading.Thread(target=lambda: results.append(renewer.renew_once()))
+    t.start()
+    t.join()
+    assert results == [1]
+
+    lock.release()
+    assert renewer.renew_once() == 0